@@ -1,47 +1,152 @@
 import uproot
 import pandas as pd
+import numpy as np
 
 import awkward as ak
 
-# load and skim dataframe a few events at a time (more memory efficient)
-def getDF(_tree, entrysteps=10, subdet=0, zside=1, layer=9, u=3, v=3):
+from patternIO import format_words
+
+BRANCHES=['hgcdigi_subdet','hgcdigi_zside','hgcdigi_layer','hgcdigi_waferu','hgcdigi_waferv','hgcdigi_cellu','hgcdigi_cellv','hgcdigi_wafertype','hgcdigi_data_BX1','hgcdigi_isadc_BX1','hgcdigi_data_BX2','hgcdigi_isadc_BX2','hgcdigi_toa_BX2']
+
+def waferKey(subdet, zside, layer, u, v):
+    """single integer identifying a wafer, so digis can be selected for many wafers at once"""
+    return ((((subdet+8)*4 + (zside+1))*64 + layer)*64 + (u+32))*64 + (v+32)
+
+def iterateSelected(_tree, selectDigis, entrysteps=10, entrystart=0, maxevents=None):
+    """
+    read the tree in chunks of entrysteps entries, starting at entry entrystart,
+      and keep only the digis passing selectDigis (jagged boolean array from a chunk of the tree) from each chunk
+    stops after maxevents entries with selected digis (None to read the full tree)
+    returns an empty DataFrame (same columns and index) if no digis are selected, e.g. if entrystart is past the end of the tree
+    """
     t = []
-    branches=['hgcdigi_subdet','hgcdigi_zside','hgcdigi_layer','hgcdigi_waferu','hgcdigi_waferv','hgcdigi_cellu','hgcdigi_cellv','hgcdigi_wafertype','hgcdigi_data_BX1','hgcdigi_isadc_BX1','hgcdigi_data_BX2','hgcdigi_isadc_BX2','hgcdigi_toa_BX2']
 
-    x = _tree.arrays(branches)
-    selection = (x['hgcdigi_subdet']==subdet) & (x['hgcdigi_zside']==zside) & (x['hgcdigi_layer']==layer) & (x['hgcdigi_waferu']==u) & (x['hgcdigi_waferv']==v)
+    nevents = 0
+    for x,report in _tree.iterate(BRANCHES, step_size=entrysteps, entry_start=entrystart, report=True):
+        x = x[selectDigis(x)]
+
+        hasDigis = ak.to_numpy(ak.num(x['hgcdigi_subdet'])>0)
+        if hasDigis.sum()==0:
+            continue
 
-    return ak.to_pandas(x[selection])
+        done = maxevents is not None and nevents+hasDigis.sum()>=maxevents
+        if done:
+            # keep only the entries needed to reach maxevents
+            x = x[:np.flatnonzero(hasDigis)[maxevents-nevents-1]+1]
+        nevents += ak.sum(ak.num(x['hgcdigi_subdet'])>0)
 
+        # entry numbers start from 0 in each chunk
+        df = ak.to_pandas(x)
+        df.index = df.index.set_levels(df.index.levels[0]+report.tree_entry_start, level='entry')
+        t.append(df)
+
+        if done:
+            break
+
+    if len(t)==0:
+        index = pd.MultiIndex.from_arrays([np.zeros(0,dtype=np.int64)]*2, names=['entry','subentry'])
+        return pd.DataFrame({b:np.zeros(0,dtype=np.int32) for b in BRANCHES}, index=index)
+
+    return pd.concat(t)
+
+# load and skim dataframe a few events at a time (more memory efficient)
+def getDF(_tree, entrysteps=10, subdet=0, zside=1, layer=9, u=3, v=3, entrystart=0, maxevents=None):
+    """
+    read the digis of one wafer, in chunks of entrysteps entries, starting at entry entrystart
+    stops after maxevents entries with digis in the wafer (None to read the full tree)
+    """
+    def selectDigis(x):
+        return (x['hgcdigi_subdet']==subdet) & (x['hgcdigi_zside']==zside) & (x['hgcdigi_layer']==layer) & (x['hgcdigi_waferu']==u) & (x['hgcdigi_waferv']==v)
+
+    return iterateSelected(_tree, selectDigis, entrysteps, entrystart, maxevents)
+
+def getDFWafers(_tree, entrysteps=10, wafers=None, layer=None, entrystart=0, maxevents=None):
+    """
+    read the digis of several wafers in a single pass over the tree
+      wafers: list of (subdet,zside,layer,waferu,waferv)
+      layer: (subdet,zside,layer), to read all wafers in a layer instead
+    stops after maxevents entries with digis in any of the wafers (None to read the full tree)
+    """
+    def selectDigis(x):
+        if wafers is None:
+            return (x['hgcdigi_subdet']==layer[0]) & (x['hgcdigi_zside']==layer[1]) & (x['hgcdigi_layer']==layer[2])
+
+        # compare flattened wafer keys against the list of wafers, then restore the per-entry structure
+        keys = waferKey(*[ak.to_numpy(ak.flatten(x[b])).astype(np.int64) for b in BRANCHES[:5]])
+        return ak.unflatten(np.isin(keys,[waferKey(*w) for w in wafers]), ak.num(x['hgcdigi_subdet']))
+
+    return iterateSelected(_tree, selectDigis, entrysteps, entrystart, maxevents)
+
+def formatData(df):
+    """
+    build the 32 bit words for all cells at once, from the columns of the dataframe
+      isTOT (1b) + tp (1b) + adc BX-1 (10b) + adc/tot (10b) + toa (10b)
+    """
+    isTOT = 1-df.isadc.values.astype(np.int64)
 
-def formatData(x):
-    isTOT = 1-x.isadc
-    
-    tp = 0
     # assign tp randomly??? right now, just use isadc-1
-    tp = 1-x.isadcm1
-    
+    tp = 1-df.isadcm1.values.astype(np.int64)
+
     # build 32 bit word
-    data = (isTOT<<31) + (tp<<30) + (x.adcm1<<20) + (x.cellData<<10) + (x.toa)
+    data = (isTOT<<31) + (tp<<30) + (df.adcm1.values.astype(np.int64)<<20) + (df.cellData.values.astype(np.int64)<<10) + (df.toa.values.astype(np.int64))
     return data
 
 
-def loadMCData(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/ConcentratorNtuples/L1THGCal_Ntuples/DAQ_Data/TTbar_SampleFile/ntuple.root',
-               outputName=None,
-               subdet=0,
-               zside=1,
-               layer=5,
-               waferu=3,
-               waferv=1,
-               dataType='bin',
-               returnCellDF=False):
+def formatWords(words,base):
+    """render words as lower case hex (base=16) or binary (base=2) strings"""
+    words = np.asarray(words)
+    if len(words)>0 and (words.min()<0 or words.max()>0xffffffff):
+        # does not fit in 32 bits, fall back to python formatting
+        fmt = '{0:08x}' if base==16 else '{0:032b}'
+        return np.array([fmt.format(x) for x in words],dtype=object)
+    return format_words(words,base,upper=False).astype(str).astype(object)
 
 
-    #load tree
+NLINKS = 12
+NCHANNELS = 37
+
+def linksToArray(dfLinks):
+    """
+    dense array of the eLink data (with integer words)
+    returns the entry numbers, the (n_entries, 12, 37) uint32 payload, and which (entry, eLink) are present in dfLinks
+    """
+    entryNumbers = dfLinks.index.get_level_values('entry').values
+    eLinks = dfLinks.index.get_level_values('eLink').values
+    entries = np.unique(entryNumbers)
+    iEntry = np.searchsorted(entries, entryNumbers)
+
+    payload = np.zeros((len(entries),NLINKS,NCHANNELS), dtype=np.uint32)
+    payload[iEntry,eLinks] = dfLinks.values
+    present = np.zeros((len(entries),NLINKS), dtype=bool)
+    present[iEntry,eLinks] = True
+    return entries, payload, present
+
+
+def arrayToLinks(entries, payload, present, dataType='int'):
+    """eLink dataframe (as returned by loadMCData) from the dense array"""
+    iEntry,eLinks = np.nonzero(present)
+    index = pd.MultiIndex.from_arrays([entries[iEntry],eLinks.astype(np.int64)], names=['entry','eLink'])
+    words = payload[iEntry,eLinks].astype(np.int64)
+
+    if dataType.lower()=='hex':
+        values = formatWords(words.reshape(-1),16).reshape(words.shape)
+    elif dataType.lower()=='bin':
+        values = formatWords(words.reshape(-1),2).reshape(words.shape)
+    else:
+        values = words
+    return pd.DataFrame(values, index=index, columns=[f'CH{i}' for i in range(NCHANNELS)])
+
+
+def openTree(fName):
     uproot.open.defaults["xrootd_handler"] = uproot.MultithreadedXRootDSource
-    _tree = uproot.open(fName)['hgcalTriggerNtuplizer/HGCalTriggerNtuple']
+    return uproot.open(fName)['hgcalTriggerNtuplizer/HGCalTriggerNtuple']
+
 
-    df = getDF(_tree, 5, subdet=subdet, zside=zside, layer=layer, u=waferu, v=waferv)
+def processDF(df, dataType='bin', returnCellDF=False, outputName=None, calCells=None, linkMap=None):
+    """
+    convert the digis of one wafer (from getDF) into the formatted words of each channel of each eLink
+      calCells/linkMap: geometry tables, read from geomInfo if not given
+    """
     df.columns = ['subdet','zside','layer','waferu','waferv','cellu','cellv','wafertype','adcm1','isadcm1','cellData','isadc','toa']
 
     df['HDM'] = df.wafertype==0
@@ -51,11 +156,12 @@ def loadMCData(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/Concentrator
     df.loc[df.toa==-1,'toa'] = 0
 
     #convert the 3 values into a formatted 32 bit word
-    df['FormattedData'] = df.apply(formatData,axis=1)
+    df['FormattedData'] = formatData(df)
 
     #duplicate specific cells and call them calibration cells
     #  give calibration cells u/v values that are negative
-    calCells = pd.read_csv('geomInfo/calibrationCells.csv')
+    if calCells is None:
+        calCells = pd.read_csv('geomInfo/calibrationCells.csv')
     calCellData = df.reset_index().merge(calCells,on=['HDM','cellu','cellv']).fillna(0)
     calCellData[['cellu','cellv']] = calCellData[['U','V']]
 
@@ -63,19 +169,23 @@ def loadMCData(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/Concentrator
     df = pd.concat([df.reset_index(),calCellData.drop(['isCal','U','V'],axis=1)])
 
     #merge with eRx link mapping
-    linkMap = pd.read_csv('geomInfo/eLinkInputMapFull.csv')
+    if linkMap is None:
+        linkMap = pd.read_csv('geomInfo/eLinkInputMapFull.csv')
     df = df.merge(linkMap,on=['HDM','cellu','cellv']).set_index(['entry','eLink','linkChannel'])
     df.sort_index(inplace=True)
 
     if dataType.lower()=='hex':
-        df['FormattedData'] = df.FormattedData.apply(lambda x: '{0:08x}'.format(x) )
-        dfLinks = df.FormattedData.unstack(fill_value='00000000')
+        df['FormattedData'] = formatWords(df.FormattedData.values,16)
+        fill_value = '00000000'
     elif dataType.lower()=='bin':
-        df['FormattedData'] = df.FormattedData.apply(lambda x: '{0:032b}'.format(x) )
-        dfLinks = df.FormattedData.unstack(fill_value='0'*32)
+        df['FormattedData'] = formatWords(df.FormattedData.values,2)
+        fill_value = '0'*32
     else:
-        dfLinks = df.FormattedData.unstack(fill_value=0)
+        fill_value = 0
+    dfLinks = df.FormattedData.unstack(fill_value=fill_value)
 
+    # always 37 channels per eLink (the last ones are empty for low density wafers)
+    dfLinks = dfLinks.reindex(columns=range(37), fill_value=fill_value)
     dfLinks.columns = [f'CH{i}' for i in range(37)]
 
     if not outputName is None:
@@ -88,6 +198,102 @@ def loadMCData(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/Concentrator
         return dfLinks
 
 
+def loadMCData(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/ConcentratorNtuples/L1THGCal_Ntuples/DAQ_Data/TTbar_SampleFile/ntuple.root',
+               outputName=None,
+               subdet=0,
+               zside=1,
+               layer=5,
+               waferu=3,
+               waferv=1,
+               dataType='bin',
+               returnCellDF=False,
+               entryStart=0,
+               maxEvents=None,
+               entrySteps=1000,
+               cache=None,
+               returnArray=False):
+    """
+    cache: MCDataCache, to reuse the eLink data from a previous run instead of reading the ntuple (not used with returnCellDF)
+    returnArray: return the dense (n_entries, 12, 37) uint32 array of integer words, and a pd.Index of the entry number of each row,
+                 instead of the eLink dataframe (entries/links missing from the MC are filled with zeros)
+    """
+
+    if returnArray or (cache is not None and not returnCellDF):
+        cached = None
+        if cache is not None:
+            key = cache.key(fName, (subdet,zside,layer,waferu,waferv), entryStart, maxEvents)
+            cached = cache.get(key)
+        if cached is None:
+            cached = linksToArray(loadMCData(fName, subdet=subdet, zside=zside, layer=layer, waferu=waferu, waferv=waferv, dataType='int',
+                                             entryStart=entryStart, maxEvents=maxEvents, entrySteps=entrySteps))
+            if cache is not None:
+                cache.put(key, *cached)
+
+        entries,payload,present = cached
+        if returnArray:
+            return payload, pd.Index(entries, name='entry')
+
+        dfLinks = arrayToLinks(*cached, dataType=dataType)
+        if not outputName is None:
+            dfLinks.to_csv(outputName)
+        return dfLinks
+
+    #load tree
+    _tree = openTree(fName)
+
+    df = getDF(_tree, entrySteps, subdet=subdet, zside=zside, layer=layer, u=waferu, v=waferv, entrystart=entryStart, maxevents=maxEvents)
+
+    return processDF(df, dataType=dataType, returnCellDF=returnCellDF, outputName=outputName)
+
+
+def loadMCDataWafers(fName = 'root://cmseos.fnal.gov//store/user/lpchgcal/ConcentratorNtuples/L1THGCal_Ntuples/DAQ_Data/TTbar_SampleFile/ntuple.root',
+                     wafers=None,
+                     layer=None,
+                     dataType='bin',
+                     returnCellDF=False,
+                     entryStart=0,
+                     maxEvents=None,
+                     entrySteps=1000,
+                     cache=None):
+    """
+    load the eLink data of several wafers, reading the ntuple only once
+      wafers: list of (subdet,zside,layer,waferu,waferv)
+      layer: (subdet,zside,layer), to load all wafers in a layer instead
+      cache: MCDataCache, only wafers not in the cache are read from the ntuple (when given a list of wafers, and not with returnCellDF)
+    returns a dict, keyed by (subdet,zside,layer,waferu,waferv), of what loadMCData returns for each wafer
+    """
+    if wafers is None and layer is None:
+        raise ValueError('loadMCDataWafers needs either a list of wafers or a layer')
+
+    if cache is not None and wafers is not None and not returnCellDF:
+        waferData = {}
+        keys = {tuple(w):cache.key(fName, w, entryStart, maxEvents) for w in wafers}
+        cached = {w:cache.get(k) for w,k in keys.items()}
+        missing = [w for w in cached if cached[w] is None]
+        if len(missing)>0:
+            for w,dfLinks in loadMCDataWafers(fName, wafers=missing, dataType='int', entryStart=entryStart, maxEvents=maxEvents, entrySteps=entrySteps).items():
+                cached[w] = linksToArray(dfLinks)
+                cache.put(keys[w], *cached[w])
+        for w in wafers:
+            if cached[tuple(w)] is not None:
+                waferData[tuple(w)] = arrayToLinks(*cached[tuple(w)], dataType=dataType)
+        return waferData
+
+    _tree = openTree(fName)
+
+    df = getDFWafers(_tree, entrySteps, wafers=wafers, layer=layer, entrystart=entryStart, maxevents=maxEvents)
+
+    calCells = pd.read_csv('geomInfo/calibrationCells.csv')
+    linkMap = pd.read_csv('geomInfo/eLinkInputMapFull.csv')
+
+    waferData = {}
+    for wafer,dfWafer in df.groupby(BRANCHES[:5]):
+        wafer = tuple(int(x) for x in wafer)
+        waferData[wafer] = processDF(dfWafer.copy(), dataType=dataType, returnCellDF=returnCellDF, calCells=calCells, linkMap=linkMap)
+
+    return waferData
+
+
 if __name__=="__main__":
     dfLinks, df = loadMCData(fName='InputNtuples/ntuple.root',
                              returnCellDF=True)
@@ -0,0 +1,122 @@
+import numpy as np
+
+###############################################
+# L1A sequence generators
+###############################################
+#
+# each generator returns a sorted int64 array of the BXs with a L1A, in O(number of L1As)
+#   (except `random`, kept as in the original emulator, which shuffles the full range of BXs)
+# - fixed:   one L1A every freq BXs
+# - random:  a Poisson number of L1As, placed uniformly in the range (seeded as the original emulator)
+# - poisson: a L1A in each BX with probability 1/freq (exponential spacing), e.g. freq=53.44 for 750 kHz
+# the sequences can then be filtered by trigger rules (at most k L1As in any window of BXs)
+#   and by vetoes around other fast commands (BCR, EBR, LinkReset)
+#
+# each generator has its own random number generator, seeded from the seed and the sequence
+#
+###############################################
+
+LHC_BX_FREQ = 40.079e6
+
+# CMS (Run 2) trigger rules: (k, window) for at most k L1As in any window of consecutive BXs
+CMS_TRIGGER_RULES = [(1,3),(2,25),(3,100),(4,240)]
+
+# stream of each generator, to seed them independently from the same seed
+RNG_STREAMS = {'poisson': 1, 'mcEvents': 2}
+
+def make_rng(seed, stream, *keys):
+    """random number generator for one stream (e.g. one L1A sequence), independent of the other streams"""
+    return np.random.default_rng([seed, RNG_STREAMS[stream]]+list(keys))
+
+def freq_from_rate(rate):
+    """mean number of BXs between L1As for a L1A rate in Hz (e.g. 750e3 -> 53.44)"""
+    return LHC_BX_FREQ/rate
+
+def fixed_sequence(first, num, freq, N):
+    """L1As at BX (j+1)*freq, for j from first to first+num (only BXs before N)"""
+    if freq<=0:
+        raise ValueError(f'L1A frequency has to be positive, got {freq}')
+    last = min(first+num, (N-1)//freq)
+    return (np.arange(first, max(first,last), dtype=np.int64)+1)*freq
+
+def random_sequence(start, stop, freq, seed=6):
+    """a Poisson number of L1As (mean (stop-start)/freq) in distinct BXs in [start,stop)"""
+    rng = np.random.RandomState(seed)
+    return np.sort(rng.choice(np.arange(start,stop), rng.poisson((stop-start)*1./freq), replace=False)).astype(np.int64)
+
+def poisson_sequence(start, stop, freq, num=-1, rng=None):
+    """
+    L1As in [start,stop), with probability 1/freq in each BX (geometric spacing between L1As)
+      at most num L1As (-1: no limit)
+    """
+    if freq<1:
+        raise ValueError(f'L1A frequency has to be at least 1 BX, got {freq}')
+    if rng is None:
+        rng = make_rng(0,'poisson')
+    p = 1./freq
+
+    # draw the spacings in chunks, with a little more than the expected number of L1As left
+    chunks = []
+    last = start-1
+    while last<stop-1:
+        size = int((stop-1-last)*p*1.1) + 16
+        bxs = last + np.cumsum(rng.geometric(p,size))
+        chunks.append(bxs[bxs<stop])
+        if len(chunks[-1])<size:
+            break
+        last = bxs[-1]
+    bxs = np.concatenate(chunks) if len(chunks)>0 else np.zeros(0,dtype=np.int64)
+
+    if num>-1:
+        bxs = bxs[:num]
+    return bxs.astype(np.int64)
+
+def parse_trigger_rules(rules):
+    """'cms' or a list of k,window pairs separated by ';' (e.g. '1,3;2,25')"""
+    if rules=='':
+        return []
+    if rules.lower()=='cms':
+        return CMS_TRIGGER_RULES
+    return [tuple(int(x) for x in rule.split(',')) for rule in rules.split(';')]
+
+def apply_trigger_rules(bxs, rules):
+    """
+    keep L1As (in order) as long as they pass all the rules: at most k L1As in any window of consecutive BXs
+    returns a boolean mask of the accepted L1As
+    """
+    accepted = np.ones(len(bxs),dtype=bool)
+    if len(rules)==0 or len(bxs)==0:
+        return accepted
+
+    # L1As that would pass the rules when counting all the previous L1As pass them for sure,
+    #   so only L1As close to a previous one need the sequential check
+    suspect = np.zeros(len(bxs),dtype=bool)
+    for k,window in rules:
+        suspect[k:] |= (bxs[k:]-bxs[:-k])<window
+    if not suspect.any():
+        return accepted
+
+    maxk = max(k for k,window in rules)
+    kept = []
+    for i,bx in enumerate(bxs.tolist()):
+        if suspect[i]:
+            for k,window in rules:
+                if len(kept)>=k and bx-kept[-k]<window:
+                    accepted[i] = False
+                    break
+        if accepted[i]:
+            kept.append(bx)
+            if len(kept)>maxk: kept.pop(0)
+    return accepted
+
+def apply_vetoes(bxs, veto_bxs, before=0, after=0):
+    """
+    boolean mask of the L1As outside of the veto windows [veto-before, veto+after] around each of veto_bxs
+    """
+    veto_bxs = np.sort(np.asarray(veto_bxs,dtype=np.int64))
+    if len(veto_bxs)==0 or len(bxs)==0:
+        return np.ones(len(bxs),dtype=bool)
+    # first veto BX at or after bx-after, vetoed if it is at most bx+before
+    i = np.searchsorted(veto_bxs, bxs-after, side='left')
+    next_veto = veto_bxs[np.minimum(i,len(veto_bxs)-1)]
+    return ~((i<len(veto_bxs)) & (next_veto<=bxs+before))
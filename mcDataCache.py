@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from rocMetrics import log
+
+###############################################
+# On-disk cache of the eLink payloads loaded from MC ntuples
+###############################################
+#
+# each entry is a .npz file with the dense (n_entries, 12, 37) uint32 payload of one wafer,
+#   the entry numbers, and which (entry, eLink) pairs are present
+# keyed by:
+#   - the identity of the ntuple (absolute path, size and modification time, or the URL for remote files)
+#   - the wafer coordinates and the entries read (entryStart, maxEvents)
+#   - the contents of the geometry files (calibration cells, eLink mapping)
+# the total size is limited, removing the least recently used entries first
+#
+###############################################
+
+CACHE_VERSION = 1
+
+GEOMETRY_FILES = ['geomInfo/calibrationCells.csv','geomInfo/eLinkInputMapFull.csv']
+
+def ntupleIdentity(fName):
+    """path, size and modification time of a local ntuple (the name alone for remote files)"""
+    if '://' in fName and not fName.startswith('file://'):
+        return [fName]
+    path = os.path.abspath(fName.replace('file://',''))
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def fileHash(fName):
+    with open(fName,'rb') as _file:
+        return hashlib.sha1(_file.read()).hexdigest()
+
+def isNoCache(cacheDir):
+    """no cache for '' (or an empty string left quoted by the shell, e.g. "''")"""
+    return cacheDir is None or cacheDir.strip().strip('\'"')==''
+
+def makeCache(cacheDir, maxSizeMB=1000):
+    """MCDataCache in cacheDir, or None if no cache is used"""
+    return None if isNoCache(cacheDir) else MCDataCache(cacheDir, maxSizeMB)
+
+class MCDataCache:
+    """
+    cacheDir: directory of the cache files
+    maxSizeMB: limit on the total size of the cache, least recently used files are removed first
+    """
+    def __init__(self, cacheDir='mcCache', maxSizeMB=1000, geometryFiles=GEOMETRY_FILES):
+        if isNoCache(cacheDir):
+            raise ValueError(f'No cache directory given ({cacheDir!r})')
+        self.cacheDir = cacheDir
+        self.maxSize = maxSizeMB*1024*1024
+        self.geometryHash = [fileHash(f) for f in geometryFiles]
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, fName, wafer, entryStart=0, maxEvents=None):
+        info = {'version': CACHE_VERSION,
+                'ntuple': ntupleIdentity(fName),
+                'wafer': [int(x) for x in wafer],
+                'entryStart': entryStart,
+                'maxEvents': maxEvents,
+                'geometry': self.geometryHash,
+                }
+        return hashlib.sha1(json.dumps(info,sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, f'{key}.npz')
+
+    def get(self, key):
+        """returns (entries, payload, present), or None if not in the cache"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as cached:
+                data = cached['entries'], cached['payload'], cached['present']
+        except Exception:
+            log.warning(f'Unable to read cache file {path}, ignoring it')
+            return None
+
+        # mark as recently used
+        os.utime(path)
+        return data
+
+    def put(self, key, entries, payload, present):
+        # write to a temporary file first, so a partially written file is never read back
+        fd,tmpName = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        with os.fdopen(fd,'wb') as _file:
+            np.savez(_file, entries=entries, payload=payload, present=present)
+        os.replace(tmpName, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used files until the cache fits in maxSizeMB"""
+        files = [os.path.join(self.cacheDir,f) for f in os.listdir(self.cacheDir) if f.endswith('.npz')]
+        files = sorted(files, key=os.path.getmtime)
+        totalSize = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if totalSize<=self.maxSize:
+                break
+            totalSize -= os.path.getsize(f)
+            os.remove(f)
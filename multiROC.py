@@ -0,0 +1,208 @@
+import argparse
+import json
+
+import numpy as np
+
+import simulateInputECOND as sim
+from patternIO import CSVPatternWriter,BinaryPatternWriter
+from rocMetrics import log,setup_logging,RunMetrics,metrics_file_name
+
+###############################################
+# Several ROCs, read out by one or more ECON-Ds, driven by the same fast command stream
+###############################################
+#
+# the fast commands (L1As, BCRs, resets) are generated once, from the arguments of simulateInputECOND.py,
+#   and each ROC has its own payload: data of another wafer (physics data, all wafers read in one pass over the ntuple),
+#   or another seed (choice of MC events), and optionally its own delay or LinkResetROCD BXs
+# ROCs with the same readout schedule (delay, LinkResets) are filled together, vectorized over all their links,
+#   so the cost grows with the number of links, not with the number of runs
+# outputs: one file per ECON-D (with the links of its ROCs), or one combined file with all ROCs,
+#   with the columns ERX_0,...,ERX_(12*ROCs-1) in the order of the ROCs (listed in the description)
+#
+# ROCs are given in a JSON file, with the settings that differ from the command line:
+#   [{"name": "roc0", "econd": 0, "waferCoordinates": "0,1,5,3,1"},
+#    {"name": "roc1", "econd": 0, "waferCoordinates": "0,1,5,4,2", "delay": 8},
+#    {"name": "roc2", "econd": 1, "waferCoordinates": "0,1,5,4,3", "linkresetrocdBX": "2000"}]
+#   python3 multiROC.py --system rocs.json -N 10692 --bcr --sequence random --physics-data
+# or as a number of ROCs (seeds --seed, --seed+1, ...) and ROCs per ECON-D:
+#   python3 multiROC.py --rocs 6 --rocs-per-econd 3 -N 10692 --bcr --sequence random --physics-data
+#
+###############################################
+
+# settings that can be different for each ROC
+ROC_FIELDS = ['waferCoordinates','seed','delay','linkresetrocdBX','mcEvtNumbers','fname','mcEntryStart']
+
+def make_rocs(num_rocs,rocs_per_econd,seed=6):
+    """ROCs with consecutive seeds, rocs_per_econd in each ECON-D"""
+    return [{'name': f'roc{i}', 'econd': i//rocs_per_econd, 'seed': seed+i} for i in range(num_rocs)]
+
+def roc_arguments(args,roc):
+    """arguments of one ROC: the shared arguments, with the settings of the ROC"""
+    unknown = [k for k in roc if not k in ROC_FIELDS+['name','econd']]
+    if len(unknown)>0:
+        raise ValueError(f"Settings {unknown} of ROC {roc.get('name','')} can not be changed for a single ROC (only {ROC_FIELDS})")
+    roc_args = argparse.Namespace(**vars(args))
+    for k in ROC_FIELDS:
+        if k in roc:
+            setattr(roc_args,k,type(getattr(args,k))(roc[k]) if getattr(args,k) is not None else roc[k])
+    return roc_args
+
+def schedule_key(args):
+    """ROCs with the same key have the same readout schedule, header and CM words"""
+    key = (args.delay,args.linkresetrocdBX)
+    if args.rng=='philox' or args.hamErrRate>0:
+        key += (args.seed,)
+    return key
+
+def roc_fast_commands(fast_commands,args,roc_args):
+    """fast commands seen by a ROC: the shared ones, with the LinkResetROCDs of the ROC (in BXs without another fast command)"""
+    if roc_args.linkresetrocdBX==args.linkresetrocdBX:
+        return fast_commands
+    roc_commands = sim.FastCommandSchedule(len(fast_commands))
+    roc_commands.codes[:] = fast_commands.codes
+    roc_commands.set(fast_commands.positions(sim.CMD_LINKRESETROCD),sim.CMD_IDLE)
+    if roc_args.linkresetrocdBX!='':
+        bxs = np.array([int(bx) for bx in roc_args.linkresetrocdBX.split(',')],dtype=np.int64)
+        bxs = bxs[bxs<len(roc_commands)]
+        roc_commands.set(bxs[roc_commands.codes[bxs]==sim.FASTCMD_CODES[sim.CMD_IDLE]],sim.CMD_LINKRESETROCD)
+    return roc_commands
+
+def preload_mc_data(rocs_args,num_events):
+    """load the MC data of all wafers with one pass over each ntuple (instead of one per ROC)"""
+    import pandas as pd
+    from getElinkInputDataFromMC import loadMCDataWafers,linksToArray
+
+    wafers = {}
+    for roc_args in rocs_args:
+        if not roc_args.physicsdata:
+            continue
+        maxEvents = num_events if roc_args.mcMaxEvents==-1 else roc_args.mcMaxEvents
+        wafer = sim.wafer_coordinates(roc_args)
+        if not (roc_args.fname,wafer,roc_args.mcEntryStart,maxEvents) in sim._mc_data:
+            wafers.setdefault((roc_args.fname,roc_args.mcEntryStart,maxEvents,roc_args.mcCacheDir,roc_args.mcCacheSize),set()).add(wafer)
+
+    for (fname,entryStart,maxEvents,cacheDir,cacheSize),selected in wafers.items():
+        from mcDataCache import makeCache
+        cache = makeCache(cacheDir,cacheSize)
+        waferData = loadMCDataWafers(fName=fname, wafers=sorted(selected), dataType='int', entryStart=entryStart, maxEvents=maxEvents, cache=cache)
+        for wafer,dfLinks in waferData.items():
+            entries,payload,present = linksToArray(dfLinks)
+            sim._mc_data[(fname,wafer,entryStart,maxEvents)] = payload, pd.Index(entries, name='entry')
+
+def system_description(args,num_bx,num_packets,L1a_name,rocs,channels):
+    """description of simulateInputECOND.py, with the ROC of each group of links"""
+    lines = sim.eportRX_description(args,num_bx,num_packets,L1a_name,channels).rstrip('\n').split('\n')
+    for i,roc in enumerate(rocs):
+        settings = ', '.join(f'{k}={roc[k]}' for k in ROC_FIELDS if k in roc)
+        lines.insert(-1,f"# ERX_{i*sim.NELINKS}-ERX_{(i+1)*sim.NELINKS-1}: ROC {roc['name']} (ECON-D {roc['econd']}){': '+settings if settings else ''}")
+    return '\n'.join(lines)+'\n'
+
+def make_system_input(args,rocs,output='econd'):
+    """
+    Patterns of several ROCs driven by the same fast commands
+    args: arguments of simulateInputECOND.py (shared settings and fast commands)
+    rocs: list of dicts with the name, ECON-D and settings (ROC_FIELDS) of each ROC
+    output: one file per ECON-D ('econd'), or one file with all ROCs ('combined')
+    returns the names of the files written
+    """
+    if args.bufferDepth>0 and args.bufferFull=='busy':
+        raise ValueError('busy throttling of L1As (--bufferFull busy) is not supported with several ROCs sharing the fast commands')
+    for i,roc in enumerate(rocs):
+        roc.setdefault('name',f'roc{i}')
+        roc.setdefault('econd',0)
+
+    metrics = RunMetrics()
+    with metrics.stage('fast_commands'):
+        fast_commands,L1a_name,num_events = sim.build_fast_commands(args)
+    sim.fast_command_metrics(metrics,fast_commands,args.bx_start)
+
+    rocs_args = [roc_arguments(args,roc) for roc in rocs]
+    with metrics.stage('dataset'):
+        if args.physicsdata:
+            preload_mc_data(rocs_args,num_events)
+        datasets = [sim.make_dataset(roc_args,num_events) for roc_args in rocs_args]
+
+    # ROCs with the same readout schedule
+    groups = {}
+    for i,roc_args in enumerate(rocs_args):
+        groups.setdefault(schedule_key(roc_args),[]).append(i)
+
+    schedules = []
+    with metrics.stage('schedule'):
+        for indices in groups.values():
+            group_args = rocs_args[indices[0]]
+            group_commands = roc_fast_commands(fast_commands,args,group_args)
+            group_metrics = RunMetrics()
+            reads,num_bx,counters = sim.schedule_readout(group_commands,group_args,group_metrics)
+            packets = np.concatenate([datasets[i] for i in indices],axis=1)
+            schedules.append({'rocs':indices, 'args':group_args, 'fast_commands':group_commands, 'reads':reads, 'packets':packets,
+                              'num_bx':num_bx, 'num_packets':counters['event'], 'metrics':group_metrics})
+    num_bx = max(s['num_bx'] for s in schedules)
+    num_rows = max(0,num_bx-args.bx_start)
+
+    # ROCs of each output file, and their columns in the eRx words of all ROCs
+    base_name = sim.eportRX_file_name(args,L1a_name)
+    if output=='combined':
+        outputs = {f'{base_name}_{len(rocs)}ROCs': list(range(len(rocs)))}
+    else:
+        outputs = {}
+        for i,roc in enumerate(rocs):
+            outputs.setdefault(f"{base_name}_ECOND{roc['econd']}",[]).append(i)
+    def columns(indices):
+        return (np.asarray(indices)[:,None]*sim.NELINKS + np.arange(sim.NELINKS)).reshape(-1)
+
+    writers = []
+    for name,indices in outputs.items():
+        channels = ['RESET_B','SOFT_RESET_B'] + ['ERX_%i'%i for i in range(len(indices)*sim.NELINKS)] + ['FAST_CMD']
+        num_packets = max(s['num_packets'] for s in schedules if len(set(s['rocs']) & set(indices))>0)
+        description = system_description(args,num_bx,num_packets,L1a_name,[rocs[i] for i in indices],channels)
+        if args.outputFormat=='binary':
+            meta = {'N':args.N, 'bx_start':args.bx_start, 'delay':args.delay, 'bcr':args.bcr, 'rocs':[rocs[i] for i in indices]}
+            writer = BinaryPatternWriter(f'rocData/{name}.bin',num_rows,description,sim.FASTCMD_LIST,channels,meta)
+        else:
+            writer = CSVPatternWriter(f'rocData/{name}.csv',description,sim.FASTCMD_LIST)
+        writers.append((writer,columns(indices)))
+
+    # fill the blocks of each schedule, for all its ROCs at once
+    blocks = [sim.iter_eportRX_blocks(s['reads'],s['packets'],s['fast_commands'],num_bx,s['args'],args.block_size,metrics=metrics) for s in schedules]
+    group_columns = [columns(s['rocs']) for s in schedules]
+    for group_blocks in zip(*blocks):
+        clk = group_blocks[0][0]
+        words = np.empty((len(clk),len(rocs)*sim.NELINKS),dtype=np.uint32)
+        for (_,data,_),cols in zip(group_blocks,group_columns):
+            words[:,cols] = data
+        codes = sim.fast_command_stream(fast_commands,clk,num_rows,args)
+        with metrics.stage('write'):
+            for writer,cols in writers:
+                writer.write_block(clk,words[:,cols],codes)
+    for writer,cols in writers:
+        writer.close()
+
+    file_names = [writer.file_name for writer,cols in writers]
+    metrics.write(metrics_file_name(f'rocData/{base_name}.csv'),
+                  patterns=file_names, rocs=rocs, args=vars(args),
+                  schedules=[{'rocs':[rocs[i]['name'] for i in s['rocs']], **s['metrics'].to_dict()} for s in schedules])
+    for name in file_names:
+        log.info(f'Pattern written to {name}')
+    return file_names
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Emulate several ROCs (and ECON-Ds) driven by the same fast commands; other arguments are the ones of simulateInputECOND.py', allow_abbrev=False)
+    parser.add_argument('--system', type=str, default=None, dest="system", help="JSON file with the list of ROCs (name, econd, and settings that differ from the command line)")
+    parser.add_argument('--rocs', type=int, default=2, dest="rocs", help="Number of ROCs, with seeds --seed, --seed+1, ... (without a JSON file, default: 2)")
+    parser.add_argument('--rocs-per-econd', type=int, default=1, dest="rocs_per_econd", help="Number of ROCs read out by each ECON-D (without a JSON file, default: 1)")
+    parser.add_argument('--output', type=str, default='econd', choices=['econd','combined'], dest="output", help="One file per ECON-D, or one file with all ROCs (default: econd)")
+    system_args,remaining = parser.parse_known_args()
+
+    args = sim.make_parser().parse_args(remaining)
+    args = sim.readConfigFromFile(args)
+    setup_logging(args.logLevel)
+
+    if system_args.system:
+        with open(system_args.system) as _file:
+            rocs = json.load(_file)
+    else:
+        rocs = make_rocs(system_args.rocs,system_args.rocs_per_econd,args.seed)
+
+    make_system_input(args,rocs,system_args.output)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from rocMetrics import log
+
+###############################################
+# Cache of the generated patterns, to skip regenerating unchanged ones
+###############################################
+#
+# each pattern is stored as <key>.csv/.bin, with a manifest entry <key>.json, keyed by a hash of:
+#   - the arguments of the run (after the --config file), except the ones that do not change the output (engine, jobs, ...)
+#   - the version of the emulator (hash of its source files)
+#   - the input data of physics runs (MC ntuple identity and geometry files)
+# when the key matches, the stored pattern is copied (or hard linked) to rocData instead of running the emulator
+# entries can be listed and pruned with
+#   python3 outputCache.py <cacheDir> list
+#   python3 outputCache.py <cacheDir> prune [--stale] [--max-age DAYS] [--max-size MB]
+#
+###############################################
+
+# arguments that only change how the pattern is generated, not its content
+EXCLUDED_ARGS = ['config','engine','stream','block_size','jobs','shard_orbits','mcCacheDir','mcCacheSize','outputCache','outputCacheMode','logLevel']
+
+EMULATOR_FILES = ['simulateInputECOND.py','rocCRC.py','rocRNG.py','rocBuffer.py','l1aGenerator.py','patternIO.py','getElinkInputDataFromMC.py']
+
+def fileHash(fName, algorithm='sha1'):
+    _hash = hashlib.new(algorithm)
+    with open(fName,'rb') as _file:
+        for chunk in iter(lambda: _file.read(1<<20), b''):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+def emulator_version():
+    """hash of the source files of the emulator"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    _hash = hashlib.sha1()
+    for f in EMULATOR_FILES:
+        _hash.update(f.encode())
+        _hash.update(fileHash(os.path.join(directory,f)).encode())
+    return _hash.hexdigest()
+
+def input_identity(args):
+    """identity of the input data of the run (MC ntuple and geometry files, for physics data)"""
+    if not args.physicsdata:
+        return None
+    from mcDataCache import ntupleIdentity,GEOMETRY_FILES
+    return {'ntuple': ntupleIdentity(args.fname),
+            'geometry': [fileHash(f) for f in GEOMETRY_FILES]}
+
+def effective_args(args):
+    return {k:v for k,v in sorted(vars(args).items()) if not k in EXCLUDED_ARGS}
+
+class OutputCache:
+    """
+    cacheDir: directory of the cached patterns and their manifest entries
+    mode: restore patterns by 'copy', or by hard 'link' (falls back to a copy across file systems)
+    """
+    def __init__(self, cacheDir, mode='copy'):
+        self.cacheDir = cacheDir
+        self.mode = mode
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def key(self, args):
+        info = {'args': effective_args(args),
+                'version': emulator_version(),
+                'inputs': input_identity(args),
+                }
+        return hashlib.sha1(json.dumps(info,sort_keys=True,default=str).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cacheDir, f'{key}.json')
+
+    def read_entry(self, key):
+        try:
+            with open(self.entry_path(key)) as _file:
+                return json.load(_file)
+        except (OSError,ValueError):
+            return None
+
+    def write_entry(self, key, entry):
+        fd,tmpName = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        with os.fdopen(fd,'w') as _file:
+            json.dump(entry,_file,indent=1,default=str)
+        os.replace(tmpName, self.entry_path(key))
+
+    def restore(self, key):
+        """
+        copy (or link) the cached pattern to its output file
+        returns the output file name, or None if not in the cache (or the cached file was modified)
+        """
+        entry = self.read_entry(key)
+        if entry is None:
+            return None
+        artifact = os.path.join(self.cacheDir, entry['artifact'])
+        if not os.path.exists(artifact) or os.path.getsize(artifact)!=entry['size'] or fileHash(artifact,'sha256')!=entry['sha256']:
+            log.warning(f'Cached pattern {artifact} is missing or was modified, regenerating it')
+            return None
+
+        output = entry['file']
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        if not (os.path.exists(output) and os.path.samefile(output,artifact)):
+            if os.path.exists(output):
+                os.remove(output)
+            if self.mode=='link':
+                try:
+                    os.link(artifact, output)
+                except OSError:
+                    shutil.copyfile(artifact, output)
+            else:
+                shutil.copyfile(artifact, output)
+
+        entry['last_used'] = time.time()
+        self.write_entry(key, entry)
+        return output
+
+    def store(self, key, file_name, args):
+        """add the pattern just generated in file_name to the cache"""
+        artifact = key + os.path.splitext(file_name)[1]
+        shutil.copyfile(file_name, os.path.join(self.cacheDir, artifact))
+        self.write_entry(key, {'file': file_name,
+                               'artifact': artifact,
+                               'size': os.path.getsize(file_name),
+                               'sha256': fileHash(file_name,'sha256'),
+                               'version': emulator_version(),
+                               'inputs': input_identity(args),
+                               'args': effective_args(args),
+                               'created': time.time(),
+                               'last_used': time.time(),
+                               })
+
+    def entries(self):
+        """manifest: dict of all entries in the cache, by key"""
+        entries = {}
+        for f in sorted(os.listdir(self.cacheDir)):
+            if f.endswith('.json'):
+                entry = self.read_entry(f[:-5])
+                if entry is not None:
+                    entries[f[:-5]] = entry
+        return entries
+
+    def is_stale(self, entry, version=None):
+        """entry made with another version of the emulator, or with input files that changed"""
+        if entry['version']!=(version or emulator_version()):
+            return True
+        if entry['inputs'] is not None:
+            from mcDataCache import ntupleIdentity,GEOMETRY_FILES
+            try:
+                inputs = {'ntuple': ntupleIdentity(entry['inputs']['ntuple'][0]),
+                          'geometry': [fileHash(f) for f in GEOMETRY_FILES]}
+            except OSError:
+                return True
+            if json.loads(json.dumps(inputs))!=entry['inputs']:
+                return True
+        return False
+
+    def remove(self, key):
+        entry = self.read_entry(key)
+        if entry is not None and os.path.exists(os.path.join(self.cacheDir,entry['artifact'])):
+            os.remove(os.path.join(self.cacheDir,entry['artifact']))
+        if os.path.exists(self.entry_path(key)):
+            os.remove(self.entry_path(key))
+
+    def prune(self, stale=False, maxAge=None, maxSizeMB=None):
+        """
+        remove entries that are stale, not used in maxAge days, and then the least recently used ones above maxSizeMB
+          (and files without a manifest entry)
+        returns the keys removed
+        """
+        entries = self.entries()
+        version = emulator_version()
+        removed = []
+        for key,entry in entries.items():
+            if (stale and self.is_stale(entry,version)) or (maxAge is not None and time.time()-entry['last_used']>maxAge*86400):
+                removed.append(key)
+        if maxSizeMB is not None:
+            kept = sorted([k for k in entries if not k in removed], key=lambda k: entries[k]['last_used'])
+            totalSize = sum(entries[k]['size'] for k in kept)
+            for key in kept:
+                if totalSize<=maxSizeMB*1024*1024:
+                    break
+                totalSize -= entries[key]['size']
+                removed.append(key)
+        for key in removed:
+            self.remove(key)
+
+        # patterns without an entry
+        artifacts = set(entries[k]['artifact'] for k in entries if not k in removed)
+        for f in os.listdir(self.cacheDir):
+            if not f.endswith('.json') and not f in artifacts:
+                os.remove(os.path.join(self.cacheDir,f))
+        return removed
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='List or prune the cache of generated patterns')
+    parser.add_argument('cacheDir', type=str, help="Directory of the cache (--outputCache of simulateInputECOND.py)")
+    parser.add_argument('command', type=str, choices=['list','prune'], help="list the manifest, or prune entries")
+    parser.add_argument('--stale', action='store_true', default=False, dest="stale", help="Remove entries made by another version of the emulator, or with changed input files")
+    parser.add_argument('--max-age', type=float, default=None, dest="maxAge", help="Remove entries not used in this number of days")
+    parser.add_argument('--max-size', type=float, default=None, dest="maxSize", help="Remove least recently used entries above this size (MB)")
+    args = parser.parse_args()
+
+    cache = OutputCache(args.cacheDir)
+    if args.command=='list':
+        version = emulator_version()
+        for key,entry in cache.entries().items():
+            print(f"{key}  {entry['size']/1024/1024:8.2f} MB  {time.strftime('%Y-%m-%d %H:%M',time.localtime(entry['last_used']))}  {'stale' if cache.is_stale(entry,version) else 'valid'}  {entry['file']}")
+    else:
+        removed = cache.prune(args.stale,args.maxAge,args.maxSize)
+        print(f'Removed {len(removed)} entries')
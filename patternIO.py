@@ -0,0 +1,445 @@
+import numpy as np
+import json
+import os
+
+###############################################
+# Reading/writing ROC pattern files
+###############################################
+#
+# CSV layout (rocData/*.csv):
+#   comment lines (#) with the description of the pattern, and the list of columns
+#   CLK_N,RESET_B,SOFT_RESET_B,ERX_0,...,ERX_11,FAST_CMD
+#   with the eRx words as 8 character (upper case) hex strings, and no newline after the last BX
+#
+# binary layout (rocData/*.bin), readable with np.memmap without copying:
+#   8 bytes magic (ROCPAT01) + 4 bytes header length (little-endian uint32) + JSON header
+#   eRx words: (num_rows, links) little-endian uint32, at header['erx_offset'] (64 byte aligned)
+#   fast commands: (num_rows,) uint8 code, at header['fast_cmd_offset'], with names in header['fast_commands']
+#   the header also has the CSV description, the first CLK_N (bx_start) and the settings of the run (N, delay, bcr)
+#
+###############################################
+
+BINARY_MAGIC = b'ROCPAT01'
+BINARY_ALIGN = 64
+
+def open_output(file_name,mode='w'):
+    """
+    Open an output file, removing it first if it exists
+      so that files hard linked to it (e.g. in the output cache) are not overwritten
+    """
+    if os.path.lexists(file_name):
+        os.remove(file_name)
+    return open(file_name,mode)
+
+def to_hex(words):
+    """
+    Format an array of 32 bit words as 8 character (upper case) hex strings
+      formats each distinct word only once
+    """
+    values,inverse = np.unique(np.asarray(words,dtype=np.uint32),return_inverse=True)
+    return np.array(['{0:08X}'.format(v) for v in values],dtype=object)[inverse.reshape(-1)]
+
+# ASCII characters of each byte value as 2 hex digits, as a little-endian uint16 (first digit in the low byte)
+HEX_BYTES = {upper: (np.frombuffer(digits,dtype=np.uint8)[np.arange(256)>>4].astype(np.uint16) |
+                     (np.frombuffer(digits,dtype=np.uint8)[np.arange(256) & 0xf].astype(np.uint16)<<8))
+             for upper,digits in [(True,b'0123456789ABCDEF'),(False,b'0123456789abcdef')]}
+
+def format_words(words,base=16,upper=True):
+    """
+    Render 32 bit words as fixed width strings, hex (8 characters) or binary (32 characters)
+      vectorized: hex digits are looked up two at a time from the big-endian bytes of the words,
+      binary digits one at a time from each bit, and the result viewed as a bytes ('S') array
+    """
+    words = np.asarray(words,dtype=np.uint32)
+    if base==16:
+        chars = HEX_BYTES[upper][np.ascontiguousarray(words.reshape(-1),dtype='>u4').view(np.uint8)]
+        return chars.view('S8').reshape(words.shape)
+    if base!=2:
+        raise ValueError(f'Unsupported base {base}')
+
+    shifts = np.arange(31,-1,-1,dtype=np.uint32)
+    chars = (((words[...,None]>>shifts) & 1) + ord('0')).astype(np.uint8)
+    return np.ascontiguousarray(chars).view('S32').reshape(words.shape)
+
+def format_integers(values):
+    """
+    ASCII digits of non-negative integers, right aligned in a (n, width) uint8 matrix (0 before the first digit)
+    returns the matrix and the number of digits of each integer
+    """
+    values = np.asarray(values,dtype=np.int64).reshape(-1)
+    if np.any(values<0):
+        raise ValueError('Only non-negative integers can be formatted')
+    width = len(str(values.max())) if len(values)>0 else 1
+    powers = 10**np.arange(width-1,-1,-1,dtype=np.int64)
+    num_digits = 1 + (values[:,None]>=powers[None,:-1]).sum(axis=1)
+    digits = ((values[:,None]//powers)%10 + ord('0')).astype(np.uint8)
+    digits[np.arange(width)[None,:]<width-num_digits[:,None]] = 0
+    return digits,num_digits
+
+def format_csv_block(clk,words,fast_commands,hard_resets=None,soft_resets=None,fast_command_names=None):
+    """
+    CSV rows (CLK_N,RESET_B,SOFT_RESET_B,ERX_0,...,ERX_11,FAST_CMD) of a block of BXs, as bytes without a final newline
+      same arguments as CSVPatternWriter.write_block
+    each row is rendered into a preallocated (BX, longest row) byte matrix, one column range per field
+      (the words through a lookup on their bytes), and the padding of the shorter fields is dropped at the end
+    """
+    n = len(clk)
+    if hard_resets is None: hard_resets = np.ones(n,dtype=int)
+    if soft_resets is None: soft_resets = np.ones(n,dtype=int)
+    words = np.asarray(words,dtype=np.uint32)
+
+    # fast command names as padded byte strings, through their codes
+    if np.issubdtype(np.asarray(fast_commands).dtype,np.integer):
+        codes = np.asarray(fast_commands)
+    else:
+        fast_command_names,codes = np.unique(np.asarray(fast_commands,dtype=str),return_inverse=True)
+        codes = codes.reshape(-1)
+    names = np.array([str(name).encode() for name in fast_command_names])
+    name_chars = np.frombuffer(names.tobytes(),dtype=np.uint8).reshape(len(names),-1)[codes]
+    name_length = np.char.str_len(names)[codes]
+
+    fields = [format_integers(clk),format_integers(hard_resets),format_integers(soft_resets)]
+    widths = [f[0].shape[1] for f in fields]
+    erx_width = 9*words.shape[1]
+    row_width = sum(widths)+3+erx_width+name_chars.shape[1]+1
+    rows = np.zeros((n,row_width),dtype=np.uint8)
+
+    column = 0
+    for digits,width in zip([f[0] for f in fields],widths):
+        rows[:,column:column+width] = digits
+        rows[:,column+width] = ord(',')
+        column += width+1
+    erx = rows[:,column:column+erx_width].reshape(n,words.shape[1],9)
+    erx[:,:,:8] = format_words(words).view(np.uint8).reshape(n,words.shape[1],8)
+    erx[:,:,8] = ord(',')
+    column += erx_width
+    rows[:,column:column+name_chars.shape[1]] = name_chars
+    rows[np.arange(n),column+name_length] = ord('\n')
+    if n>0:
+        rows[-1,column+name_length[-1]] = 0
+
+    # padding is 0: before the digits of the integers, after the fast command name and the newline
+    return rows[rows!=0].tobytes()
+
+class CSVPatternWriter:
+    """
+    Write a pattern file one block of BXs at a time, as the blocks are generated
+      so the full pattern is never held in memory
+    fast_command_names: names of the fast command codes, when blocks are given with codes instead of names
+    """
+    def __init__(self,file_name,description,fast_command_names=None):
+        self.file_name = file_name
+        self.fast_command_names = fast_command_names
+        self.output_file = open_output(file_name,'wb')
+        self.output_file.write(description.encode())
+        self.num_rows = 0
+
+    def write_block(self,clk,words,fast_commands,hard_resets=None,soft_resets=None):
+        """
+        clk: CLK_N of each BX in the block
+        words: (BX, eRx links) array of 32 bit words
+        fast_commands: fast command name (or code) for each BX
+        hard_resets/soft_resets: RESET_B/SOFT_RESET_B for each BX (default 1)
+        """
+        if len(clk)==0: return
+        self.write_rows(format_csv_block(clk,words,fast_commands,hard_resets,soft_resets,self.fast_command_names),len(clk))
+
+    def write_rows(self,rows,num_rows):
+        """write num_rows already formatted rows (bytes from format_csv_block)"""
+        if num_rows==0: return
+        # newline before each block after the first, so that the file does not end with one
+        if self.num_rows>0:
+            self.output_file.write(b'\n')
+        self.output_file.write(rows)
+        self.num_rows += num_rows
+
+    def close(self):
+        self.output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def encode_fast_commands(fast_commands,fast_command_names):
+    """Convert fast command names into uint8 codes (index in fast_command_names)"""
+    names,inverse = np.unique(np.asarray(fast_commands,dtype=str),return_inverse=True)
+    codes = np.array([fast_command_names.index(name) for name in names],dtype=np.uint8)
+    return codes[inverse.reshape(-1)]
+
+class BinaryPatternWriter:
+    """
+    Write a binary pattern file one block of BXs at a time
+      the file is preallocated for num_rows BXs, and blocks are written in order through a memmap
+    meta: settings of the run stored in the header (e.g. N, bx_start, delay, bcr)
+    """
+    def __init__(self,file_name,num_rows,description,fast_command_names,channels,meta=None):
+        self.file_name = file_name
+        self.num_rows = num_rows = int(num_rows)
+        self.fast_command_names = [str(name) for name in fast_command_names]
+        erx_channels = [ch for ch in channels if ch.startswith('ERX_')]
+
+        header = {'version': 1,
+                  'num_rows': num_rows,
+                  'channels': list(channels),
+                  'links': len(erx_channels),
+                  'fast_commands': self.fast_command_names,
+                  'description': description,
+                  }
+        header.update(meta or {})
+        header.setdefault('bx_start',0)
+
+        # offsets depend on the header length, so leave room for them before padding
+        header['erx_offset'] = 0
+        header['fast_cmd_offset'] = 0
+        header_length = len(json.dumps(header).encode()) + 40
+        header['erx_offset'] = -(-(len(BINARY_MAGIC)+4+header_length)//BINARY_ALIGN)*BINARY_ALIGN
+        header['fast_cmd_offset'] = header['erx_offset'] + num_rows*header['links']*4
+        header_bytes = json.dumps(header).encode().ljust(header['erx_offset']-len(BINARY_MAGIC)-4)
+        self.header = header
+
+        with open_output(file_name,'wb') as output_file:
+            output_file.write(BINARY_MAGIC)
+            output_file.write(np.uint32(len(header_bytes)).astype('<u4').tobytes())
+            output_file.write(header_bytes)
+            output_file.truncate(header['fast_cmd_offset']+num_rows)
+
+        self.words = None
+        self.codes = None
+        if num_rows>0:
+            self.words = np.memmap(file_name,dtype='<u4',mode='r+',offset=header['erx_offset'],shape=(num_rows,header['links']))
+            self.codes = np.memmap(file_name,dtype=np.uint8,mode='r+',offset=header['fast_cmd_offset'],shape=(num_rows,))
+        self.row = 0
+
+    def write_block(self,clk,words,fast_commands,hard_resets=None,soft_resets=None):
+        """
+        same arguments as CSVPatternWriter.write_block (resets are always 1 in binary files)
+          fast_commands can also be given directly as codes (index in fast_command_names)
+        """
+        n = len(clk)
+        if n==0: return
+        self.words[self.row:self.row+n] = words
+        if np.issubdtype(np.asarray(fast_commands).dtype,np.integer):
+            self.codes[self.row:self.row+n] = fast_commands
+        else:
+            self.codes[self.row:self.row+n] = encode_fast_commands(fast_commands,self.fast_command_names)
+        self.row += n
+
+    def close(self):
+        if self.words is not None:
+            self.words.flush()
+            self.codes.flush()
+        self.words = None
+        self.codes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def read_binary_pattern(file_name,mode='r'):
+    """
+    Open a binary pattern file
+    returns the header, and memmaps of the eRx words (num_rows, links) and fast command codes (num_rows,)
+    """
+    with open(file_name,'rb') as input_file:
+        magic = input_file.read(len(BINARY_MAGIC))
+        if magic!=BINARY_MAGIC:
+            raise ValueError(f'{file_name} is not a binary pattern file')
+        header_length = int(np.frombuffer(input_file.read(4),dtype='<u4')[0])
+        header = json.loads(input_file.read(header_length).decode())
+
+    num_rows = header['num_rows']
+    if num_rows==0:
+        return header,np.zeros((0,header['links']),dtype='<u4'),np.zeros(0,dtype=np.uint8)
+
+    words = np.memmap(file_name,dtype='<u4',mode=mode,offset=header['erx_offset'],shape=(num_rows,header['links']))
+    codes = np.memmap(file_name,dtype=np.uint8,mode=mode,offset=header['fast_cmd_offset'],shape=(num_rows,))
+    return header,words,codes
+
+# value of each ASCII character as a hex digit (0xff: not a hex digit)
+HEX_DIGITS = np.full(256,0xff,dtype=np.uint8)
+for i,c in enumerate(b'0123456789ABCDEF'):
+    HEX_DIGITS[c] = i
+    HEX_DIGITS[ord(chr(c).lower())] = i
+
+# value of each pair of hex digits (indexed by the pair of ASCII characters as a little-endian uint16) (0xffff: not hex digits)
+HEX_PAIRS = np.full((256,256),0xffff,dtype=np.uint16)
+_digits = np.flatnonzero(HEX_DIGITS!=0xff)
+HEX_PAIRS[_digits[:,None],_digits[None,:]] = (HEX_DIGITS[_digits][None,:].astype(np.uint16)<<4) | HEX_DIGITS[_digits][:,None]
+HEX_PAIRS = HEX_PAIRS.reshape(-1)
+
+def _read_lines(input_file,block_size=1<<25):
+    """blocks of complete lines (about block_size bytes) of the rest of the file, each ending with a newline"""
+    rest = b''
+    while True:
+        chunk = input_file.read(block_size)
+        if not chunk:
+            break
+        chunk = rest+chunk
+        cut = chunk.rfind(b'\n')+1
+        if cut>0:
+            yield chunk[:cut]
+        rest = chunk[cut:]
+    if rest.strip():
+        yield rest+b'\n'
+
+def _parse_csv_block(block,num_fields,erx_fields,max_width=64,has_clk=True):
+    """
+    Parse a block of CSV lines with num_fields fields each, directly on the bytes of the block
+      fields are taken as fixed width windows of the buffer (numpy views), so there is no loop over the lines
+      returns CLK_N (BX,) (None without a CLK_N column), resets (BX, 2), eRx words (BX, links), fast command names (BX,)
+    """
+    # padded, so that a window can start at any character
+    buf = np.frombuffer(block+bytes(max_width),dtype=np.uint8)
+    ends = np.flatnonzero(buf==ord('\n'))
+    commas = np.flatnonzero(buf==ord(','))
+    num_lines = len(ends)
+    if len(commas)!=num_lines*(num_fields-1):
+        raise ValueError(f'Expected {num_fields} fields in each line')
+    commas = commas.reshape(num_lines,num_fields-1)
+    if np.any(commas[1:,0]<ends[:-1]) or np.any(commas[:,-1]>ends):
+        raise ValueError(f'Expected {num_fields} fields in each line')
+    ends = ends - (buf[np.maximum(ends-1,0)]==ord('\r'))
+
+    def field(i):
+        # first character and width of field i in each line
+        start = np.concatenate([[0],ends[:-1]+1+(buf[ends[:-1]]==ord('\r'))]) if i==0 else commas[:,i-1]+1
+        end = ends if i==num_fields-1 else commas[:,i]
+        return start,end-start
+
+    def chars(i):
+        # characters of field i, padded with 0 up to the longest one
+        start,width = field(i)
+        max_field = int(width.max())
+        if max_field>max_width:
+            raise ValueError(f'Field longer than {max_width} characters')
+        window = np.lib.stride_tricks.sliding_window_view(buf,max_field)[start]
+        return np.where(np.arange(max_field)<width[:,None],window,0).astype(np.uint8)
+
+    def integers(i):
+        digits = chars(i)
+        values = np.zeros(num_lines,dtype=np.int64)
+        for j in range(digits.shape[1]):
+            values = np.where(digits[:,j]>0,values*10+digits[:,j].astype(np.int64)-ord('0'),values)
+        return values
+
+    first = 1 if has_clk else 0
+    clk = integers(0) if has_clk else None
+    resets = np.stack([integers(first),integers(first+1)],axis=1)
+
+    # eRx words: consecutive fields of 8 hex characters, taken in one window
+    #   (bytes from the first eRx field up to the comma after the last one)
+    nlinks = len(erx_fields)
+    if erx_fields!=list(range(erx_fields[0],erx_fields[0]+nlinks)) or np.any(np.diff(commas[:,erx_fields[0]-1:erx_fields[-1]+1])!=9):
+        raise ValueError('Expected 8 hex characters in each eRx word')
+    window = np.lib.stride_tricks.sliding_window_view(buf,9*nlinks)[field(erx_fields[0])[0]]
+    # pairs of hex digits are the bytes of the big-endian words
+    pairs = HEX_PAIRS[np.ascontiguousarray(window.reshape(num_lines,nlinks,9)[:,:,:8]).view('<u2')]
+    if np.any(pairs==0xffff):
+        raise ValueError('Invalid hex character in eRx word')
+    words = pairs.astype(np.uint8).view('>u4')[:,:,0].astype(np.uint32)
+
+    # fast commands: fixed width byte strings, decoded once for each distinct name
+    names = chars(num_fields-1)
+    names = names.view(f'S{names.shape[1]}').reshape(-1)
+    fast_commands = np.empty(num_lines,dtype=object)
+    todo = np.ones(num_lines,dtype=bool)
+    while todo.any():
+        name = names[np.argmax(todo)]
+        is_name = names==name
+        fast_commands[is_name] = name.decode()
+        todo &= ~is_name
+    return clk,resets,words,fast_commands
+
+# columns of the patterns written by the first versions of the emulator, without CLK_N
+#   with comment lines between the sections of the pattern (# reset, # N fast commands, # end)
+LEGACY_COLUMNS = '# Hard reset,Soft reset,'
+
+def read_csv_pattern(file_name):
+    """
+    Read a CSV pattern file
+    returns the description (comment lines), the channels, and arrays of CLK_N, resets (BX, 2), eRx words (BX, links) and fast command names
+      the lines are parsed in blocks, with numpy operations on the bytes of each block (a few seconds for 10^7 BXs)
+    patterns in the legacy layout (LEGACY_COLUMNS) are read with the same channel names, and CLK_N counting the rows from 0
+    """
+    description = ''
+    with open(file_name,'rb') as input_file:
+        offset = 0
+        for line in input_file:
+            if not line.startswith(b'#'): break
+            description += line.decode()
+            offset += len(line)
+        legacy = [line for line in description.split('\n') if line.startswith(LEGACY_COLUMNS)]
+        if legacy:
+            columns = legacy[0][2:].split(',')
+            channels = ['RESET_B','SOFT_RESET_B'] + ['ERX_%i'%i for i in range(len(columns)-3)] + ['FAST_CMD']
+            erx_fields = list(range(2,len(channels)-1))
+        else:
+            channels = description.strip().split('\n')[-1][2:].split(',')[1:]
+            if channels[:2]!=['RESET_B','SOFT_RESET_B'] or channels[-1]!='FAST_CMD':
+                raise ValueError(f'Unexpected columns in {file_name}: {channels}')
+            erx_fields = [i+1 for i,ch in enumerate(channels) if ch.startswith('ERX_')]
+
+        input_file.seek(offset)
+        if legacy:
+            # small files: the comment lines between the sections are removed line by line
+            blocks = [_parse_csv_block(b''.join(line for line in block.splitlines(keepends=True) if not line.startswith(b'#')),len(channels),erx_fields,has_clk=False)
+                      for block in _read_lines(input_file)]
+        else:
+            blocks = [_parse_csv_block(block,len(channels)+1,erx_fields) for block in _read_lines(input_file)]
+
+    if len(blocks)==0:
+        return description,channels,np.zeros(0,dtype=np.int64),np.zeros((0,2),dtype=np.int64),np.zeros((0,len(erx_fields)),dtype=np.uint32),np.zeros(0,dtype=object)
+    clk,resets,words,fast_commands = [np.concatenate(x) if x[0] is not None else None for x in zip(*blocks)]
+    if clk is None:
+        clk = np.arange(len(words))
+    return description,channels,clk,resets,words,fast_commands
+
+def csv_to_binary(csv_name,bin_name,fast_command_names=None,meta=None):
+    """
+    Convert a CSV pattern file to the binary format
+      fast_command_names: code table for the fast commands (default: the names found in the file, in order of appearance)
+    """
+    description,channels,clk,resets,words,fast_commands = read_csv_pattern(csv_name)
+
+    if len(clk)>0 and not np.array_equal(clk,np.arange(clk[0],clk[0]+len(clk))):
+        raise ValueError(f'CLK_N in {csv_name} is not consecutive, cannot convert to binary')
+    if not np.all(resets==1):
+        raise ValueError(f'{csv_name} has resets, cannot convert to binary')
+
+    if fast_command_names is None:
+        names,first = np.unique(fast_commands,return_index=True)
+        fast_command_names = list(names[np.argsort(first)])
+
+    meta = dict(meta or {})
+    meta['bx_start'] = int(clk[0]) if len(clk)>0 else meta.get('bx_start',0)
+
+    with BinaryPatternWriter(bin_name,len(clk),description,fast_command_names,channels,meta) as writer:
+        writer.write_block(clk,words,fast_commands)
+
+def binary_to_csv(bin_name,csv_name,block_size=100000):
+    """Convert a binary pattern file back to the CSV layout"""
+    header,words,codes = read_binary_pattern(bin_name)
+
+    with CSVPatternWriter(csv_name,header['description'],header['fast_commands']) as writer:
+        for first in range(0,header['num_rows'],block_size):
+            last = min(first+block_size,header['num_rows'])
+            clk = np.arange(header['bx_start']+first,header['bx_start']+last)
+            writer.write_block(clk,np.asarray(words[first:last]),codes[first:last])
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert ROC pattern files between the CSV and binary formats')
+    parser.add_argument('input', type=str, help="Input file (.csv or .bin)")
+    parser.add_argument('output', type=str, help="Output file (.bin or .csv)")
+    args = parser.parse_args()
+
+    if args.input.endswith('.csv'):
+        csv_to_binary(args.input,args.output)
+    else:
+        binary_to_csv(args.input,args.output)
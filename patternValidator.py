@@ -0,0 +1,343 @@
+import argparse
+import json
+import re
+import sys
+import time
+
+import numpy as np
+
+import simulateInputECOND as sim
+from rocCRC import crc_words,CRC_NWORDS
+from patternIO import read_csv_pattern,read_binary_pattern,encode_fast_commands,LEGACY_COLUMNS
+
+###############################################
+# Decoder/validator of the generated ROC pattern files
+###############################################
+#
+# loads a pattern file (CSV or binary) into arrays, locates the packets on the eRx links from their header,
+#   and checks all packets and BXs at once (numpy operations, no loop over the BXs)
+#   patterns of several ROCs (multiROC.py) are checked for each ROC, on its 12 links and with its delay,
+#   from the ROCs listed in the description (or in the header of binary files)
+#   - header: BX/orbit fields of each packet match a L1A ((bxL1A+2)%3564, (bxL1A+2)//3564), read out in order,
+#             and the event counter increases by one between packets (restarting from 1 after an ECR/EBR)
+#   - latency: packets start at least `delay` BXs after their L1A, with the L1As taken from the FAST_CMD column
+#             shifted back by the fast command latency (the offset is measured if the headers do not match)
+#   - crc: CRC word (polynomial 0x104c11db7) of the first 39 words of each packet, on each link
+#   - idle: idle words outside of packets (9AAAAAAA on BC0, from the BCRs in the FAST_CMD column, AAAAAAAA otherwise),
+#             and the idle word at the end of each packet (ACCCCCCC)
+# the report (JSON) has the number of errors of each check, and the first mismatches
+#   python3 patternValidator.py rocData/<pattern>.csv [--report report.json]
+# patterns in the legacy layout of the first versions (no CLK_N, other packet format) are not validated (exit code 2)
+#
+###############################################
+
+# header: 1111 + 12bit Bx# + 6bit Event# + 3bit Orbit# + 3bit hamming code + 0101
+HEADER_MASK = 0xf000000f
+HEADER_PATTERN = 0xf0000005
+IDLE_INDEX = sim.NWORDS-1
+
+# BX/orbit of the header: orbit counter has 3 bits
+HEADER_PERIOD = 8*sim.ORBITLAST
+
+CHECKS = ['clk','packet','header','event','latency','fast_cmd_offset','crc','idle']
+
+def roc_groups(description,num_links,delay=None,rocs=None):
+    """
+    links of each ROC in the pattern, as a list of (name, link indices, delay)
+      from the ROCs of a multiROC.py pattern (rocs, or the '# ERX_a-ERX_b: ROC name ...' lines of the description),
+      with the delay of each ROC if it has its own; a single group with all links otherwise
+    """
+    if rocs:
+        return [(roc['name'],np.arange(i*sim.NELINKS,(i+1)*sim.NELINKS),int(roc['delay']) if 'delay' in roc else delay) for i,roc in enumerate(rocs)]
+    groups = []
+    for line in description.split('\n'):
+        match = re.match(r'# ERX_(\d+)-ERX_(\d+): ROC (\S+)',line)
+        if match:
+            roc_delay = re.search(r'\bdelay=(\d+)',line)
+            groups.append((match.group(3),np.arange(int(match.group(1)),int(match.group(2))+1),int(roc_delay.group(1)) if roc_delay else delay))
+    return groups if groups else [('',np.arange(num_links),delay)]
+
+def load_pattern(file_name):
+    """
+    eRx words and fast commands of a pattern file (CSV or binary)
+    returns CLK_N (BX,), eRx words (BX, links), fast command codes (index in FASTCMD_LIST, shifted by the latency as in the file),
+      the delay of the run (None if not in the file) and the links of each ROC (roc_groups)
+    """
+    if file_name.endswith('.bin'):
+        header,words,file_codes = read_binary_pattern(file_name)
+        table = np.array([sim.FASTCMD_CODES[name] for name in header['fast_commands']],dtype=np.uint8)
+        clk = np.arange(header['bx_start'],header['bx_start']+header['num_rows'])
+        groups = roc_groups(header.get('description',''),words.shape[1],header.get('delay'),header.get('rocs'))
+        return clk,words,table[file_codes],header.get('delay'),groups
+
+    description,channels,clk,resets,words,fast_commands = read_csv_pattern(file_name)
+    if LEGACY_COLUMNS in description:
+        raise ValueError(f'{file_name} is a pattern of the first versions of the emulator (no CLK_N column, other header and idle words), which can not be validated')
+    match = re.search(r'\(with (\d+) BXs of delay\)',description)
+    delay = int(match.group(1)) if match else None
+    return clk,words,encode_fast_commands(fast_commands,sim.FASTCMD_LIST),delay,roc_groups(description,words.shape[1],delay)
+
+def unshift_fast_commands(codes,bx_start,latency=sim.FASTCMD_INTERNAL_LATENCY):
+    """FastCommandSchedule of the fast commands sent in each BX, undoing the latency shift of the FAST_CMD column"""
+    schedule = sim.FastCommandSchedule(bx_start+len(codes))
+    schedule.codes[bx_start:] = np.roll(codes,latency) if len(codes)>=latency else codes
+    return schedule
+
+def locate_packets(words):
+    """
+    rows of the packet headers: 1111 ... 0101, the same word on all links
+      candidates less than NWORDS after the previous one are taken as words of that packet
+    """
+    rows = np.flatnonzero((np.asarray(words[:,0]) & HEADER_MASK)==HEADER_PATTERN)
+    rows = rows[(words[rows]==words[rows,:1]).all(axis=1)]
+    return rows[np.concatenate([[True],np.diff(rows)>=sim.NWORDS])[:len(rows)]]
+
+def header_fields(header_words):
+    """bx, event and orbit fields of header words"""
+    header_words = np.asarray(header_words,dtype=np.int64)
+    return (header_words>>16) & 0xfff, (header_words>>10) & 0x3f, (header_words>>7) & 0x7
+
+def match_l1as(hdr_bx,bx,orbit,l1a_bxs):
+    """
+    index of the L1A of each packet: latest L1A before the packet with the BX/orbit of its header (-1 if none)
+      the header only has the L1A BX modulo 8 orbits, and packets are read out well within 8 orbits of their L1A
+    """
+    l1a_keys = (l1a_bxs+2)%HEADER_PERIOD
+    order = np.lexsort((l1a_bxs,l1a_keys))
+    sorted_keys = l1a_keys[order]*(1<<40) + l1a_bxs[order]
+    keys = orbit*sim.ORBITLAST+bx
+    i = np.searchsorted(sorted_keys,keys*(1<<40)+hdr_bx,side='left')-1
+    matched = (i>=0) & (bx<sim.ORBITLAST)
+    matched[matched] = (sorted_keys[i[matched]]>>40)==keys[matched]
+    return np.where(matched,order[np.maximum(i,0)],-1)
+
+def measure_offset(hdr_bx,bx,orbit,codes,bx_start,max_offset=2*sim.FASTCMD_INTERNAL_LATENCY+2):
+    """shift of the FAST_CMD column that matches the most packet headers with a L1A"""
+    raw_l1a = np.flatnonzero(codes==sim.FASTCMD_CODES[sim.CMD_L1A])
+    n_matched = []
+    for offset in range(max_offset+1):
+        l1a_bxs = np.sort((raw_l1a+offset)%len(codes))+bx_start if len(codes)>=offset else raw_l1a+bx_start
+        n_matched.append(np.count_nonzero(match_l1as(hdr_bx,bx,orbit,l1a_bxs)>=0))
+    return int(np.argmax(n_matched)),int(np.max(n_matched))
+
+class Mismatches:
+    """
+    errors found by each check: number of words/packets checked and of errors,
+      and the first max_errors mismatches of each check (clk, link (None: all links), expected, found)
+    """
+    def __init__(self,max_errors=100):
+        self.max_errors = max_errors
+        self.checks = {check:{'checked':0,'errors':0} for check in CHECKS}
+        self.mismatches = {check:[] for check in CHECKS}
+
+    def count(self,check,checked,num_errors):
+        self.checks[check]['checked'] += int(checked)
+        self.checks[check]['errors'] += int(num_errors)
+
+    def add(self,check,clk,link=None,expected=None,found=None):
+        """keep the first mismatches of a check (arrays of clk, link, expected and found values)"""
+        n = min(len(clk),self.max_errors-len(self.mismatches[check]))
+        if n<=0: return
+        def column(x):
+            return [None]*n if x is None else list(np.broadcast_to(np.asarray(x,dtype=object),(len(clk),))[:n])
+        for c,l,e,f in zip(np.asarray(clk[:n]).tolist(),column(link),column(expected),column(found)):
+            self.mismatches[check].append({'check':check,'clk':c,'link':None if l is None else int(l),'expected':e,'found':f})
+
+    def first(self):
+        mismatches = sum(self.mismatches.values(),[])
+        return sorted(mismatches,key=lambda m: (m['clk'],CHECKS.index(m['check'])))[:self.max_errors]
+
+    @property
+    def num_errors(self):
+        return sum(c['errors'] for c in self.checks.values())
+
+def hex_words(words):
+    return [f'{int(w):08X}' for w in np.asarray(words).reshape(-1)]
+
+def check_packets(words,hdr_rows,clk0,errors):
+    """packets cut by the end of the file, returns the rows of the complete packets"""
+    truncated = hdr_rows[hdr_rows+sim.NWORDS>len(words)]
+    errors.count('packet',len(hdr_rows),len(truncated))
+    errors.add('packet',clk0+truncated,expected='%i words'%sim.NWORDS,found=(len(words)-truncated).tolist())
+    return hdr_rows[hdr_rows+sim.NWORDS<=len(words)]
+
+def check_headers(hdr_bx,bx,event,orbit,schedule,bx_start,delay,errors):
+    """
+    BX/orbit of each header against the L1As, latency from the L1A, and event counter sequence
+    returns a mask of the packets matched to a L1A
+    """
+    l1a_bxs = schedule.positions(sim.CMD_L1A)
+    i_l1a = match_l1as(hdr_bx,bx,orbit,l1a_bxs)
+    matched = i_l1a>=0
+
+    # L1As are read out in order (some are dropped by EBRs),
+    #   for a mismatch the expected header is the one of the next L1A
+    previous = np.maximum.accumulate(np.concatenate([[-1],i_l1a]))[:-1]
+    bad = ~matched | (i_l1a<=previous)
+    errors.count('header',len(hdr_bx),bad.sum())
+    expected = l1a_bxs[np.minimum(previous[bad]+1,len(l1a_bxs)-1)]+2 if len(l1a_bxs)>0 else None
+    errors.add('header',hdr_bx[bad],
+               expected=['bx=%i orbit=%i'%(b%sim.ORBITLAST,(b//sim.ORBITLAST)%8) for b in expected] if expected is not None else 'no L1A',
+               found=['bx=%i orbit=%i'%(b,o) for b,o in zip(bx[bad],orbit[bad])])
+
+    # packets start at least delay BXs after their L1A
+    if delay is not None:
+        latency = hdr_bx[matched]-l1a_bxs[i_l1a[matched]]
+        early = latency<delay
+        errors.count('latency',len(latency),early.sum())
+        errors.add('latency',hdr_bx[matched][early],expected='>=%i'%delay,found=latency[early].tolist())
+
+    # event counter: previous one + 1, or restarting from 1 on an ECR/EBR,
+    #   counted from 1 if the reset is after the previous packet was read out, or from 2 if it is during its readout
+    resets = schedule.positions(sim.CMD_ECR,sim.CMD_EBR)
+    resets = np.concatenate([[-1],resets[resets>=bx_start]])
+    i_reset = np.searchsorted(resets,hdr_bx,side='right')-1
+    last_reset = resets[i_reset]
+    expected = np.concatenate([[1],event[:-1]+1])[:len(event)]
+    if len(hdr_bx)>1:
+        expected[1:] = np.where(last_reset[1:]>hdr_bx[:-1]+IDLE_INDEX,1,np.where(last_reset[1:]>hdr_bx[:-1],2,expected[1:]))
+    expected &= 0x3f
+    bad = event!=expected
+    errors.count('event',len(event),bad.sum())
+    errors.add('event',hdr_bx[bad],expected=expected[bad].tolist(),found=event[bad].tolist())
+    return matched
+
+def check_offset(hdr_bx,bx,orbit,codes,clk0,latency,matched,errors):
+    """
+    shift of the FAST_CMD column, measured again only if some headers do not match a L1A
+    returns the measured shift
+    """
+    offset = latency
+    if len(matched)>0 and not matched.all():
+        best,n_matched = measure_offset(hdr_bx,bx,orbit,codes,clk0)
+        if n_matched>matched.sum():
+            offset = best
+    errors.count('fast_cmd_offset',1,offset!=latency)
+    if offset!=latency:
+        errors.add('fast_cmd_offset',[clk0],expected=latency,found=offset)
+    return offset
+
+def check_crc(words,hdr_rows,clk0,errors,block_size=1<<14,links=None):
+    """
+    CRC word of the first CRC_NWORDS words of each packet, on each link
+      links: index of each column of words in the pattern (for the mismatches)
+    """
+    links = np.arange(words.shape[1]) if links is None else links
+    window = np.arange(CRC_NWORDS)
+    for first in range(0,len(hdr_rows),block_size):
+        rows = hdr_rows[first:first+block_size]
+        expected = crc_words(words[rows[:,None]+window].transpose(0,2,1))
+        found = words[rows+sim.CRC_INDEX]
+        i_packet,link = np.nonzero(expected!=found)
+        errors.count('crc',expected.size,len(link))
+        errors.add('crc',clk0+rows[i_packet]+sim.CRC_INDEX,links[link],hex_words(expected[i_packet,link]),hex_words(found[i_packet,link]))
+
+def check_idles(words,hdr_rows,schedule,clk0,errors,block_size=1<<20,links=None):
+    """idle words outside of the packets (9AAAAAAA on BC0), and at the end of each packet (ACCCCCCC)"""
+    links = np.arange(words.shape[1]) if links is None else links
+    n = len(words)
+    # rows of the packets, up to the CRC word
+    marks = np.zeros(n+1,dtype=np.int32)
+    np.add.at(marks,hdr_rows,1)
+    np.add.at(marks,np.minimum(hdr_rows+IDLE_INDEX,n),-1)
+    in_packet = np.cumsum(marks[:-1])>0
+    is_packet_idle = np.zeros(n,dtype=bool)
+    is_packet_idle[hdr_rows[hdr_rows+IDLE_INDEX<n]+IDLE_INDEX] = True
+
+    for first in range(0,n,block_size):
+        last = min(first+block_size,n)
+        bx,_ = schedule.counters(np.arange(clk0+first,clk0+last),clk0)
+        expected = np.where(is_packet_idle[first:last],sim.IDLEWORD_HEX,sim.pack_idle(bx==0)).astype(np.uint32)
+        checked = ~in_packet[first:last]
+        block = np.asarray(words[first:last])
+        bad = (block!=expected[:,None]) & checked[:,None]
+        errors.count('idle',checked.sum()*words.shape[1],np.count_nonzero(bad))
+        if len(errors.mismatches['idle'])<errors.max_errors and bad.any():
+            row,link = np.nonzero(bad)
+            row,link = row[:errors.max_errors],link[:errors.max_errors]
+            errors.add('idle',clk0+first+row,links[link],hex_words(expected[row]),hex_words(block[row,link]))
+
+def validate_pattern(file_name,delay=None,latency=sim.FASTCMD_INTERNAL_LATENCY,max_errors=100):
+    """
+    check a pattern file (CSV or binary)
+      delay: minimum latency of the readout of a L1A (default: from the file, for each ROC)
+      latency: shift of the FAST_CMD column
+    returns the report, as a dict (with the delay, fast command shift and number of packets of each ROC for patterns of several ROCs)
+    """
+    start = time.time()
+    clk,words,codes,file_delay,groups = load_pattern(file_name)
+    n = len(clk)
+    clk0 = int(clk[0]) if n>0 else 0
+    errors = Mismatches(max_errors)
+
+    # BXs are consecutive (rows are mapped to BXs from the first CLK_N)
+    bad = np.flatnonzero(np.diff(clk)!=1)
+    errors.count('clk',n,len(bad))
+    errors.add('clk',clk[bad+1],expected=(clk[bad]+1).tolist(),found=clk[bad+1].tolist())
+
+    schedule = unshift_fast_commands(codes,clk0,latency)
+
+    # packets of each ROC, on its links
+    rocs = []
+    for name,links,roc_delay in groups:
+        roc_delay = roc_delay if delay is None else delay
+        roc_words = words[:,links] if len(groups)>1 else words
+        packet_rows = locate_packets(roc_words)
+        hdr_rows = check_packets(roc_words,packet_rows,clk0,errors)
+        bx,event,orbit = header_fields(roc_words[hdr_rows,0])
+        hdr_bx = clk0+hdr_rows
+
+        matched = check_headers(hdr_bx,bx,event,orbit,schedule,clk0,roc_delay,errors)
+        offset = check_offset(hdr_bx,bx,orbit,codes,clk0,latency,matched,errors)
+        check_crc(roc_words,hdr_rows,clk0,errors,links=links)
+        check_idles(roc_words,packet_rows,schedule,clk0,errors,links=links)
+        rocs.append({'name':name, 'links':[int(links[0]),int(links[-1])], 'delay':roc_delay, 'fast_cmd_offset':offset, 'num_packets':len(hdr_rows)})
+
+    report = {'file': file_name,
+              'num_rows': n,
+              'bx_start': clk0,
+              'links': int(words.shape[1]),
+              'delay': rocs[0]['delay'],
+              'fast_cmd_latency': latency,
+              'fast_cmd_offset': rocs[0]['fast_cmd_offset'],
+              'num_l1a': len(schedule.positions(sim.CMD_L1A)),
+              'num_packets': sum(roc['num_packets'] for roc in rocs),
+              'valid': errors.num_errors==0,
+              'checks': errors.checks,
+              'mismatches': errors.first(),
+              'seconds': round(time.time()-start,3),
+              }
+    if len(rocs)>1:
+        report['rocs'] = rocs
+    return report
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Decode a ROC pattern file and check its packets, CRCs, idles and fast commands')
+    parser.add_argument('input', type=str, help="Pattern file (.csv or .bin)")
+    parser.add_argument('--report', type=str, default=None, dest="report", help="Write the report to this JSON file")
+    parser.add_argument('--max-errors', type=int, default=100, dest="max_errors", help="Number of mismatches kept in the report (default: 100)")
+    parser.add_argument('--delay', type=int, default=None, dest="delay", help="Minimum readout latency of a L1A (default: from the file)")
+    parser.add_argument('--latency', type=int, default=sim.FASTCMD_INTERNAL_LATENCY, dest="latency", help=f"Shift of the FAST_CMD column (default: {sim.FASTCMD_INTERNAL_LATENCY})")
+    args = parser.parse_args()
+
+    try:
+        report = validate_pattern(args.input,args.delay,args.latency,args.max_errors)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+
+    print(f"{report['file']}: {report['num_rows']} BXs, {report['num_packets']} packets, {report['num_l1a']} L1As ({report['seconds']:.2f} s)")
+    for roc in report.get('rocs',[]):
+        print(f"  ROC {roc['name']} (ERX_{roc['links'][0]}-ERX_{roc['links'][1]}): {roc['num_packets']} packets, delay {roc['delay']}")
+    for check,counts in report['checks'].items():
+        print(f"  {check:16s} {counts['checked']:12d} checked {counts['errors']:10d} errors")
+    for m in report['mismatches'][:10]:
+        print(f"  {m['check']:16s} CLK_N {m['clk']:10d} link {'all' if m['link'] is None else m['link']:>3}  expected {m['expected']}  found {m['found']}")
+    print('VALID' if report['valid'] else 'INVALID')
+
+    if args.report:
+        with open(args.report,'w') as _file:
+            json.dump(report,_file,indent=1)
+
+    sys.exit(0 if report['valid'] else 1)
@@ -0,0 +1,78 @@
+###############################################
+# Event buffer of the ROC: events waiting to be read out after their L1A
+###############################################
+#
+# ring buffer with a fixed number of slots (the depth of the ROC buffer), or growing as needed (depth 0: no limit)
+#   events are pushed on a L1A and popped once their last word is read, in O(1)
+# when a L1A arrives with the buffer full (BUFFER_FULL_POLICIES):
+#   drop: the L1A is ignored by the ROC, no packet is sent (the L1A stays in the fast command stream)
+#   busy: the ROC is busy, and the L1A is not sent (removed from the fast command stream)
+#   flag: the event is still read out (beyond the depth), with the status bits of its header set (STATUS_BUFFER_FULL)
+# the buffer also counts the number of BXs with each occupancy
+#
+###############################################
+
+BUFFER_FULL_POLICIES = ['drop','busy','flag']
+
+# status bits of the header (H1/H2/H3) of events accepted with a full buffer
+STATUS_BUFFER_FULL = 0b111
+
+# fields of each slot
+GLOBALBX,START,END,EVENT,WORDS,STATUS = range(6)
+
+class EventBuffer:
+    """
+    depth: maximum number of events (0: no limit)
+    each slot is a list [globalBX of the L1A, first BX read, last BX read, index of the event, words read, header status bits]
+    """
+    def __init__(self,depth=0):
+        self.depth = depth
+        self.slots = [None]*(depth if depth>0 else 64)
+        self.first = 0
+        self.size = 0
+        # number of BXs with each occupancy
+        self.occupancy = [0]*(len(self.slots)+1)
+
+    def __len__(self):
+        return self.size
+
+    def is_full(self):
+        return self.depth>0 and self.size>=self.depth
+
+    def push(self,globalBX,start,end,event,status=0):
+        """add an event at the back of the buffer (beyond the depth only in flag mode, growing the ring)"""
+        if self.size==len(self.slots):
+            self.slots = [self.slots[(self.first+i)%len(self.slots)] for i in range(self.size)] + [None]*len(self.slots)
+            self.first = 0
+        self.slots[(self.first+self.size)%len(self.slots)] = [globalBX,start,end,event,0,status]
+        self.size += 1
+
+    def front(self):
+        return self.slots[self.first]
+
+    def back(self):
+        return self.slots[(self.first+self.size-1)%len(self.slots)]
+
+    def pop(self):
+        """remove the event at the front of the buffer (fully read out)"""
+        slot = self.slots[self.first]
+        self.slots[self.first] = None
+        self.first = (self.first+1)%len(self.slots)
+        self.size -= 1
+        return slot
+
+    def clear(self,keep_front=False):
+        """remove all events (but the one at the front, if it is being read), returns the number of events removed"""
+        kept = min(self.size,1) if keep_front else 0
+        removed = self.size-kept
+        for i in range(kept,self.size):
+            self.slots[(self.first+i)%len(self.slots)] = None
+        self.size = kept
+        return removed
+
+    def count_bx(self,nbx,occupancy=None):
+        """add nbx BXs with this occupancy (default: the current one)"""
+        occupancy = self.size if occupancy is None else occupancy
+        if occupancy>=len(self.occupancy):
+            self.occupancy += [0]*(occupancy+1-len(self.occupancy))
+        self.occupancy[occupancy] += nbx
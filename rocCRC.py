@@ -0,0 +1,73 @@
+import numpy as np
+
+###############################################
+# CRC of the ROC packets (polynomial 0x104c11db7, no reflection, initCrc=0, xorOut=0)
+###############################################
+#
+# computed directly on 32 bit words (uint32 arrays), instead of on the hex string of the packet
+#   equivalent to crcmod.mkCrcFun(0x104c11db7,initCrc=0, xorOut=0, rev=False) on the big-endian bytes of the words
+#
+# table driven, one word at a time (slicing-by-4):
+#   the crc after a word is f(crc ^ word), with f(x) = x*2^32 mod poly
+#   f is linear, so it is split into one 256 entry table per byte of x
+#
+###############################################
+
+POLY = 0x104c11db7
+
+# number of words in the CRC of a packet (HDR + CM + 37 channels)
+CRC_NWORDS = 39
+
+def _shift_word(x):
+    # f(x) = x*2^32 mod poly, one bit at a time
+    for i in range(32):
+        if x & 0x80000000:
+            x = ((x<<1) ^ POLY) & 0xffffffff
+        else:
+            x = (x<<1) & 0xffffffff
+    return x
+
+# CRC_TABLES[k][b] = f(b<<8k)
+CRC_TABLES = np.array([[_shift_word(b<<(8*k)) for b in range(256)] for k in range(4)],dtype=np.uint32)
+
+def _apply(tables,x):
+    x = np.asarray(x,dtype=np.uint32)
+    return tables[3][x>>24] ^ tables[2][(x>>16) & 0xff] ^ tables[1][(x>>8) & 0xff] ^ tables[0][x & 0xff]
+
+def crc_update(crc,words):
+    """
+    Update the crc with one more word
+      crc and words are broadcast together, e.g. one word for each of the 12 eRx links
+    """
+    return _apply(CRC_TABLES,np.asarray(crc,dtype=np.uint32) ^ np.asarray(words,dtype=np.uint32))
+
+def crc_words(words,crc=0):
+    """
+    CRC of the 32 bit words along the last axis of words
+      e.g. words with shape (num_events, 12, 39) gives the CRC of every packet of every link at once
+    """
+    words = np.asarray(words,dtype=np.uint32)
+    crc = np.broadcast_to(np.asarray(crc,dtype=np.uint32),words.shape[:-1])
+    for i in range(words.shape[-1]):
+        crc = crc_update(crc,words[...,i])
+    return crc
+
+
+if __name__=="__main__":
+    # check against the crcmod function on random packets
+    import crcmod
+    crc = crcmod.mkCrcFun(POLY,initCrc=0, xorOut=0, rev=False)
+
+    rng = np.random.default_rng(0)
+    packets = rng.integers(0,2**32,(100,12,CRC_NWORDS),dtype=np.uint32)
+    packets[:10] = rng.choice(np.array([0,0xffffffff,0xaaaaaaaa,0x9aaaaaaa],dtype=np.uint32),(10,12,CRC_NWORDS))
+
+    expected = np.array([[crc(packets[i,j].astype('>u4').tobytes()) for j in range(12)] for i in range(len(packets))],dtype=np.uint32)
+    assert np.array_equal(crc_words(packets),expected), 'batched CRC (crc_words) differs from crcmod'
+
+    # one word at a time, from a running CRC (as in the loop over the BXs of a packet)
+    running = np.zeros(packets.shape[:-1],dtype=np.uint32)
+    for i in range(CRC_NWORDS):
+        running = crc_update(running,packets[...,i])
+    assert np.array_equal(running,expected), 'CRC from crc_update differs from crcmod'
+    print(f'CRC matches crcmod on {len(packets)*12} packets')
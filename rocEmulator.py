@@ -0,0 +1,172 @@
+import contextlib
+import dataclasses
+import logging
+from typing import Optional
+
+import numpy as np
+
+import simulateInputECOND as sim
+from rocMetrics import log,log_level,RunMetrics,metrics_file_name
+
+###############################################
+# In-process API of the ROC emulator
+###############################################
+#
+# for test benches calling the emulator many times: no argparse and no files,
+#   the eRx words and fast commands are returned as arrays (vectorized engine, same words as the pattern files)
+#   pandas/uproot are only imported if physics data is used
+#
+#   from rocEmulator import Emulator
+#   emulator = Emulator(N=10692, bcr=True, sequence='fixed', L1a_freq='50', nL1a='3')
+#   result = emulator.run()                  # or emulator.run(ebr=True, ebrBX=[98]), changing some settings
+#   result.erx                               # (BX, 12) uint32 eRx words
+#   result.fast_command_names()              # FAST_CMD column (shifted by the fast command latency)
+#   result.metrics.to_dict()                 # stage timers, counters (L1As, EBR drops, ...) and histograms of the run
+#
+###############################################
+
+# options given as lists, stored as comma separated strings (as on the command line)
+LIST_FIELDS = ['ecrBX','ocrBX','ebrBX','linkresetrocdBX','linkresetecondBX','sequence','nL1a','L1a_freq','L1a_rate','L1aBX','mcEvtNumbers','waferCoordinates']
+
+@dataclasses.dataclass
+class EmulatorConfig:
+    """
+    Settings of the emulator, same names and defaults as the arguments of simulateInputECOND.py
+      list settings (BXs, sequences, wafer coordinates) can be given as lists (or single values) or as comma separated strings
+    """
+    N: int = 10000
+    bx_start: int = 0
+    bcr: bool = False
+    missing_bcr: bool = False
+    extra_bcr: bool = False
+    bocr: bool = False
+    ecr: bool = False
+    ecrBX: str = ''
+    ocr: bool = False
+    ocrBX: str = ''
+    ebr: bool = False
+    ebrBX: str = ''
+    linkresetrocdBX: str = ''
+    linkresetecondBX: str = ''
+    delay: int = 7
+    bufferDepth: int = 0
+    bufferFull: str = 'drop'
+    hamErrRate: float = 0.
+    rng: str = 'legacy'
+    sequence: str = ''
+    nL1a: str = ''
+    L1a_freq: str = ''
+    L1a_rate: str = ''
+    L1aBX: str = ''
+    L1aStart: int = 0
+    seed: int = 6
+    triggerRules: str = ''
+    l1aVeto: str = ''
+    mcEvtNumbers: Optional[str] = None
+    zerodata: bool = False
+    physicsdata: bool = False
+    waferCoordinates: str = '0,1,5,3,1'
+    fname: str = 'InputNtuples/ntuple.root'
+    mcEntryStart: int = 0
+    mcMaxEvents: Optional[int] = None
+    mcCacheDir: str = 'mcCache'
+    mcCacheSize: float = 1000
+    # only used when writing files (EmulatorResult.write, or simulateInputECOND.py)
+    outputFormat: str = 'csv'
+    outputFileName: Optional[str] = None
+
+    def __post_init__(self):
+        for field in LIST_FIELDS:
+            value = getattr(self,field)
+            if value is not None and not isinstance(value,str):
+                setattr(self,field,','.join(str(x) for x in value) if np.iterable(value) else str(value))
+
+    @classmethod
+    def from_args(cls,args):
+        """config from the arguments of simulateInputECOND.py (e.g. after readConfigFromFile)"""
+        names = [field.name for field in dataclasses.fields(cls)]
+        return cls(**{k:v for k,v in vars(args).items() if k in names})
+
+    def replace(self,**changes):
+        return dataclasses.replace(self,**changes)
+
+@dataclasses.dataclass
+class EmulatorResult:
+    """
+    Output of the emulator, one row per BX (CLK_N from bx_start)
+      erx: (BX, 12) uint32 eRx words
+      fast_commands: (BX,) uint8 fast command codes (index in FASTCMD_LIST), shifted by FASTCMD_INTERNAL_LATENCY as in the pattern files
+      metrics: RunMetrics of the run (stage timers, counters and histograms, see rocMetrics)
+    """
+    config: EmulatorConfig
+    clk: np.ndarray
+    erx: np.ndarray
+    fast_commands: np.ndarray
+    num_events: int
+    num_packets: int
+    L1a_name: str
+    metrics: Optional[RunMetrics] = None
+
+    def fast_command_names(self):
+        return sim.fast_command_names(self.fast_commands)
+
+    def write(self,file_name=None):
+        """write the pattern file (CSV or binary, from config.outputFormat), by default in rocData with the usual name, and its metrics"""
+        config = self.config
+        if file_name is None:
+            file_name = 'rocData/%s.%s'%(sim.eportRX_file_name(config,self.L1a_name),'bin' if config.outputFormat=='binary' else 'csv')
+        description = sim.eportRX_description(config,config.bx_start+len(self.clk),self.num_packets,self.L1a_name,sim.CHANNELS)
+        if file_name.endswith('.bin'):
+            meta = {'N':config.N, 'bx_start':config.bx_start, 'delay':config.delay, 'bcr':config.bcr}
+            writer = sim.BinaryPatternWriter(file_name,len(self.clk),description,sim.FASTCMD_LIST,sim.CHANNELS,meta)
+        else:
+            writer = sim.CSVPatternWriter(file_name,description,sim.FASTCMD_LIST)
+        with writer:
+            writer.write_block(self.clk,self.erx,self.fast_commands)
+        if self.metrics is not None:
+            self.metrics.write(metrics_file_name(file_name),pattern=file_name,engine='vector',args=dataclasses.asdict(config))
+        return file_name
+
+class Emulator:
+    """
+    ROC emulator with a fixed configuration (EmulatorConfig, or its fields as keyword arguments)
+    verbose: log the messages of the emulator (fast commands issued, MC events) at info level,
+      to the handlers of the rocEmulator logger (or to stderr if it has none); otherwise only warnings are logged
+    """
+    def __init__(self,config=None,verbose=False,**settings):
+        self.config = (config or EmulatorConfig()).replace(**settings)
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def _logging(self):
+        """level of the log (and a stderr handler if verbose and there is none) during a run"""
+        handler = logging.StreamHandler() if self.verbose and not log.hasHandlers() else None
+        if handler is not None:
+            log.addHandler(handler)
+        try:
+            with log_level('info' if self.verbose else 'warning'):
+                yield
+        finally:
+            if handler is not None:
+                log.removeHandler(handler)
+
+    def run(self,**settings):
+        """run the emulator, with some settings changed for this run only"""
+        config = self.config.replace(**settings) if settings else self.config
+
+        metrics = RunMetrics()
+        with self._logging():
+            with metrics.stage('fast_commands'):
+                fast_commands,L1a_name,num_events = sim.build_fast_commands(config)
+            with metrics.stage('dataset'):
+                packets = sim.make_dataset(config,num_events)
+            with metrics.stage('schedule'):
+                reads,num_bx,counters = sim.schedule_readout(fast_commands,config,metrics)
+            sim.fast_command_metrics(metrics,fast_commands,config.bx_start)
+
+        with metrics.stage('fill'):
+            erx = sim.fill_eportRX_matrix(reads,packets,fast_commands,config,config.bx_start,num_bx,metrics=metrics)
+        clk = np.arange(config.bx_start,config.bx_start+len(erx))
+        commands = sim.fast_command_stream(fast_commands,clk,len(erx),config)
+
+        return EmulatorResult(config,clk,erx,commands,num_events,counters['event'],L1a_name,metrics)
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+###############################################
+# Instrumentation of the emulator: log messages, stage timers, counters and histograms
+###############################################
+#
+# log: messages of the emulator (logger 'rocEmulator'), with no handler of its own:
+#   the command line scripts write them to stderr (setup_logging), other callers attach their own handlers
+#   info: fast commands issued, MC events used
+#   debug: every L1A (buffer depth, latency, readout window) and LinkReset, only formatted if enabled
+# RunMetrics: collected in each run and written as JSON next to the pattern (<pattern>.metrics.json)
+#   timers: wall time of each stage (fast_commands, dataset, schedule/bx_loop, fill, crc, write), in seconds
+#   counters: number of L1As, events read out, events dropped by EBRs, L1As with a full buffer, idle BXs after LinkResets, fast commands, ...
+#   histograms: event buffer depth at each L1A, buffer occupancy (BXs with each number of events), readout latency of each event,
+#     and the maximum buffer depth in each orbit
+# everything is accumulated with a few operations per L1A or per block of BXs, so it is always on
+#
+###############################################
+
+LOG_LEVELS = ['debug','info','warning','error']
+
+log = logging.getLogger('rocEmulator')
+_stderr_handler = logging.StreamHandler(sys.stderr)
+
+def set_log_level(level):
+    """level: one of LOG_LEVELS (or a logging level)"""
+    log.setLevel(level.upper() if isinstance(level,str) else level)
+
+@contextlib.contextmanager
+def log_level(level):
+    """set the level of the log in a block (e.g. to silence the emulator), and restore it after"""
+    previous = log.level
+    set_log_level(level)
+    try:
+        yield
+    finally:
+        log.setLevel(previous)
+
+def setup_logging(level='info'):
+    """log messages written to stderr, for the command line scripts (the handler is only added once)"""
+    if _stderr_handler not in log.handlers:
+        log.addHandler(_stderr_handler)
+    set_log_level(level)
+
+class RunMetrics:
+    """
+    Timers, counters and histograms of one run of the emulator
+      histograms are of integer values (bin i counts the value i)
+    """
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.series = {}
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        """add the wall time of the block to the timer of this stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name,time.perf_counter()-start)
+
+    def add_time(self,name,seconds):
+        self.timers[name] = self.timers.get(name,0.)+seconds
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name,0)+int(n)
+
+    def fill(self,name,values,weights=None):
+        """add non-negative integer values (with integer weights, e.g. numbers of BXs) to a histogram"""
+        counts = np.bincount(np.asarray(values,dtype=np.int64).reshape(-1),weights).astype(np.int64)
+        previous = self.histograms.get(name,np.zeros(0,dtype=np.int64))
+        if len(previous)<len(counts):
+            previous = np.concatenate([previous,np.zeros(len(counts)-len(previous),dtype=np.int64)])
+        previous[:len(counts)] += counts
+        self.histograms[name] = previous
+
+    def set_series(self,name,values):
+        """values of a quantity over time (e.g. one per orbit)"""
+        self.series[name] = np.asarray(values)
+
+    def merge(self,other):
+        """add the timers, counters and histograms of another run (e.g. of a worker process)"""
+        for name,seconds in other.timers.items():
+            self.add_time(name,seconds)
+        for name,n in other.counters.items():
+            self.count(name,n)
+        for name,counts in other.histograms.items():
+            self.fill(name,np.repeat(np.arange(len(counts)),counts))
+        self.series.update(other.series)
+
+    def to_dict(self):
+        return {'timers': {k:round(v,6) for k,v in self.timers.items()},
+                'counters': dict(self.counters),
+                'histograms': {k:{'values': np.nonzero(v)[0].tolist(), 'counts': v[v>0].tolist()} for k,v in self.histograms.items()},
+                'series': {k:v.tolist() for k,v in self.series.items()},
+                }
+
+    def write(self,file_name,**info):
+        """write the metrics (and info, e.g. the arguments of the run) as JSON, returns the file name"""
+        with open(file_name,'w') as _file:
+            json.dump({**info,**self.to_dict()},_file,indent=1,default=str)
+        return file_name
+
+def metrics_file_name(file_name):
+    """JSON file of the metrics of a pattern file: rocData/X.csv -> rocData/X.metrics.json"""
+    for extension in ['.csv','.bin']:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]+'.metrics.json'
+    return file_name+'.metrics.json'
+
+def l1a_metrics(metrics,l1a_bx,depth,latency,bx_start,num_bx,orbit_length=3564):
+    """
+    histograms of the event buffer depth (events already in the buffer) at each L1A, and of the readout latency (BXs from the L1A to the header)
+      of each event read out, and the maximum buffer depth (including the new event) in each orbit from bx_start (0 in orbits without L1As)
+    """
+    l1a_bx = np.asarray(l1a_bx,dtype=np.int64)
+    depth = np.asarray(depth,dtype=np.int64)
+    metrics.count('l1a',len(l1a_bx))
+    metrics.fill('buffer_depth_at_l1a',depth)
+    metrics.fill('readout_latency',latency)
+    max_depth = np.zeros(max(0,num_bx-bx_start+orbit_length-1)//orbit_length,dtype=np.int64)
+    np.maximum.at(max_depth,(l1a_bx-bx_start)//orbit_length,depth+1)
+    metrics.set_series('max_buffer_depth_per_orbit',max_depth)
@@ -0,0 +1,76 @@
+import numpy as np
+
+###############################################
+# Counter-based random numbers for the ROC packets (Philox4x32-10)
+###############################################
+#
+# each random number is a function of (bx, event, orbit, link, stream) and the seed only,
+#   so all packets are drawn at once (vectorized over numpy arrays), and the values do not depend on
+#   the order in which packets are generated (blocks, parallel runs, loop or vectorized engine)
+#
+# counter (4x32 bits): bx + event<<12, orbit, link, stream
+# key (2x32 bits): seed
+#
+###############################################
+
+PHILOX_M = (0xD2511F53, 0xCD9E8D57)
+PHILOX_W = (0x9E3779B9, 0xBB67AE85)
+
+# streams of random numbers
+STREAM_CM = 0
+STREAM_HEADER = 1
+
+def _mulhilo(a,b):
+    product = np.uint64(a)*b.astype(np.uint64)
+    return (product>>np.uint64(32)).astype(np.uint32), (product & np.uint64(0xffffffff)).astype(np.uint32)
+
+def philox4x32(counter,key,rounds=10):
+    """
+    Philox4x32 block function, on an array of counters (..., 4) uint32 with a key (2,) uint32
+    returns (..., 4) uint32 random words
+    """
+    c = np.asarray(counter,dtype=np.uint32)
+    c0,c1,c2,c3 = c[...,0],c[...,1],c[...,2],c[...,3]
+    k0,k1 = np.uint32(key[0]),np.uint32(key[1])
+    for i in range(rounds):
+        hi0,lo0 = _mulhilo(PHILOX_M[0],c0)
+        hi1,lo1 = _mulhilo(PHILOX_M[1],c2)
+        c0,c1,c2,c3 = hi1^c1^k0, lo1, hi0^c3^k1, lo0
+        k0 = np.uint32((int(k0)+PHILOX_W[0]) & 0xffffffff)
+        k1 = np.uint32((int(k1)+PHILOX_W[1]) & 0xffffffff)
+    return np.stack([c0,c1,c2,c3],axis=-1)
+
+def packet_random(bx,event,orbit,link,stream,seed=0):
+    """random words (..., 4) uint32 for each packet (bx, event, orbit arrays, broadcast with link)"""
+    bx,event,orbit,link = np.broadcast_arrays(*[np.asarray(x,dtype=np.int64) for x in (bx,event,orbit,link)])
+    counter = np.stack([(bx & 0xfff) | (event<<12),orbit,link,np.full(bx.shape,stream)],axis=-1) & 0xffffffff
+    return philox4x32(counter.astype(np.uint32),(seed & 0xffffffff,(seed>>32) & 0xffffffff))
+
+def cm_values(bx,event,orbit,nlinks=12,seed=0):
+    """
+    common mode ADC values (CM0, CM1) of each packet and link: (n, nlinks, 2)
+      random scale (0-15)<<6 for each packet, plus random 0-63 for each link
+    """
+    bx,event,orbit = [np.asarray(x,dtype=np.int64).reshape(-1) for x in (bx,event,orbit)]
+    scale = (packet_random(bx,event,orbit,0,STREAM_HEADER,seed)[:,0] & 0xf).astype(np.int64)<<6
+    values = packet_random(bx[:,None],event[:,None],orbit[:,None],np.arange(nlinks),STREAM_CM,seed)
+    return (values[:,:,:2] & 0x3f).astype(np.int64) + scale[:,None,None]
+
+def hamming_codes(bx,event,orbit,rate,seed=0):
+    """3 bit hamming code of the header of each packet: 0, or 1-7 with probability rate"""
+    bx,event,orbit = [np.asarray(x,dtype=np.int64).reshape(-1) for x in (bx,event,orbit)]
+    values = packet_random(bx,event,orbit,0,STREAM_HEADER,seed)
+    has_error = values[:,1]/2.**32 < rate
+    return np.where(has_error,1+values[:,2]%7,0).astype(np.int64)
+
+
+if __name__=="__main__":
+    # known answer tests of Philox4x32-10 (Random123)
+    kat = [([0,0,0,0],[0,0],[0x6627e8d5,0xe169c58d,0xbc57ac4c,0x9b00dbd8]),
+           ([0xffffffff]*4,[0xffffffff]*2,[0x408f276d,0x41c83b0e,0xa20bc7c6,0x6d5451fd]),
+           ([0x243f6a88,0x85a308d3,0x13198a2e,0x03707344],[0xa4093822,0x299f31d0],[0xd16cfe09,0x94fdcceb,0x5001e420,0x24126ea1]),
+           ]
+    for c,k,r in kat:
+        result = philox4x32(np.array(c,dtype=np.uint32),k)
+        assert np.array_equal(result,np.array(r,dtype=np.uint32)), f'Philox4x32-10 of counter {c}, key {k}: {[hex(x) for x in result]}, expected {[hex(x) for x in r]}'
+    print(f'Philox4x32-10 matches the {len(kat)} known answers')
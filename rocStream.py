@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import simulateInputECOND as sim
+from patternIO import format_csv_block
+from rocMetrics import log,setup_logging,RunMetrics
+
+###############################################
+# Streaming the generated BXs to a local consumer (e.g. the pattern generator of a hardware-in-the-loop setup)
+###############################################
+#
+# the vectorized engine generates the eRx words and fast commands one block of --block-size BXs at a time,
+#   and each block is sent as soon as it is generated, over a Unix socket, a TCP port on localhost or a pipe:
+#   unix:/tmp/roc.sock, tcp:5555 (or tcp:host:port), pipe:/path/to/fifo, or - (stdout/stdin)
+# the producer never holds more than --queue blocks:
+#   blocks are generated in a thread while the previous ones are sent,
+#   and generation waits while the consumer is not reading (backpressure, through the transport buffer)
+# --rate paces the stream to a number of BXs per second (default: as fast as the consumer reads)
+# --passes runs the same settings again (0: until interrupted), with CLK_N continuing from the previous pass
+#   and, with --new-seed, the seed increased in each pass (other random L1As and MC events)
+#
+# formats (--format):
+#   csv: the same bytes as the CSV pattern file (description, then the rows), so a saved stream is the pattern file
+#   binary: STREAM_MAGIC + 4 bytes header length (little-endian uint32) + JSON header (description, channels, fast command codes),
+#     then for each block a BLOCK_HEADER (number of BXs, links, first CLK_N), the eRx words as little-endian uint32 (BX, links)
+#     and the uint8 fast command codes (BX,); a block with 0 BXs ends the stream
+#
+# the stand-in consumer (--listen) reads one stream, checks that the CLK_N are consecutive, and reports the BX rate;
+#   --block-delay slows it down, to see the backpressure on the producer, and --save writes the stream received to a file
+#
+#   python3 rocStream.py --listen unix:/tmp/roc.sock &
+#   python3 rocStream.py --connect unix:/tmp/roc.sock -N 356400 --bcr --sequence random --format binary --rate 1e6 --passes 0
+#   python3 rocStream.py --connect - -N 10692 --bcr --sequence random | python3 rocStream.py --listen - --save rocData/stream.csv
+#
+###############################################
+
+STREAM_MAGIC = b'ROCSTR01'
+BLOCK_HEADER = np.dtype([('num_bx','<u4'),('links','<u4'),('clk','<u8')])
+
+def parse_address(address):
+    """
+    (transport, address) of unix:PATH, tcp:PORT or tcp:HOST:PORT (localhost by default), pipe:PATH or - (stdout/stdin)
+    """
+    if address=='-':
+        return 'pipe','-'
+    transport,_,location = address.partition(':')
+    if transport=='unix' and location:
+        return 'unix',location
+    if transport=='pipe' and location:
+        return 'pipe',location
+    if transport=='tcp' and location:
+        host,_,port = location.rpartition(':')
+        return 'tcp',(host or 'localhost',int(port))
+    raise ValueError(f'Unknown address {address} (expected unix:PATH, tcp:PORT, tcp:HOST:PORT, pipe:PATH or -)')
+
+async def open_writer(address):
+    """StreamWriter to the consumer at this address"""
+    transport,location = parse_address(address)
+    if transport=='unix':
+        reader,writer = await asyncio.open_unix_connection(location)
+        return writer
+    if transport=='tcp':
+        reader,writer = await asyncio.open_connection(*location)
+        return writer
+
+    loop = asyncio.get_running_loop()
+    if location=='-':
+        # the stream takes the stdout file descriptor (log messages are written to stderr)
+        pipe = os.fdopen(os.dup(sys.stdout.fileno()),'wb')
+    else:
+        pipe = await asyncio.to_thread(open,location,'wb')
+    pipe_transport,protocol = await loop.connect_write_pipe(lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),pipe)
+    return asyncio.StreamWriter(pipe_transport,protocol,None,loop)
+
+def stream_header(args,description,links):
+    """start of a binary stream: magic, header length and JSON header"""
+    header = {'version': 1,
+              'channels': ['RESET_B','SOFT_RESET_B']+['ERX_%i'%i for i in range(links)]+['FAST_CMD'],
+              'links': links,
+              'fast_commands': sim.FASTCMD_LIST,
+              'description': description,
+              'N': args.N, 'bx_start': args.bx_start, 'delay': args.delay, 'bcr': args.bcr, 'block_size': args.block_size,
+              }
+    header_bytes = json.dumps(header).encode()
+    return STREAM_MAGIC + np.uint32(len(header_bytes)).astype('<u4').tobytes() + header_bytes
+
+def encode_block(clk,words,codes,outputFormat,first=False):
+    """bytes of one block of BXs: CSV rows (with a newline before all blocks but the first), or block header, words and codes"""
+    if outputFormat=='csv':
+        rows = format_csv_block(clk,words,codes,fast_command_names=sim.FASTCMD_LIST)
+        return rows if first else b'\n'+rows
+    header = np.zeros(1,dtype=BLOCK_HEADER)
+    header['num_bx'] = len(clk)
+    header['links'] = words.shape[1]
+    header['clk'] = clk[0] if len(clk)>0 else 0
+    return header.tobytes() + np.ascontiguousarray(words,dtype='<u4').tobytes() + np.asarray(codes,dtype=np.uint8).tobytes()
+
+def prepare_pass(args,metrics):
+    """
+    fast commands, dataset and readout schedule of one pass
+    returns the description, the number of BXs and the generator of the blocks (vectorized engine)
+    """
+    with metrics.stage('fast_commands'):
+        fast_commands,L1a_name,num_events = sim.build_fast_commands(args)
+    with metrics.stage('dataset'):
+        packets = sim.make_dataset(args,num_events)
+    with metrics.stage('schedule'):
+        reads,num_bx,counters = sim.schedule_readout(fast_commands,args,metrics)
+    sim.fast_command_metrics(metrics,fast_commands,args.bx_start)
+
+    description = sim.eportRX_description(args,num_bx,counters['event'],L1a_name,sim.CHANNELS)
+    blocks = sim.iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,args.block_size,metrics=metrics)
+    return description,max(0,num_bx-args.bx_start),blocks
+
+async def generate_blocks(args,queue,metrics,passes=1,new_seed=False):
+    """
+    put the blocks of each pass in the queue (waiting while it is full), and None at the end
+      generation runs in a thread, so the event loop keeps sending the previous blocks
+    """
+    offset = 0
+    i_pass = 0
+    try:
+        while passes==0 or i_pass<passes:
+            pass_args = argparse.Namespace(**vars(args))
+            if new_seed:
+                pass_args.seed = args.seed+i_pass
+            description,num_rows,blocks = await asyncio.to_thread(prepare_pass,pass_args,metrics)
+            if i_pass==0:
+                await queue.put(description)
+            while True:
+                block = await asyncio.to_thread(next,blocks,None)
+                if block is None:
+                    break
+                clk,data,codes = block
+                await queue.put((clk+offset,data,codes))
+            log.info(f'Pass {i_pass} generated: {num_rows} BXs from CLK_N {offset+args.bx_start}')
+            offset += num_rows
+            i_pass += 1
+    except Exception as e:
+        # raised again by the sender
+        await queue.put(e)
+        return
+    await queue.put(None)
+
+async def end_stream(writer,outputFormat):
+    """end block of a binary stream (nothing for CSV, which ends when the connection is closed)"""
+    if outputFormat=='binary':
+        writer.write(encode_block(np.zeros(0,dtype=np.int64),np.zeros((0,sim.NELINKS),dtype=np.uint32),np.zeros(0,dtype=np.uint8),'binary'))
+    await writer.drain()
+
+async def produce(args,address,rate=None,passes=1,new_seed=False,queue_size=4,metrics=None):
+    """
+    Stream the BXs generated with the arguments of simulateInputECOND.py to the consumer at this address
+    rate: BXs per second (None: as fast as the consumer reads)
+    passes: number of runs with these settings, one after the other (0: until interrupted or until the consumer closes the connection)
+    new_seed: increase the seed in each pass
+    queue_size: number of blocks generated ahead of the one being sent
+    returns the RunMetrics of the stream (stage timers, BXs/blocks/bytes sent)
+      backpressure is the time spent waiting for the consumer, pace the time waiting for the target rate
+    """
+    metrics = RunMetrics() if metrics is None else metrics
+    queue = asyncio.Queue(maxsize=queue_size)
+    # connected first: with -, log messages of the generation already go to stderr
+    writer = await open_writer(address)
+    generator = asyncio.create_task(generate_blocks(args,queue,metrics,passes,new_seed))
+
+    loop = asyncio.get_running_loop()
+    start = None
+    sent_bx = 0
+    try:
+        description = await queue.get()
+        if isinstance(description,Exception):
+            raise description
+        if args.outputFormat=='csv':
+            writer.write(description.encode())
+        else:
+            writer.write(stream_header(args,description,sim.NELINKS))
+
+        while True:
+            block = await queue.get()
+            if block is None:
+                break
+            if isinstance(block,Exception):
+                raise block
+            clk,data,codes = block
+            if start is None:
+                start = loop.time()
+
+            if rate:
+                wait = start + sent_bx/rate - loop.time()
+                if wait>0:
+                    with metrics.stage('pace'):
+                        await asyncio.sleep(wait)
+                else:
+                    metrics.count('late_blocks')
+
+            payload = encode_block(clk,data,codes,args.outputFormat,first=(sent_bx==0))
+            writer.write(payload)
+            with metrics.stage('backpressure'):
+                await writer.drain()
+            sent_bx += len(clk)
+            metrics.count('bx_sent',len(clk))
+            metrics.count('blocks_sent')
+            metrics.count('bytes_sent',len(payload))
+
+        await end_stream(writer,args.outputFormat)
+    except asyncio.CancelledError:
+        # interrupted (e.g. end of a soak run): the stream still ends with the end block
+        await end_stream(writer,args.outputFormat)
+        raise
+    except (BrokenPipeError,ConnectionResetError):
+        log.warning('The consumer closed the connection')
+    finally:
+        generator.cancel()
+        if start is not None:
+            metrics.add_time('stream',loop.time()-start)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (BrokenPipeError,ConnectionResetError):
+            pass
+    return metrics
+
+def log_stream_metrics(metrics):
+    counters = metrics.counters
+    seconds = metrics.timers.get('stream',0.)
+    log.info(f"Sent {counters.get('bx_sent',0)} BXs in {counters.get('blocks_sent',0)} blocks ({counters.get('bytes_sent',0)/1e6:.1f} MB) in {seconds:.2f} s"
+             f" ({counters.get('bx_sent',0)/max(seconds,1e-9):.0f} BX/s), {counters.get('l1a',0)} L1As generated")
+    log.info('Time waiting for the consumer: %.2f s, for the target rate: %.2f s, late blocks: %i'%(
+        metrics.timers.get('backpressure',0.),metrics.timers.get('pace',0.),counters.get('late_blocks',0)))
+
+###############################################
+# Stand-in consumer
+###############################################
+
+async def open_reader(address,handler):
+    """run handler(reader) on the first connection (or on the pipe) at this address"""
+    transport,location = parse_address(address)
+    if transport=='pipe':
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        pipe = sys.stdin.buffer if location=='-' else await asyncio.to_thread(open,location,'rb')
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),pipe)
+        return await handler(reader)
+
+    done = asyncio.get_running_loop().create_future()
+    async def on_connection(reader,writer):
+        try:
+            done.set_result(await handler(reader))
+        except Exception as e:
+            done.set_exception(e)
+        finally:
+            writer.close()
+    if transport=='unix':
+        if os.path.exists(location):
+            os.remove(location)
+        server = await asyncio.start_unix_server(on_connection,location)
+    else:
+        server = await asyncio.start_server(on_connection,*location)
+    log.info(f'Waiting for a stream on {address}')
+    async with server:
+        result = await done
+    if transport=='unix':
+        os.remove(location)
+    return result
+
+async def consume(address,block_delay=0.,save=None):
+    """
+    Read one stream (CSV or binary) from the producer at this address
+    block_delay: seconds to wait after each block (or chunk of CSV rows), to emulate a slow consumer
+    save: file to write the stream received to (a CSV stream is the pattern file)
+    returns a dict with the number of BXs, blocks, bytes and L1As received, the CLK_N gaps, the time,
+      and whether the end block was received (binary)
+    """
+    async def handler(reader):
+        result = {'format':None, 'bx':0, 'blocks':0, 'bytes':0, 'l1a':0, 'clk_gaps':0, 'first_clk':None, 'last_clk':None, 'complete':False}
+        output = open(save,'wb') if save else None
+        start = time.perf_counter()
+
+        def received(data):
+            result['bytes'] += len(data)
+            if output is not None:
+                output.write(data)
+
+        magic = await reader.read(len(STREAM_MAGIC))
+        received(magic)
+        if magic==STREAM_MAGIC:
+            result['format'] = 'binary'
+            length = await reader.readexactly(4)
+            header = await reader.readexactly(int(np.frombuffer(length,dtype='<u4')[0]))
+            received(length+header)
+            l1a_code = json.loads(header)['fast_commands'].index(sim.CMD_L1A)
+            while True:
+                try:
+                    block_header = await reader.readexactly(BLOCK_HEADER.itemsize)
+                    received(block_header)
+                    block = np.frombuffer(block_header,dtype=BLOCK_HEADER)[0]
+                    num_bx,links,clk = int(block['num_bx']),int(block['links']),int(block['clk'])
+                    if num_bx==0:
+                        result['complete'] = True
+                        break
+                    payload = await reader.readexactly(num_bx*(4*links+1))
+                except asyncio.IncompleteReadError:
+                    log.warning('The stream ended before its end block')
+                    break
+                received(payload)
+                codes = np.frombuffer(payload,dtype=np.uint8,offset=4*links*num_bx)
+                if result['last_clk'] is not None and clk!=result['last_clk']+1:
+                    result['clk_gaps'] += 1
+                if result['first_clk'] is None:
+                    result['first_clk'] = clk
+                result['last_clk'] = clk+num_bx-1
+                result['bx'] += num_bx
+                result['blocks'] += 1
+                result['l1a'] += int(np.count_nonzero(codes==l1a_code))
+                if block_delay>0:
+                    await asyncio.sleep(block_delay)
+        else:
+            # CSV: count the rows (lines not starting with #) in the complete lines received,
+            #   the stream has no newline after the last row
+            result['format'] = 'csv'
+            rest = magic
+            while True:
+                data = await reader.read(1<<16)
+                received(data)
+                lines = rest+data
+                cut = lines.rfind(b'\n')+1 if data else len(lines)
+                complete,rest = lines[:cut],lines[cut:]
+                num_lines = complete.count(b'\n') + (1 if not data and complete else 0)
+                result['bx'] += num_lines - complete.startswith(b'#') - complete.count(b'\n#')
+                result['l1a'] += complete.count(b','+sim.CMD_L1A.encode()+b'\n') + (1 if not data and complete.endswith(b','+sim.CMD_L1A.encode()) else 0)
+                if not data:
+                    result['complete'] = result['bytes']>0
+                    break
+                result['blocks'] += 1
+                if block_delay>0:
+                    await asyncio.sleep(block_delay)
+
+        if output is not None:
+            output.close()
+        result['seconds'] = time.perf_counter()-start
+        return result
+
+    return await open_reader(address,handler)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Stream the generated BXs to a local consumer, or run the stand-in consumer (--listen); other arguments are the ones of simulateInputECOND.py', allow_abbrev=False)
+    parser.add_argument('--connect', type=str, default=None, dest="connect", help="Address of the consumer: unix:PATH, tcp:PORT, tcp:HOST:PORT, pipe:PATH or - (stdout)")
+    parser.add_argument('--listen', type=str, default=None, dest="listen", help="Run the stand-in consumer, reading one stream at this address (- for stdin)")
+    parser.add_argument('--rate', type=float, default=None, dest="rate", help="Target number of BXs per second (default: as fast as the consumer reads)")
+    parser.add_argument('--passes', type=int, default=1, dest="passes", help="Number of runs streamed one after the other (0: until interrupted, default: 1)")
+    parser.add_argument('--new-seed', action='store_true', default=False, dest="new_seed", help="Increase the seed in each pass")
+    parser.add_argument('--queue', type=int, default=4, dest="queue", help="Number of blocks generated ahead of the one being sent (default: 4)")
+    parser.add_argument('--block-delay', type=float, default=0., dest="block_delay", help="Consumer: seconds to wait after each block (emulates a slow consumer)")
+    parser.add_argument('--save', type=str, default=None, dest="save", help="Consumer: write the stream received to this file")
+    stream_args,remaining = parser.parse_known_args()
+
+    if stream_args.listen is not None:
+        setup_logging()
+        result = asyncio.run(consume(stream_args.listen,stream_args.block_delay,stream_args.save))
+        log.info(f"Received {result['bx']} BXs ({result['format']}{'' if result['complete'] else ', incomplete'}) in {result['blocks']} blocks"
+                 f" ({result['bytes']/1e6:.1f} MB) in {result['seconds']:.2f} s ({result['bx']/max(result['seconds'],1e-9):.0f} BX/s),"
+                 f" {result['l1a']} L1As, {result['clk_gaps']} CLK_N gaps")
+        sys.exit(1 if result['clk_gaps']>0 or not result['complete'] else 0)
+
+    if stream_args.connect is None:
+        parser.error('--connect or --listen is required')
+    args = sim.make_parser().parse_args(remaining)
+    args = sim.readConfigFromFile(args)
+    setup_logging(args.logLevel)
+
+    metrics = RunMetrics()
+    try:
+        asyncio.run(produce(args,stream_args.connect,stream_args.rate,stream_args.passes,stream_args.new_seed,stream_args.queue,metrics))
+    except KeyboardInterrupt:
+        log.info('Stream interrupted')
+    log_stream_metrics(metrics)
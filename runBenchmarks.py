@@ -0,0 +1,313 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import simulateInputECOND as sim
+from runScenarios import scenario_args
+from patternIO import CSVPatternWriter,BinaryPatternWriter
+from rocMetrics import log_level
+
+###############################################
+# Benchmarks of each stage of the emulator, with synthetic inputs (no EOS ntuple needed)
+###############################################
+#
+# scenarios: sizes from 1 orbit to 10^7 BXs, with formatted, zero and physics data, with and without ECR/EBR/LinkReset
+#   (L1As at 750 kHz, poisson sequence), MC data from a small ROOT file written locally (if uproot is installed)
+#   or from a synthetic (entries, 12, 37) array of MC-like words
+# stages: fast_commands (L1As and other fast commands), loadMCData (reading the ntuple, physics data from ROOT only),
+#   dataset (packets of all L1As), schedule (readout of each event), fill (eRx words of all BXs),
+#   csv/binary (fill, format and write the output file),
+#   loop (loop engine, the default of simulateInputECOND.py: fast commands, dataset and BX loop, without writing; only up to LOOP_MAX_BX BXs)
+# for each stage: time, BX/s, events/s, and peak memory (from tracemalloc, in a second pass so that it does not slow down the timing)
+# results are written as JSON (by default benchmarks/<commit>.json), and can be compared to a baseline from another commit:
+#   python3 runBenchmarks.py --suite quick
+#   python3 runBenchmarks.py --suite quick --compare benchmarks/<commit>.json
+#
+###############################################
+
+ORBIT = sim.ORBITLAST
+
+SUITES = {'quick': [ORBIT, 100000],
+          'full': [ORBIT, 100000, 1000000, 10000000],
+          }
+MODES = ['formatted','zero','physics']
+
+# wafer of the synthetic MC data (default of simulateInputECOND.py), and a neighbour which is not selected
+MC_WAFER = (0,1,5,3,1)
+MC_OTHER_WAFER = (0,1,5,4,2)
+MC_ENTRIES = 200
+
+# largest scenario run with the loop engine (about 2.5 s for 10^5 BXs)
+LOOP_MAX_BX = 100000
+
+# stages shorter than this are not flagged as regressions (timing noise)
+MIN_SECONDS = 0.05
+
+def make_scenarios(sizes,modes,resets=(False,True)):
+    """configurations (as in runScenarios.py) of each size, data mode, and with/without resets"""
+    scenarios = []
+    for N in sizes:
+        for mode in modes:
+            for with_resets in resets:
+                config = {'name': f'{mode}_{N}'+('_resets' if with_resets else ''),
+                          'N': N, 'bcr': True, 'sequence': 'poisson', 'L1a_freq': '53.44',
+                          'zerodata': mode=='zero', 'physicsdata': mode=='physics'}
+                if with_resets:
+                    config.update(ecr=True, ecrBX=str(N//4), ebr=True, ebrBX=str(N//2), linkresetrocdBX=str(3*N//4))
+                scenarios.append(config)
+    return scenarios
+
+def synthetic_words(rng,shape):
+    """MC-like 32 bit words: isTOT (1b) + tp (1b) + adc BX-1 (10b) + adc/tot (10b) + toa (10b), as in getElinkInputDataFromMC.formatData"""
+    isTOT = (rng.random(shape)<0.1).astype(np.int64)
+    tp = (rng.random(shape)<0.1).astype(np.int64)
+    toa = np.where(rng.random(shape)<0.6,0,rng.integers(0,1024,shape))
+    return ((isTOT<<31) + (tp<<30) + (rng.integers(0,1024,shape)<<20) + (rng.integers(0,1024,shape)<<10) + toa).astype(np.uint32)
+
+def synthetic_mc_data(num_entries=MC_ENTRIES,seed=1):
+    """dense (entries, 12, 37) array of MC-like words and the entry numbers, as returned by load_mc_data"""
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    return synthetic_words(rng,(num_entries,sim.NELINKS,37)), pd.Index(np.arange(num_entries), name='entry')
+
+def make_synthetic_ntuple(fName,num_entries=MC_ENTRIES,seed=1):
+    """small ntuple with the branches read by getElinkInputDataFromMC, with 70% of the cells of two wafers in each entry"""
+    import pandas as pd
+    import awkward as ak
+    import uproot
+
+    rng = np.random.default_rng(seed)
+    cellMap = pd.read_csv('geomInfo/eLinkInputMapFull.csv')
+    branches = {k:[] for k in ['subdet','zside','layer','waferu','waferv','cellu','cellv','wafertype','data_BX1','isadc_BX1','data_BX2','isadc_BX2','toa_BX2']}
+    counts = np.zeros(num_entries,dtype=np.int64)
+    for wafer,wafertype in [(MC_WAFER,0),(MC_OTHER_WAFER,1)]:
+        cells = cellMap[(cellMap.HDM==(wafertype==0)) & (cellMap.cellu>=0)][['cellu','cellv']].values
+        keep = rng.random((num_entries,len(cells)))<0.7
+        counts += keep.sum(axis=1)
+        entry,cell = np.nonzero(keep)
+        n = len(entry)
+        columns = dict(zip(['subdet','zside','layer','waferu','waferv'],[np.full(n,x) for x in wafer]))
+        columns.update(cellu=cells[cell,0], cellv=cells[cell,1], wafertype=np.full(n,wafertype),
+                       data_BX1=rng.integers(0,1024,n), isadc_BX1=(rng.random(n)<0.9).astype(int),
+                       data_BX2=rng.integers(0,1024,n), isadc_BX2=(rng.random(n)<0.9).astype(int),
+                       toa_BX2=np.where(rng.random(n)<0.6,-1,rng.integers(0,1024,n)))
+        for k in branches:
+            branches[k].append((entry,columns[k]))
+
+    # digis of both wafers, grouped by entry
+    tree = {}
+    for k,parts in branches.items():
+        entry = np.concatenate([p[0] for p in parts])
+        values = np.concatenate([p[1] for p in parts]).astype(np.int32)
+        tree['hgcdigi_'+k] = ak.unflatten(values[np.argsort(entry,kind='stable')],counts)
+    with uproot.recreate(fName) as _file:
+        _file['hgcalTriggerNtuplizer/HGCalTriggerNtuple'] = tree
+    return fName
+
+def make_mc_input(output_dir,mc='auto'):
+    """
+    ROOT file with synthetic MC data, or None to use the synthetic array
+      auto: ROOT file if it can be written and read back (uproot/awkward installed, in versions supported by getElinkInputDataFromMC)
+    """
+    if mc=='array':
+        return None
+    fName = os.path.join(output_dir,'ntuple.root')
+    try:
+        make_synthetic_ntuple(fName)
+        from getElinkInputDataFromMC import loadMCData
+        with log_level('warning'):
+            loadMCData(fName, **dict(zip(['subdet','zside','layer','waferu','waferv'],MC_WAFER)), maxEvents=1, returnArray=True)
+    except Exception as e:
+        if mc=='root':
+            raise
+        print(f'Cannot read a ROOT file ({type(e).__name__}: {e}), using synthetic MC data in memory')
+        return None
+    return fName
+
+def commit_id():
+    """short hash of the current commit (with +dirty for local changes), or 'unknown' outside of a git checkout"""
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],cwd=directory,capture_output=True,text=True,check=True).stdout.strip()
+        dirty = subprocess.run(['git','status','--porcelain','--untracked-files=no'],cwd=directory,capture_output=True,text=True).stdout.strip()
+        return commit+('+dirty' if dirty else '')
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+class StageTimer:
+    """
+    time (and, with measure_memory, peak memory above the memory at the start) of each stage of a scenario
+      the peak memory counts the allocations traced by tracemalloc (python objects and numpy arrays)
+    """
+    def __init__(self,measure_memory=False):
+        self.measure_memory = measure_memory
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        if self.measure_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.stages[name] = {'seconds': time.perf_counter()-start}
+        if self.measure_memory:
+            self.stages[name]['peak_MB'] = (tracemalloc.get_traced_memory()[1]-start_memory)/1024/1024
+
+def run_stages(config,mc_input,output_dir,measure_memory=False,loop_max_bx=LOOP_MAX_BX):
+    """
+    run the stages of one scenario
+    mc_input: ROOT file for physics data, or None to use the synthetic array
+    loop_max_bx: run the loop engine only for scenarios up to this number of BXs
+    returns the StageTimer, the number of BXs and of events
+    """
+    args = scenario_args(config)
+    args.mcCacheDir = ''
+    timer = StageTimer(measure_memory)
+
+    with log_level('warning'):
+        with timer.stage('fast_commands'):
+            fast_commands,L1a_name,num_events = sim.build_fast_commands(args)
+
+        if args.physicsdata:
+            # MC data is kept in memory by load_mc_data, so the ntuple is read in its own stage
+            sim._mc_data.clear()
+            if mc_input is None:
+                args.mcMaxEvents = MC_ENTRIES
+                sim._mc_data[(args.fname,MC_WAFER,args.mcEntryStart,MC_ENTRIES)] = synthetic_mc_data()
+            else:
+                args.fname = mc_input
+                with timer.stage('loadMCData'):
+                    sim.load_mc_data(args,args.mcMaxEvents)
+
+        with timer.stage('dataset'):
+            packets = sim.make_dataset(args,num_events)
+
+        with timer.stage('schedule'):
+            reads,num_bx,counters = sim.schedule_readout(fast_commands,args)
+
+        with timer.stage('fill'):
+            for clk,data,codes in sim.iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,args.block_size):
+                pass
+
+        description = sim.eportRX_description(args,num_bx,counters['event'],L1a_name,sim.CHANNELS)
+        meta = {'N':args.N, 'bx_start':args.bx_start, 'delay':args.delay, 'bcr':args.bcr}
+        writers = {'csv': lambda: CSVPatternWriter(os.path.join(output_dir,'benchmark.csv'),description,sim.FASTCMD_LIST),
+                   'binary': lambda: BinaryPatternWriter(os.path.join(output_dir,'benchmark.bin'),max(0,num_bx-args.bx_start),description,sim.FASTCMD_LIST,sim.CHANNELS,meta)}
+        for name,make_writer in writers.items():
+            with timer.stage(name):
+                with make_writer() as writer:
+                    for clk,data,codes in sim.iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,args.block_size):
+                        writer.write_block(clk,data,codes)
+
+        if args.N<=loop_max_bx:
+            with timer.stage('loop'):
+                sim.run_loop_engine(args)
+
+    sim._mc_data.clear()
+    return timer,num_bx-args.bx_start,num_events
+
+def run_benchmark(config,mc_input,output_dir,repeat=1,measure_memory=True,loop_max_bx=LOOP_MAX_BX):
+    """time of each stage (best of repeat runs), with BX/s, events/s and peak memory"""
+    runs = [run_stages(config,mc_input,output_dir,loop_max_bx=loop_max_bx) for i in range(repeat)]
+    num_bx,num_events = runs[0][1],runs[0][2]
+    stages = {name:{'seconds': min(run[0].stages[name]['seconds'] for run in runs)} for name in runs[0][0].stages}
+
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            timer = run_stages(config,mc_input,output_dir,measure_memory=True,loop_max_bx=loop_max_bx)[0]
+        finally:
+            tracemalloc.stop()
+        for name,result in timer.stages.items():
+            stages[name]['peak_MB'] = round(result['peak_MB'],2)
+
+    for result in stages.values():
+        seconds = max(result['seconds'],1e-9)
+        result['bx_per_s'] = float(num_bx/seconds)
+        result['events_per_s'] = float(num_events/seconds)
+
+    return {'name': config['name'], 'N': config['N'], 'num_bx': int(num_bx), 'num_events': int(num_events), 'config': config, 'stages': stages}
+
+def compare(results,baseline,threshold=1.25):
+    """
+    print the time of each stage relative to the baseline
+    returns the list of (scenario, stage, ratio) slower than threshold
+    """
+    reference = {r['name']:r for r in baseline['results']}
+    regressions = []
+    print(f"Compared to {baseline['commit']} ({baseline['date']}):")
+    for r in results:
+        if not r['name'] in reference:
+            continue
+        for stage,result in r['stages'].items():
+            if not stage in reference[r['name']]['stages']:
+                continue
+            before = reference[r['name']]['stages'][stage]['seconds']
+            ratio = result['seconds']/max(before,1e-9)
+            flag = ''
+            if ratio>threshold and result['seconds']>MIN_SECONDS:
+                regressions.append((r['name'],stage,ratio))
+                flag = '  SLOWER'
+            print(f"  {r['name']:30s} {stage:14s} {before:9.3f} s -> {result['seconds']:9.3f} s  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the emulator on synthetic inputs')
+    parser.add_argument('--suite', type=str, default='quick', choices=list(SUITES), dest="suite", help="Scenario sizes: quick (1 orbit, 10^5 BXs) or full (up to 10^7 BXs)")
+    parser.add_argument('--sizes', type=str, default=None, dest="sizes", help="Comma separated list of sizes (BXs), instead of the suite")
+    parser.add_argument('--modes', type=str, default=','.join(MODES), dest="modes", help="Comma separated list of data modes (formatted,zero,physics)")
+    parser.add_argument('--mc', type=str, default='auto', choices=['auto','root','array'], dest="mc", help="MC data for physics mode: small local ROOT file (root, needs uproot), synthetic array, or root if the ROOT file can be read (auto)")
+    parser.add_argument('--repeat', type=int, default=1, dest="repeat", help="Number of timed runs of each scenario (the fastest is kept)")
+    parser.add_argument('--no-memory', action='store_false', default=True, dest="memory", help="Do not measure the peak memory of each stage (skips the tracemalloc pass)")
+    parser.add_argument('--loop-max-bx', type=int, default=LOOP_MAX_BX, dest="loop_max_bx", help=f"Run the loop engine for scenarios up to this number of BXs (default: {LOOP_MAX_BX}, 0: never)")
+    parser.add_argument('--output', type=str, default=None, dest="output", help="JSON file of the results (default: benchmarks/<commit>.json)")
+    parser.add_argument('--compare', type=str, default=None, dest="compare", help="JSON results of a previous run to compare to")
+    parser.add_argument('--threshold', type=float, default=1.25, dest="threshold", help="Flag stages slower than the baseline by more than this factor (default: 1.25)")
+    bench_args = parser.parse_args()
+
+    sizes = [int(x) for x in bench_args.sizes.split(',')] if bench_args.sizes else SUITES[bench_args.suite]
+    scenarios = make_scenarios(sizes,bench_args.modes.split(','))
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        mc_input = make_mc_input(output_dir,bench_args.mc) if 'physics' in bench_args.modes else None
+
+        results = []
+        for config in scenarios:
+            results.append(run_benchmark(config,mc_input,output_dir,bench_args.repeat,bench_args.memory,bench_args.loop_max_bx))
+            r = results[-1]
+            print(f"{r['name']:30s} {r['num_bx']:9d} BXs {r['num_events']:7d} events")
+            for stage,result in r['stages'].items():
+                memory = f"{result['peak_MB']:9.1f} MB" if 'peak_MB' in result else ''
+                print(f"    {stage:14s} {result['seconds']:9.3f} s {result['bx_per_s']:12.4g} BX/s {result['events_per_s']:12.4g} events/s {memory}")
+
+    commit = commit_id()
+    report = {'commit': commit,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'mc': 'root' if mc_input else 'array',
+              'results': results,
+              }
+    output = bench_args.output or os.path.join('benchmarks',f'{commit}.json')
+    os.makedirs(os.path.dirname(output) or '.',exist_ok=True)
+    with open(output,'w') as _file:
+        json.dump(report,_file,indent=1)
+    print(f'Results written to {output}')
+
+    if bench_args.compare:
+        with open(bench_args.compare) as _file:
+            regressions = compare(results,json.load(_file),bench_args.threshold)
+        if len(regressions)>0:
+            print(f'{len(regressions)} stages slower than the baseline by more than x{bench_args.threshold}')
+            raise SystemExit(1)
@@ -0,0 +1,99 @@
+import argparse
+import io
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import simulateInputECOND as sim
+from rocMetrics import log
+
+###############################################
+# Run a batch of scenarios (e.g. all the patterns of a test campaign) in one go
+###############################################
+#
+# the batch is a JSON list of configurations, in the same format as the --config files of simulateInputECOND.py,
+#   with an optional "name" for each scenario, e.g.:
+#   [{"name": "ebr98",  "N": 10692, "bcr": true, "sequence": "fixed", "L1a_freq": "50", "nL1a": "3", "ebr": true, "ebrBX": "98"},
+#    {"name": "ebr102", "N": 10692, "bcr": true, "sequence": "fixed", "L1a_freq": "50", "nL1a": "3", "ebr": true, "ebrBX": "102"}]
+# scenarios are run in a pool of worker processes, each importing the emulator once,
+#   and the MC data used by several scenarios is loaded once (before starting the workers)
+# outputs are written in rocData with the same names as from simulateInputECOND.py
+#
+###############################################
+
+def scenario_args(config):
+    """arguments of simulateInputECOND.py (defaults, updated with the configuration)"""
+    args = sim.make_parser().parse_args([])
+    return sim.applyConfig(args,{k:v for k,v in config.items() if k!='name'},f'{config.get("name","")}')
+
+def run_scenario(config):
+    """
+    generate the pattern of one scenario
+    returns name, output file, time and log (messages of the emulator) of the scenario
+    """
+    result = {'name': config.get('name','')}
+    messages = io.StringIO()
+    handler = logging.StreamHandler(messages)
+    log.addHandler(handler)
+    start = time.time()
+    try:
+        output = sim.make_eportRX_input(scenario_args(config))
+        result['file'] = output if isinstance(output,str) else output.attrs['file_name']
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        log.removeHandler(handler)
+    result['seconds'] = time.time()-start
+    result['log'] = messages.getvalue()
+    return result
+
+def preload_mc_data(configs):
+    """load the MC data of all scenarios with physics data (when it does not depend on the number of L1As)"""
+    for config in configs:
+        args = scenario_args(config)
+        if args.physicsdata and args.mcMaxEvents!=-1:
+            sim.load_mc_data(args,args.mcMaxEvents)
+
+def run_batch(configs,jobs=1,verbose=False):
+    for i,config in enumerate(configs):
+        config.setdefault('name',f'scenario{i}')
+
+    # MC data is loaded in this process, and shared with the workers (forked after)
+    preload_mc_data(configs)
+
+    start = time.time()
+    if jobs>1:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(run_scenario,configs))
+    else:
+        results = [run_scenario(config) for config in configs]
+
+    files = [r['file'] for r in results if 'file' in r]
+    for f in set(f for f in files if files.count(f)>1):
+        print(f'Warning: {f} written by more than one scenario, only the last one is kept')
+
+    for r in results:
+        if verbose:
+            print(r['log'])
+        status = r['file'] if 'file' in r else 'FAILED '+r['error']
+        print(f"{r['name']:30s} {r['seconds']:8.2f} s  {status}")
+    print(f'{len(results)} scenarios in {time.time()-start:.2f} s')
+    return results
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Generate the patterns of a list of scenarios')
+    parser.add_argument('batch', type=str, help="JSON file with a list of configurations (same format as --config)")
+    parser.add_argument('--jobs', type=int, default=1, dest="jobs", help="Number of scenarios to run in parallel")
+    parser.add_argument('--report', type=str, default=None, dest="report", help="Write the timing of each scenario to this JSON file")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, dest="verbose", help="Print the output of each scenario")
+    batch_args = parser.parse_args()
+
+    with open(batch_args.batch) as _file:
+        configs = json.load(_file)
+
+    results = run_batch(configs,batch_args.jobs,batch_args.verbose)
+
+    if batch_args.report:
+        with open(batch_args.report,'w') as _file:
+            json.dump([{k:v for k,v in r.items() if k!='log'} for r in results],_file,indent=1)
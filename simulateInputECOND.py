@@ -1,9 +1,9 @@
 import argparse
-import pandas as pd
+import logging
 import numpy as np
 import os
-import random
 import shutil
+import time
 import warnings
 
 import glob
@@ -41,12 +41,16 @@ CMD_LINKRESETROCD = "FASTCMD_LINKRESETROCD"
 CMD_LINKRESETECOND = "FASTCMD_LINKRESETECOND"
 CMD_ALLONE = "FASTCMD_ALLONE"
 
+# code of each fast command (index in this list), in the fast command schedule and in binary outputs
+FASTCMD_LIST = [CMD_IDLE, CMD_L1A, CMD_BCR, CMD_OCR, CMD_BCROCR, CMD_ECR, CMD_EBR, CMD_LINKRESETROCD, CMD_LINKRESETECOND, CMD_ALLONE]
+FASTCMD_CODES = {cmd:code for code,cmd in enumerate(FASTCMD_LIST)}
+
 """
 DAQ words: 41 words (32 bits each)
   each word string is separated by _ and takes 1 BX to read (32 bit word: 1.8 gHz: 32* 40MHz)
   nBXs: 40BX  + IDLE_WORD = 41 BX
   HDR (header) + CM (common mode) + CH_i i:0-37 (36 channels + calibration) + CRC (checksum) + IDLE
-  HDR: 0101 + 12bit Bx# + 6bit Event# + 3bit Orbit# + 1bit H1status + 1bit H2status + 1bitH3status + 0101
+  HDR: 1111 + 12bit Bx# + 6bit Event# + 3bit Orbit# + 1bit H1status + 1bit H2status + 1bitH3status + 0101
   CM: 10 + 10bit + 10bitADC(CM0) + 10bitADC(CM1)
   IDLE: continuosly sent out when no L1A
 """
@@ -56,19 +60,55 @@ DATAWORDS += 'CRC_' + 'IDLE'
 NWORDS = len(DATAWORDS.split('_'))
 NELINKS = 12
 
+# columns of the output file
+CHANNELS = ['RESET_B', 'SOFT_RESET_B']+[f'ERX_{i}' for i in range(NELINKS)]+['FAST_CMD']
+
+# position of the place-holder words, filled in when the packet is read out
+HDR_INDEX = DATAWORDS.split('_').index('HDR')
+CM_INDEX = DATAWORDS.split('_').index('CM')
+CRC_INDEX = DATAWORDS.split('_').index('CRC')
+
 # HEX pre-defined words
 IDLEWORD_HEX = 0xaccccccc
-IDLEWORD_BC0 = '9AAAAAAA'
-IDLEWORD = 'AAAAAAAA'
+IDLEWORD_BC0 = 0x9aaaaaaa
+IDLEWORD = 0xaaaaaaaa
 ONEWORD_HEX = 0xffffffff
 
-import crcmod,codecs
-crc = crcmod.mkCrcFun(0x104c11db7,initCrc=0, xorOut=0, rev=False)
-
-def generate_L1a_fast_commands(args):
+from rocCRC import crc_words,CRC_NWORDS
+import l1aGenerator
+import rocRNG
+from rocBuffer import EventBuffer,BUFFER_FULL_POLICIES,STATUS_BUFFER_FULL,GLOBALBX,START,END,EVENT,WORDS,STATUS
+from patternIO import to_hex,open_output,format_csv_block,read_binary_pattern,CSVPatternWriter,BinaryPatternWriter
+from rocMetrics import log,set_log_level,setup_logging,LOG_LEVELS,RunMetrics,metrics_file_name,l1a_metrics
+
+# 32 bit words are kept as integers (or uint32 arrays), and only converted to hex when writing the output
+# the packing functions work on both python ints and numpy arrays
+def pack_header(bx,event,orbit,hamming=0):
+    """HDR: 1111 + 12bit Bx# + 6bit Event# + 3bit Orbit# + 3bit hamming code + 0101"""
+    return (0b1111<<28) | ((bx & 0b111111111111)<<16) | ((event & 0b111111)<<10) | ((orbit & 0b111)<<7) | ((hamming & 0b111)<<4) | 0b0101
+
+def pack_cm(cm0,cm1):
+    """CM: 00 + 10bit (0) + 10bitADC(CM0) + 10bitADC(CM1)"""
+    return ((cm0 & 0b1111111111)<<10) | (cm1 & 0b1111111111)
+
+def pack_formatted(packet_counter,link_counter,word_counter):
+    """formatted data: (4bit count + 4bit eLink (link_counter+1) + 8bit packet word) repeated twice"""
+    half = ((packet_counter & 0b1111)<<12) | (((link_counter+1) & 0b1111)<<8) | (word_counter & 0b11111111)
+    return (half<<16) | half
+
+def pack_idle(bc0):
+    """IDLE: special 0x9 header for BC0"""
+    return np.where(bc0,IDLEWORD_BC0,IDLEWORD).astype(np.uint32)
+
+def generate_L1a_fast_commands(args,veto_bxs=[]):
+    """
+    BXs with a L1A, from the sequences in args (see l1aGenerator)
+      veto_bxs: BXs of other fast commands (BCR/EBR/LinkReset), with no L1A within args.l1aVeto BXs of them
+    """
     sequences = args.sequence.split(',')
     L1a_nums = args.nL1a.split(',')
     L1a_freqs = args.L1a_freq.split(',')
+    L1a_rates = args.L1a_rate.split(',')
     L1a_startBx = args.L1aStart
     L1a_bxs = []
     L1a_counter = 0
@@ -76,212 +116,798 @@ def generate_L1a_fast_commands(args):
 
     if args.L1aBX!='':
         L1a_bxs = [int(bx) for bx in args.L1aBX.split(',')]
-        print('L1a bxs ',np.array(L1a_bxs))
+        log.info('L1a bxs %s',np.array(L1a_bxs))
         L1a_name = f'{len(L1a_bxs)}L1As-customSeq'
         return np.array(L1a_bxs),L1a_name
 
+    # L1As of each sequence, and the index of the sequence
+    sequence_index = []
+    freq_labels = []
     for i,sequence in enumerate(sequences):
         num = int(L1a_nums[i]) if (len(L1a_nums)>i and L1a_nums[i]!='') else -1
-        freq = int(L1a_freqs[i]) if (len(L1a_freqs)>i and L1a_freqs[i]!='') else 53 # default freq
+        freq = L1a_freqs[i] if (len(L1a_freqs)>i and L1a_freqs[i]!='') else '53' # default freq (~750 kHz)
+        if (len(L1a_freqs)<=i or L1a_freqs[i]=='') and len(L1a_rates)>i and L1a_rates[i]!='':
+            # rate in kHz, as a (rounded) number of BXs between L1As
+            freq = '%.4g'%l1aGenerator.freq_from_rate(float(L1a_rates[i])*1e3)
+            if sequence!='poisson':
+                freq = str(int(round(float(freq))))
         maxn = num if num>-1 else args.N
+        freq_labels.append(freq if sequence=='poisson' else str(int(freq)))
 
         bxs=[]
         if sequence=='fixed':
-            bxs = np.array([(j+1)*freq for j in range(L1a_counter,L1a_counter+maxn) if (j+1)*freq<args.N])
-            # print('fixed ',bxs,L1a_counter,L1a_counter+maxn,[(j+1)*freq for j in range(L1a_counter,L1a_counter+maxn)])
-            #0 3 100
+            bxs = l1aGenerator.fixed_sequence(L1a_counter,maxn,int(freq),args.N)
         elif sequence=='random':
-            np.random.seed(6)
-            bxs = np.random.choice(np.arange(L1a_startBx,maxn), np.random.poisson((maxn-L1a_startBx)*1./freq), replace=False)
+            bxs = l1aGenerator.random_sequence(L1a_startBx,maxn,int(freq),seed=args.seed)
+        elif sequence=='poisson':
+            rng = l1aGenerator.make_rng(args.seed,'poisson',i)
+            bxs = l1aGenerator.poisson_sequence(L1a_startBx,args.N,float(freq),num,rng)
         else:
-            print('no such sequence')
+            log.warning('no such sequence %s',sequence)
 
         if len(bxs)>0:
-            L1a_bxs.extend(bxs)
-            L1a_name += str(len(bxs)) + 'L1As-' + sequence + 'freq' + str(freq)
+            L1a_bxs.append(bxs)
+            sequence_index.append(np.full(len(bxs),i))
             L1a_counter = maxn
 
-    L1a_bxs=np.array(L1a_bxs)
-    L1a_bxs.sort()
-    print('L1a bxs ',L1a_bxs)
+    if len(L1a_bxs)==0:
+        log.info('L1a bxs %s',np.array([]))
+        return np.array([],dtype=np.int64),L1a_name
 
-    return L1a_bxs,L1a_name
+    L1a_bxs = np.concatenate(L1a_bxs)
+    sequence_index = np.concatenate(sequence_index)
+    order = np.argsort(L1a_bxs,kind='stable')
+    L1a_bxs,sequence_index = L1a_bxs[order],sequence_index[order]
+
+    # drop L1As close to other fast commands, then the ones that do not pass the trigger rules
+    if args.l1aVeto!='':
+        before,after = [int(x) for x in args.l1aVeto.split(',')]
+        accepted = l1aGenerator.apply_vetoes(L1a_bxs,veto_bxs,before,after)
+        L1a_bxs,sequence_index = L1a_bxs[accepted],sequence_index[accepted]
+    accepted = l1aGenerator.apply_trigger_rules(L1a_bxs,l1aGenerator.parse_trigger_rules(args.triggerRules))
+    L1a_bxs,sequence_index = L1a_bxs[accepted],sequence_index[accepted]
 
-def count_bx(i,fast_command):
-    bx_counter = i%ORBITLAST + 1
-    if fast_command==CMD_BCR or fast_command==(CMD_BCROCR): bx_counter = ORBITBCR-1
-    return bx_counter
+    for i,n in enumerate(np.bincount(sequence_index,minlength=len(sequences))):
+        if n>0:
+            L1a_name += str(n) + 'L1As-' + sequences[i] + 'freq' + freq_labels[i]
+    log.info('L1a bxs %s',L1a_bxs)
 
-def count_orbit(i,fast_command):
-    orbit_counter = int(i/ORBITLAST)
-    if fast_command==CMD_BCROCR or fast_command==CMD_OCR: orbit_counter = 0
-    return orbit_counter
+    return L1a_bxs,L1a_name
 
-def generate_fast_commands(args):
+def fast_command_names(codes):
+    """CMD_* names of an array of fast command codes (only used when writing the output)"""
+    return np.array(FASTCMD_LIST,dtype='object')[codes]
+
+class FastCommandSchedule:
+    """
+    Fast command sent in each of N BXs, as uint8 codes (index in FASTCMD_LIST)
+      1 byte per BX, with the BXs that have a fast command (not IDLE) kept as a sparse list for event-driven loops
+    """
+    def __init__(self,N):
+        self.codes = np.zeros(N,dtype=np.uint8)
+        self._positions = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self,globalBX):
+        """name of the fast command in this BX"""
+        return FASTCMD_LIST[self.codes[globalBX]]
+
+    def set(self,bxs,command):
+        self.codes[np.asarray(bxs,dtype=np.int64)] = FASTCMD_CODES[command]
+        self._positions = None
+
+    def positions(self,*commands):
+        """sorted BXs with a fast command (only these commands, if given)"""
+        if self._positions is None:
+            self._positions = np.flatnonzero(self.codes!=FASTCMD_CODES[CMD_IDLE])
+        if len(commands)==0:
+            return self._positions
+        selected = np.isin(self.codes[self._positions],[FASTCMD_CODES[cmd] for cmd in commands])
+        return self._positions[selected]
+
+    def codes_at(self,globalBX):
+        """fast command codes in these BXs (IDLE after the last BX of the schedule)"""
+        globalBX = np.asarray(globalBX)
+        codes = np.full(globalBX.shape,FASTCMD_CODES[CMD_IDLE],dtype=np.uint8)
+        is_generated = globalBX<len(self.codes)
+        codes[is_generated] = self.codes[globalBX[is_generated]]
+        return codes
+
+    def counters(self,globalBX,bx_start=0):
+        """
+        BX and orbit counters in these BXs (from bx_start, where the BX counter starts at bx_start%ORBITLAST)
+          the BX counter is set to ORBITBCR on a BCR, and rolls over at ORBITLAST, increasing the orbit counter
+          the orbit counter is set to 0 on an OCR
+        """
+        globalBX = np.asarray(globalBX,dtype=np.int64)
+        bcr_bxs = self.positions(CMD_BCR,CMD_BCROCR)
+        bcr_bxs = bcr_bxs[bcr_bxs>=bx_start]
+        reset_bxs = np.concatenate([[bx_start],bcr_bxs])
+        reset_vals = np.concatenate([[bx_start%ORBITLAST],np.full(len(bcr_bxs),ORBITBCR)])
+
+        # number of roll overs of the BX counter up to each BX: before the last BCR, and since the last BCR
+        rollovers = np.concatenate([[0],np.cumsum((reset_vals[:-1]+np.diff(reset_bxs))//ORBITLAST)])
+        def count(bxs):
+            i_reset = np.searchsorted(reset_bxs,bxs,side='right')-1
+            bx_counter = reset_vals[i_reset] + bxs - reset_bxs[i_reset]
+            return bx_counter%ORBITLAST, rollovers[i_reset] + bx_counter//ORBITLAST
+
+        bx,orbit = count(globalBX)
+
+        ocr_bxs = self.positions(CMD_OCR,CMD_BCROCR)
+        ocr_bxs = ocr_bxs[ocr_bxs>=bx_start]
+        if len(ocr_bxs)>0:
+            i_ocr = np.searchsorted(ocr_bxs,globalBX,side='right')-1
+            orbit_at_ocr = np.concatenate([[0],count(ocr_bxs)[1]])
+            orbit = orbit - orbit_at_ocr[i_ocr+1]
+        return bx,orbit
+
+def build_fast_commands(args):
     N = args.N
 
-    fast_commands = np.array([CMD_IDLE] * N, dtype='object')
+    fast_commands = FastCommandSchedule(N)
 
     bcr_bxs=[]
     if args.bcr:
         # assume bcr sent at BX=3513
-        bcr_bxs = [i for i in range(len(fast_commands)) if i%ORBITLAST==ORBITBCR]
+        bcr_bxs = list(range(ORBITBCR,N,ORBITLAST))
         # extra bcrs
         if args.extra_bcr:
             bcr_bxs += [2000]
         # missing bcrs
         if args.missing_bcr:
             bcr_bxs.pop(0)
-        print('Issuing BCR in BX:',bcr_bxs)
-        fast_commands[bcr_bxs] = CMD_BCR
+        log.info('Issuing BCR in BX: %s',bcr_bxs)
+        fast_commands.set(bcr_bxs,CMD_BCR)
 
     if not args.linkresetrocdBX=="":
         LinkResetROCD_bx=[int(bx) for bx in args.linkresetrocdBX.split(',')]
-        fast_commands[LinkResetROCD_bx]=CMD_LINKRESETROCD
-        print('Issuing LinkResetROCD in BX:',LinkResetROCD_bx)
+        fast_commands.set(LinkResetROCD_bx,CMD_LINKRESETROCD)
+        log.info('Issuing LinkResetROCD in BX: %s',LinkResetROCD_bx)
 
     if not args.linkresetecondBX=="":
         LinkResetECOND_bx=[int(bx) for bx in args.linkresetecondBX.split(',')]
-        fast_commands[LinkResetECOND_bx]=CMD_LINKRESETECOND
-        print('Issuing LinkResetECOND in BX:',LinkResetECOND_bx)
+        fast_commands.set(LinkResetECOND_bx,CMD_LINKRESETECOND)
+        log.info('Issuing LinkResetECOND in BX: %s',LinkResetECOND_bx)
 
     # if args.bocr:
     #     # assume ocr sent at BX=3513
-    #     ocr_bxs = [i for i in range(len(fast_commands)) if i%ORBITLAST==ORBITBCR]
-    #     fast_commands[ocr_bxs] = CMD_BCROCR
+    #     ocr_bxs = list(range(ORBITBCR,N,ORBITLAST))
+    #     fast_commands.set(ocr_bxs,CMD_BCROCR)
 
     if args.ecr and args.ecrBX!='':
         # assume ecr sent at unique globalBXs
         ecr_bxs = [int(ecr) for ecr in args.ecrBX.split(',')]
-        fast_commands[ecr_bxs] = CMD_ECR
+        fast_commands.set(ecr_bxs,CMD_ECR)
 
     if args.ocr and args.ocrBX!='':
         # assume ocr sent at unique globalBXs
         ocr_bxs = [int(ocr) for ocr in args.ocrBX.split(',') if not int(ocr) in bcr_bxs]
         bcrocr_bxs = [int(ocr) for ocr in args.ocrBX.split(',') if int(ocr) in bcr_bxs]
-        fast_commands[ocr_bxs] = CMD_OCR
-        fast_commands[bcrocr_bxs] = CMD_BCROCR
+        fast_commands.set(ocr_bxs,CMD_OCR)
+        fast_commands.set(bcrocr_bxs,CMD_BCROCR)
 
-    L1a_bxs,L1a_name = generate_L1a_fast_commands(args)
+    # no L1As (if vetoed) around BCRs, EBRs and LinkResets
+    veto_bxs = fast_commands.positions(CMD_BCR,CMD_BCROCR,CMD_LINKRESETROCD,CMD_LINKRESETECOND)
+    if args.ebr and args.ebrBX!='':
+        veto_bxs = np.concatenate([veto_bxs,[int(ebr) for ebr in args.ebrBX.split(',')]])
+
+    L1a_bxs,L1a_name = generate_L1a_fast_commands(args,veto_bxs)
     if len(L1a_bxs)>0:
-        fast_commands[L1a_bxs] = CMD_L1A
+        fast_commands.set(L1a_bxs,CMD_L1A)
     num_events = len(L1a_bxs)
 
     if args.ebr and args.ebrBX!='':
-        # fill array with bxs up to 3BXs after l1as
-        L1a_bxs_after4 = []
-        for i in range(3):
-            L1a_bxs_after4 += [bx+i+1 for bx in L1a_bxs if bx not in L1a_bxs_after4]
-        # print('l1a bxs after 4 ',L1a_bxs_after4)
-        ebr_bxs = [int(ebr) for ebr in args.ebrBX.split(',') if int(ebr) not in L1a_bxs_after4]
-        fast_commands[ebr_bxs] = CMD_EBR
-
-    # command - orbit - bx - globalBx
-    commands = [{'fc': fast_command,
-                 'orbit': count_orbit(i,fast_command),
-                 'BX': count_bx(i,fast_command),
-                 'globalBX': i}  for i,fast_command in enumerate(fast_commands)]
-
-    return commands,L1a_name,num_events
+        # no EBR in the 3 BXs after a L1A
+        ebr_bxs = np.array([int(ebr) for ebr in args.ebrBX.split(',')],dtype=np.int64)
+        L1a_bxs_after4 = (np.asarray(L1a_bxs,dtype=np.int64)[:,None] + np.arange(1,4)).reshape(-1)
+        ebr_bxs = ebr_bxs[~np.isin(ebr_bxs,L1a_bxs_after4)]
+        fast_commands.set(ebr_bxs,CMD_EBR)
+
+    return fast_commands,L1a_name,num_events
+
+def fast_command_metrics(metrics,fast_commands,bx_start=0):
+    """number of each fast command (other than IDLE) sent from bx_start"""
+    positions = fast_commands.positions()
+    counts = np.bincount(fast_commands.codes[positions[positions>=bx_start]],minlength=len(FASTCMD_LIST))
+    for code in np.flatnonzero(counts):
+        metrics.count(FASTCMD_LIST[code],counts[code])
+
+def readout_metrics(metrics,l1as,latencies,event_buffer,readout,args,num_bx):
+    """
+    counters and histograms of the readout (same for both engines)
+      l1as: (globalBX, events in the buffer) of each L1A accepted by the ROC
+      latencies: BXs from the L1A to the header of each event read out
+      event_buffer: EventBuffer, with the number of BXs with each occupancy
+      readout: counters of the readout (events read, dropped by EBRs, ...)
+    """
+    l1as = np.array(l1as,dtype=np.int64).reshape(-1,2)
+    l1a_metrics(metrics,l1as[:,0],l1as[:,1],latencies,args.bx_start,num_bx,ORBITLAST)
+    for name,n in readout.items():
+        metrics.count(name,n)
+    metrics.fill('buffer_occupancy',np.arange(len(event_buffer.occupancy)),event_buffer.occupancy)
+    metrics.count('num_bx',max(0,num_bx-args.bx_start))
+
+def write_run_metrics(metrics,file_name,args):
+    """metrics of the run, next to the pattern file"""
+    info = {'pattern': file_name,
+            'engine': 'parallel' if args.jobs>1 else ('stream' if (args.stream or args.outputFormat=='binary') else args.engine),
+            'args': vars(args)}
+    return metrics.write(metrics_file_name(file_name),**info)
+
+# packets of formatted and zero data only depend on the packet count (0-15), the link and the word
+#   so they are built once (on first use), and events are copied from them
+_packet_templates = {}
+
+def packet_templates(data_type='formatted'):
+    """
+    (16, NELINKS, NWORDS) array with the packet for each packet count, for 'formatted' or 'zero' data
+      HDR/CRC words (and CM for zero data) are place-holders (0), replaced with bx and orbit when the packet is read out
+    """
+    if not data_type in _packet_templates:
+        packet_counter = np.arange(16)[:,None,None]
+        link_counter = np.arange(NELINKS)[None,:,None]
+        word_counter = np.arange(NWORDS)[None,None,:]
+
+        if data_type=='formatted':
+            templates = pack_formatted(packet_counter,link_counter,word_counter).astype(np.uint32)
+        else:
+            # a zero 32-bit word, with CM moved to be replaced later, so random number can be seeded off of e/b/o number
+            templates = np.zeros((16,NELINKS,NWORDS),dtype=np.uint32)
 
-def make_dataset(args,num_events):
-    packet_counter = 0
-    roc_buffer = []
+        templates[:,:,HDR_INDEX] = 0
+        templates[:,:,CRC_INDEX] = 0
+        templates[:,:,DATAWORDS.split('_').index('IDLE')] = IDLEWORD_HEX # assume non-bc0
+        templates.setflags(write=False)
+        _packet_templates[data_type] = templates
 
-    if args.physicsdata:
+    return _packet_templates[data_type]
+
+# MC data loaded in this process, keyed by ntuple, wafer and entries read
+#   shared by all the scenarios of a batch (see runScenarios.py)
+_mc_data = {}
+
+def wafer_coordinates(args):
+    """(subdet,zside,layer,waferu,waferv) of the wafer in args"""
+    # try parsing the wafer coordinates
+    try:
+        subdet,zside,layer,waferu,waferv=eval(args.waferCoordinates)
+    except:
+        log.warning(f'Unable to parse wafer coordinates ({args.waferCoordinates}) for (subdet,zside,layer,waferu,waferv), falling back to default values (0,1,5,3,1)')
+        subdet,zside,layer,waferu,waferv = 0,1,5,3,1
+    return subdet,zside,layer,waferu,waferv
+
+def load_mc_data(args,maxEvents=None):
+    """
+    MC data of the wafer in args: dense (entries, links, channels) array of integer words and the entry numbers
+      loaded only once in each process
+    """
+    subdet,zside,layer,waferu,waferv = wafer_coordinates(args)
+
+    key = (args.fname,(subdet,zside,layer,waferu,waferv),args.mcEntryStart,maxEvents)
+    if not key in _mc_data:
         from getElinkInputDataFromMC import loadMCData
 
-        # try parsing the wafer coordinates
-        try:
-            subdet,zside,layer,waferu,waferv=eval(args.waferCoordinates)
-        except:
-            print('#'*20)
-            print('#'*20)
-            print(f'Unable to parse wafer coordinates ({args.waferCoordinates}) for (subdet,zside,layer,waferu,waferv)')
-            print('   Falling back to default values')
-            print('      (0,1,5,3,1)')
-            print('#'*20)
-            print('#'*20)
-            subdet,zside,layer,waferu,waferv = 0,1,5,3,1
-
-        # load dataframe, with formatted words
-        mcDataDF = loadMCData(fName=args.fname, subdet=subdet, zside=zside, layer=layer, waferu=waferu, waferv=waferv)
-
-        # get list of entries that are present in the dataframe
+        # processed MC data is cached on disk, so repeated runs do not need to read the ntuple
+        from mcDataCache import makeCache
+        cache = makeCache(args.mcCacheDir, args.mcCacheSize)
+
+        # load the eLink data, as a dense (entries, links, channels) array of integer words
+        _mc_data[key] = loadMCData(fName=args.fname, subdet=subdet, zside=zside, layer=layer, waferu=waferu, waferv=waferv, dataType='int',
+                                   entryStart=args.mcEntryStart, maxEvents=maxEvents, cache=cache, returnArray=True)
+    return _mc_data[key]
+
+def make_dataset(args,num_events):
+    if args.physicsdata:
+        # only read as many events as needed from the ntuple (-1: one per L1A)
+        maxEvents = num_events if args.mcMaxEvents==-1 else args.mcMaxEvents
+
+        mcData,entryList = load_mc_data(args,maxEvents)
+
+        # get list of entries that are present in the MC data
         # then pick a random set to use at the L1A data
-        entryList = mcDataDF.index.levels[0].values
         if not args.mcEvtNumbers:
-            l1Aevents = np.random.choice(entryList,num_events)
+            rng = l1aGenerator.make_rng(args.seed,'mcEvents')
+            l1Aevents = rng.choice(entryList.values,num_events)
         else:
             evtNums=[int(x) for x in args.mcEvtNumbers.split(',')]
 
             for i,x in reversed(list(enumerate(evtNums))):
                 if not x in entryList:
-                    print(f'No event {x} in mc data, dropping')
+                    log.warning(f'No event {x} in mc data, dropping')
                     evtNums.pop(i)
             l1Aevents = (evtNums*int(np.ceil(num_events/len(evtNums))))[:num_events]
-        print(l1Aevents)
-    for ev_counter in range(num_events):
-        words = DATAWORDS.split('_')
-
-        # packet count: from 0 to 15 and then rolls over
-        # 4 bit: 0000 to 1111 (from 0 to 15)
-        if packet_counter==16: packet_counter = 0
-
-        data_by_link = dict()
-        for link_counter in range(NELINKS): # link counter
-            data_by_link[link_counter] = []
-            # word counter: 0-41
-            for word_counter,word_type in enumerate(words):
-
-                if word_type=='HDR':
-                    word = 'HDR' # place-holder, so that we can replace with bx and orbit when L1A is called
-                elif word_type=='CM':
-                    if args.physicsdata or args.zerodata:
-                        word = 'CM'
-                        # place-holder, moved to be replaced later, so random number can be seeded off of e/b/o number
-                    else:
-                        word = '{0:04b}'.format(packet_counter) # 4b count number
-                        word += '{0:04b}'.format(link_counter+1) # 4b elink number
-                        word += '{0:08b}'.format(word_counter) # 8b packet word
-                        word += '{0:04b}'.format(packet_counter)
-                        word += '{0:04b}'.format(link_counter+1)
-                        word += '{0:08b}'.format(word_counter)
-                elif word_type=='IDLE':
-                    word = '{0:032b}'.format(IDLEWORD_HEX) # assume non-bc0
-                elif word_type=='CRC':
-                    word = 'CRC'
+        log.info('MC events %s',l1Aevents)
+
+    # packet count: from 0 to 15 and then rolls over
+    roc_buffer = packet_templates('zero' if (args.zerodata or args.physicsdata) else 'formatted')[np.arange(num_events)%16]
+
+    if args.physicsdata and not args.zerodata:
+        # channel words of all the L1As at once
+        channels = [word_counter for word_counter,word_type in enumerate(DATAWORDS.split('_')) if word_type.startswith('CH')]
+        roc_buffer[:,:,channels] = mcData[entryList.get_indexer(l1Aevents)]
+
+    return roc_buffer
+
+def schedule_readout(fast_commands,args,metrics=None):
+    """
+    First pass of the vectorized engine
+      scalar loop over the BXs with a fast command (L1A/EBR/ECR/BCR/LinkReset) only,
+      following the same event buffer logic as the BX loop in make_eportRX_input.
+      BXs in between fast commands are skipped over in one step, either reading words from the
+      event at the front of the buffer or sending idles
+
+    returns:
+    - reads: dict of arrays, with one entry per contiguous read of (part of) a packet
+        globalBX: first BX of the read
+        nwords: number of words read
+        event: index of the event in the roc_buffer
+        word: index of the first word read
+        eventCounter: event counter at the time of the read (used in the header)
+        bxL1A: globalBX of the L1A of the event being read (used in the header)
+        status: status bits of the header (set for events accepted with a full buffer)
+    - num_bx: last BX (+1), extended if needed to finish reading the last event
+    - counters: final roc/buffer/event counters
+    metrics: RunMetrics, filled with the counters and histograms of the readout (L1As, buffer depth and occupancy, EBR drops, LinkReset idles)
+    with a finite buffer (args.bufferDepth), L1As arriving with the buffer full are dropped, removed from fast_commands (busy),
+      or read out with the status bits of the header set (flag), see rocBuffer
+    """
+    N = args.N
+    num_bx = N
+
+    cmd_bxs = fast_commands.positions()
+    cmd_bxs = cmd_bxs[cmd_bxs>=args.bx_start]
+    i_cmd = 0
+
+    counters = {
+        'roc': 0,
+        'buffer': 0,
+        'event': 1,
+        }
+
+    # events waiting to be read out: L1A BX, readout window, event index, words read and header status bits of each event
+    event_buffer = EventBuffer(args.bufferDepth)
+    # event currently being read (only updated when not sending idles from a link reset)
+    head = None
+    counterLinkResetIdles = 0
+
+    reads = []
+
+    # instrumentation
+    debug = log.isEnabledFor(logging.DEBUG)
+    l1as = []
+    readout = dict.fromkeys(['events_read','ebr_dropped_events','link_reset_idle_bx','buffer_full_l1a'],0)
+
+    bx_counter = args.bx_start
+    while bx_counter < num_bx:
+        next_cmd = cmd_bxs[i_cmd] if i_cmd<len(cmd_bxs) else num_bx
+
+        if bx_counter==next_cmd:
+            command_ = fast_commands[bx_counter]
+            i_cmd += 1
+
+            if command_ == CMD_LINKRESETROCD:
+                counterLinkResetIdles=400
+                if debug:
+                    log.debug(f'LinkResetROCD at BX: {bx_counter}, sending {counterLinkResetIdles} idles')
+
+            status = 0
+            if command_ == CMD_L1A and event_buffer.is_full():
+                readout['buffer_full_l1a'] += 1
+                if debug:
+                    log.debug(f'L1A at BX: {bx_counter} with a full buffer ({len(event_buffer)} events): {args.bufferFull}')
+                if args.bufferFull=='flag':
+                    status = STATUS_BUFFER_FULL
+                else:
+                    if args.bufferFull=='busy':
+                        fast_commands.set([bx_counter],CMD_IDLE)
+                    command_ = CMD_IDLE
+
+            if command_ == CMD_L1A:
+                if len(event_buffer)==0:
+                    delay=args.delay
+                    start=bx_counter+delay
                 else:
-                    if args.zerodata:
-                        # a zero 32-bit word
-                        word = '{0:032b}'.format(0)
-                    elif args.physicsdata:
-                        word = mcDataDF.loc[(l1Aevents[ev_counter],link_counter),word_type]
+                    num_words_until_end = NWORDS-event_buffer.back()[WORDS]
+                    if num_words_until_end >= args.delay:
+                        delay=0
                     else:
-                        word = '{0:04b}'.format(packet_counter)
-                        word += '{0:04b}'.format(link_counter+1)
-                        word += '{0:08b}'.format(word_counter)
-                        word += '{0:04b}'.format(packet_counter)
-                        word += '{0:04b}'.format(link_counter+1)
-                        word += '{0:08b}'.format(word_counter)
+                        delay=args.delay-num_words_until_end
+                    start=event_buffer.back()[START]+NWORDS+delay
 
-                # if word_type!='HDR' and word_type!='IDLE':
-                #     print('packet counter ',packet_counter,' link counter ',link_counter+1,' word counter ',word_counter,' word ',word)
-                # else:
-                #     print('word_type ',word_type)
-                data_by_link[link_counter].append(word)
+                l1as.append((bx_counter,len(event_buffer)))
+                if debug:
+                    log.debug(f'L1A at BX: {bx_counter} Events in buffer: {len(event_buffer)} Latency delay: {delay} Start reading this evt at: {start} End at {start+NWORDS-1}')
 
-        # increase packet counter after a full 12 e-link packet is sent
-        packet_counter += 1
+                event_buffer.push(bx_counter,start,start+NWORDS-1,counters['roc'],status)
+                counters['roc'] +=1
 
-        roc_buffer.append(data_by_link)
+            if command_ == CMD_ECR:
+                counters['event'] = 1
 
-    return roc_buffer
+            if command_ == CMD_EBR:
+                readout['ebr_dropped_events'] += event_buffer.clear(keep_front=counters['buffer']>0)
+                counters['event'] = 1
+
+            # replace num_bx with the last event to read
+            if len(event_buffer)>0 and event_buffer.back()[END]>=N:
+                num_bx = event_buffer.back()[END]+1
+
+            next_cmd = cmd_bxs[i_cmd] if i_cmd<len(cmd_bxs) else num_bx
+
+        # advance up to the next fast command, nothing but reading the buffer changes in between
+        bx_stop = min(next_cmd,num_bx)
+        while bx_counter < bx_stop:
+            idle_stop = bx_stop
+            if len(event_buffer)>0:
+                if counterLinkResetIdles==0:
+                    head = event_buffer.front()
+                if head is not None and bx_counter>=head[START] and bx_counter<=head[END]:
+                    front = event_buffer.front()
+                    nwords = min(bx_stop, head[END]+1, bx_counter+NWORDS-front[WORDS]) - bx_counter
+                    reads.append((bx_counter,nwords,head[EVENT],counters['buffer'],counters['event'],head[GLOBALBX],head[STATUS]))
+                    counters['buffer'] += nwords
+                    front[WORDS] += nwords
+                    bx_counter += nwords
+
+                    # occupancy at the end of each BX: the event leaves the buffer in the BX of its last word
+                    if front[WORDS]==NWORDS:
+                        event_buffer.count_bx(nwords-1)
+                        counters['event'] +=1
+                        readout['events_read'] += 1
+                        event_buffer.pop()
+                        counters['buffer']=0
+                        event_buffer.count_bx(1)
+                    else:
+                        event_buffer.count_bx(nwords)
+                    continue
+
+                # send idles until the read window opens (or the link reset idles run out)
+                if head is not None and bx_counter<head[START]:
+                    idle_stop = min(idle_stop,head[START])
+                if counterLinkResetIdles>0:
+                    idle_stop = min(idle_stop,bx_counter+counterLinkResetIdles)
+
+            readout['link_reset_idle_bx'] += min(counterLinkResetIdles,idle_stop-bx_counter)
+            counterLinkResetIdles = max(0,counterLinkResetIdles-(idle_stop-bx_counter))
+            event_buffer.count_bx(idle_stop-bx_counter)
+            bx_counter = idle_stop
+
+    reads = np.array(reads,dtype=np.int64).reshape(-1,7)
+    reads = {k:reads[:,i] for i,k in enumerate(['globalBX','nwords','event','word','eventCounter','bxL1A','status'])}
+
+    if metrics is not None:
+        is_header = reads['word']==HDR_INDEX
+        latencies = reads['globalBX'][is_header]-reads['bxL1A'][is_header]
+        readout_metrics(metrics,l1as,latencies,event_buffer,readout,args,num_bx)
+
+    return reads,num_bx,counters
+
+def fill_eportRX_matrix(reads,packets,fast_commands,args,bx_first,bx_last,history=None,metrics=None):
+    """
+    Second pass of the vectorized engine
+      fills a (bx_last-bx_first, links) array of 32 bit words with idle/BC0 words,
+      and copies in the words of the packets read out (from schedule_readout)
+      the header, common mode and CRC words are computed for each packet as it is read
+    packets: (events, links, NWORDS) words, with the links of one ROC (NELINKS) or of several ROCs with the same readout schedule
+      (the CM words are the same for every ROC, as in a run of each ROC on its own)
+    history: words of the BXs just before bx_first (at least the last 39), needed for the CRC when filling in blocks
+    metrics: RunMetrics, to time the CRC
+    """
+    num_rows = max(0,bx_last-bx_first)
+    globalBX = np.arange(bx_first,bx_first+num_rows)
+
+    # BX counter, which is set to ORBITBCR on a BCR, for the BC0 idle words
+    bx_,_ = fast_commands.counters(globalBX,args.bx_start)
+
+    num_rocs = packets.shape[1]//NELINKS
+    data = np.repeat(pack_idle(bx_==0)[:,None],packets.shape[1],axis=1)
+
+    # reads overlapping with this range of BXs (reads are in order, and at most NWORDS long)
+    lo = np.searchsorted(reads['globalBX'],bx_first-NWORDS,side='left')
+    hi = np.searchsorted(reads['globalBX'],bx_last,side='left')
+    reads = {k:v[lo:hi] for k,v in reads.items()}
+
+    # expand reads into one entry per word read
+    nwords = reads['nwords']
+    i_read = np.repeat(np.arange(len(nwords)),nwords)
+    offset = np.arange(nwords.sum()) - np.repeat(np.cumsum(nwords)-nwords,nwords)
+    rows = reads['globalBX'][i_read] + offset - bx_first
+    words = reads['word'][i_read] + offset
+    in_range = (rows>=0) & (rows<num_rows)
+    i_read,rows,words = i_read[in_range],rows[in_range],words[in_range]
+
+    data[rows] = packets[reads['event'][i_read],:,words]
+
+    # header word
+    bx = (reads['bxL1A']+2)%3564
+    orbit = (reads['bxL1A']+2)//3564
+    hamming = np.zeros(len(bx),dtype=np.int64)
+    if args.hamErrRate>0:
+        hamming = rocRNG.hamming_codes(bx,reads['eventCounter'],orbit,args.hamErrRate,args.seed)
+    header_word = pack_header(bx,reads['eventCounter'],orbit,hamming|reads['status'])
+
+    is_hdr = words==HDR_INDEX
+    data[rows[is_hdr]] = header_word[i_read[is_hdr],None]
+
+    # common mode words, random numbers from the e/b/o number
+    if args.physicsdata or args.zerodata:
+        is_cm = words==CM_INDEX
+        if args.rng=='philox':
+            i = i_read[is_cm]
+            cm = rocRNG.cm_values(bx[i],reads['eventCounter'][i],orbit[i],NELINKS,args.seed)
+            data[rows[is_cm]] = np.tile(pack_cm(cm[:,:,0],cm[:,:,1]),(1,num_rocs))
+        else:
+            # seeded off of the header (without the hamming code)
+            for row,i in zip(rows[is_cm],i_read[is_cm]):
+                rng = np.random.RandomState(header_word[i]>>7)
+                cm_scale = rng.randint(0,16)<<6
+                cm = rng.randint(0,64,(NELINKS,2)) + cm_scale
+                data[row] = np.tile(pack_cm(cm[:,0],cm[:,1]),num_rocs)
+
+    # calculate the CRC (polynomial 0x104c11db7) from the last 39 words of each link
+    #   the CRC of the first words of a block also uses the words from the end of the previous block
+    crc_start = time.perf_counter()
+    n_history = 0 if history is None else len(history)
+    daq = data if history is None else np.concatenate([history,data])
+    crc_rows = rows[words==CRC_INDEX] + n_history
+    if np.all(np.diff(crc_rows)>CRC_NWORDS):
+        # no CRC word falls in the window of another one, so all packets and links are done in one batch
+        #   windows starting before the first BX are padded with 0 (leading zeros do not change the CRC)
+        window = crc_rows[:,None] + np.arange(-CRC_NWORDS,0)
+        daqvals = np.where((window>=0)[:,:,None],daq[np.maximum(window,0)],0)
+        daq[crc_rows] = crc_words(daqvals.transpose(0,2,1))
+    else:
+        for row in crc_rows:
+            daq[row] = crc_words(daq[max(0,row-CRC_NWORDS):row].T)
+    if metrics is not None:
+        metrics.add_time('crc',time.perf_counter()-crc_start)
+
+    return daq[n_history:]
+
+def fast_command_stream(fast_commands,clk,num_rows,args):
+    """
+    fast command codes in the output rows with these CLK_N (out of num_rows rows from args.bx_start)
+      shifted by FASTCMD_INTERNAL_LATENCY, with the first ones wrapping around to the last rows
+    """
+    i_command = clk-args.bx_start
+    if num_rows>=FASTCMD_INTERNAL_LATENCY:
+        i_command = (i_command+FASTCMD_INTERNAL_LATENCY)%num_rows
+    return fast_commands.codes_at(i_command+args.bx_start)
+
+def iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,block_size=ORBITLAST,bx_range=None,metrics=None):
+    """
+    Generate the output of the vectorized engine in blocks of block_size BXs, to keep memory constant for long runs
+      yields (CLK_N, eRx words, fast command codes) for each block,
+      with the fast commands already shifted by FASTCMD_INTERNAL_LATENCY (the first ones wrap around to the last BXs)
+    bx_range: (first, last) BXs to generate (default: all of them), e.g. one shard of the parallel mode
+    metrics: RunMetrics, to time the fill of the blocks (including the CRC)
+    """
+    num_rows = max(0,num_bx-args.bx_start)
+    first,last = (args.bx_start,num_bx) if bx_range is None else bx_range
+
+    history = None
+    if first>args.bx_start:
+        # words before the first block, for the CRC
+        #   CRC words are at least NWORDS apart, so none is in the window of another one,
+        #   and the last CRC_NWORDS words are correct when filled from 2*CRC_NWORDS BXs before
+        history = fill_eportRX_matrix(reads,packets,fast_commands,args,max(args.bx_start,first-2*CRC_NWORDS),first)[-CRC_NWORDS:]
+
+    for bx_first in range(first,last,block_size):
+        fill_start = time.perf_counter()
+        bx_last = min(bx_first+block_size,last)
+        data = fill_eportRX_matrix(reads,packets,fast_commands,args,bx_first,bx_last,history,metrics)
+        history = data[-CRC_NWORDS:] if history is None else np.concatenate([history,data])[-CRC_NWORDS:]
+
+        clk = np.arange(bx_first,bx_last)
+        codes = fast_command_stream(fast_commands,clk,num_rows,args)
+        if metrics is not None:
+            metrics.add_time('fill',time.perf_counter()-fill_start)
+        yield clk,data,codes
+
+def make_eportRX_input_vectorized(args):
+    """
+    Same output as make_eportRX_input, but with a two pass engine:
+      a scalar pass over the fast commands only to schedule the readout of each event (schedule_readout),
+      and a vectorized pass filling a preallocated (N, 12) array of words (fill_eportRX_matrix)
+    """
+    metrics = RunMetrics()
+    with metrics.stage('fast_commands'):
+        fast_commands,L1a_name,num_events = build_fast_commands(args)
+
+    with metrics.stage('dataset'):
+        packets = make_dataset(args,num_events)
+
+    with metrics.stage('schedule'):
+        reads,num_bx,counters = schedule_readout(fast_commands,args,metrics)
+    fast_command_metrics(metrics,fast_commands,args.bx_start)
+
+    with metrics.stage('fill'):
+        data = fill_eportRX_matrix(reads,packets,fast_commands,args,args.bx_start,num_bx,metrics=metrics)
+
+    data_commands = fast_command_names(fast_commands.codes_at(np.arange(args.bx_start,args.bx_start+len(data))))
+
+    data_by_channel = {'RESET_B':np.ones(len(data),dtype=int),
+                       'SOFT_RESET_B':np.ones(len(data),dtype=int)}
+    for link_counter in range(NELINKS): data_by_channel['ERX_%i'%link_counter] = data[:,link_counter]
+    data_by_channel['FAST_CMD'] = data_commands
+
+    return write_eportRX_output(args,data_by_channel,num_bx,counters['event'],L1a_name,metrics)
+
+def make_eportRX_input_streaming(args):
+    """
+    Vectorized engine, writing the output file one block of args.block_size BXs at a time
+      so that memory does not grow with N (only the readout schedule and the event packets are kept)
+      in CSV (rocData/*.csv) or binary (rocData/*.bin, see patternIO) format
+    returns the name of the file written
+    """
+    metrics = RunMetrics()
+    with metrics.stage('fast_commands'):
+        fast_commands,L1a_name,num_events = build_fast_commands(args)
+
+    with metrics.stage('dataset'):
+        packets = make_dataset(args,num_events)
+
+    with metrics.stage('schedule'):
+        reads,num_bx,counters = schedule_readout(fast_commands,args,metrics)
+    fast_command_metrics(metrics,fast_commands,args.bx_start)
+
+    description = eportRX_description(args,num_bx,counters['event'],L1a_name,CHANNELS)
+    if args.outputFormat=='binary':
+        file_name = 'rocData/%s.bin'%eportRX_file_name(args,L1a_name)
+        meta = {'N':args.N, 'bx_start':args.bx_start, 'delay':args.delay, 'bcr':args.bcr}
+        writer = BinaryPatternWriter(file_name,max(0,num_bx-args.bx_start),description,FASTCMD_LIST,CHANNELS,meta)
+    else:
+        file_name = 'rocData/%s.csv'%eportRX_file_name(args,L1a_name)
+        writer = CSVPatternWriter(file_name,description,FASTCMD_LIST)
+
+    with writer:
+        for clk,data,codes in iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,args.block_size,metrics=metrics):
+            with metrics.stage('write'):
+                writer.write_block(clk,data,codes)
+
+    write_run_metrics(metrics,file_name,args)
+    return file_name
+
+# inputs of the shards, set once in each worker process of the parallel mode
+_shard_state = {}
+
+def _init_shard_worker(reads,packets,fast_commands,num_bx,args,file_name):
+    _shard_state.update(reads=reads,packets=packets,fast_commands=fast_commands,num_bx=num_bx,args=args,file_name=file_name)
+
+def generate_shard(bx_range):
+    """
+    Generate the BXs in bx_range=(first, last), in a worker process of the parallel mode
+      binary output is written directly into the (preallocated) file, CSV rows are returned as bytes
+    returns (number of BXs, CSV rows, RunMetrics of the shard)
+    """
+    reads,packets,fast_commands,num_bx,args = [_shard_state[k] for k in ['reads','packets','fast_commands','num_bx','args']]
+    metrics = RunMetrics()
+    blocks = iter_eportRX_blocks(reads,packets,fast_commands,num_bx,args,args.block_size,bx_range,metrics)
+    num_rows = bx_range[1]-bx_range[0]
+
+    if args.outputFormat=='binary':
+        header,words,codes = read_binary_pattern(_shard_state['file_name'],mode='r+')
+        for clk,data,cmd_codes in blocks:
+            with metrics.stage('write'):
+                words[clk[0]-args.bx_start:clk[-1]+1-args.bx_start] = data
+                codes[clk[0]-args.bx_start:clk[-1]+1-args.bx_start] = cmd_codes
+        with metrics.stage('write'):
+            words.flush()
+            codes.flush()
+        return num_rows,b'',metrics
+
+    rows = []
+    for clk,data,cmd_codes in blocks:
+        with metrics.stage('format'):
+            rows.append(format_csv_block(clk,data,cmd_codes,fast_command_names=FASTCMD_LIST))
+    return num_rows,b'\n'.join(rows),metrics
+
+def make_eportRX_input_parallel(args):
+    """
+    Vectorized engine, generating orbit-aligned shards of args.shard_orbits orbits in args.jobs processes
+      the readout schedule (the state of the event buffer in every BX) is computed first, in one pass over the fast commands,
+      so each shard is independent of the others, and the output is the same as from a serial run
+    returns the name of the file written
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+
+    metrics = RunMetrics()
+    with metrics.stage('fast_commands'):
+        fast_commands,L1a_name,num_events = build_fast_commands(args)
+
+    with metrics.stage('dataset'):
+        packets = make_dataset(args,num_events)
+
+    with metrics.stage('schedule'):
+        reads,num_bx,counters = schedule_readout(fast_commands,args,metrics)
+    fast_command_metrics(metrics,fast_commands,args.bx_start)
+
+    description = eportRX_description(args,num_bx,counters['event'],L1a_name,CHANNELS)
+    if args.outputFormat=='binary':
+        file_name = 'rocData/%s.bin'%eportRX_file_name(args,L1a_name)
+        meta = {'N':args.N, 'bx_start':args.bx_start, 'delay':args.delay, 'bcr':args.bcr}
+        # preallocate the file, shards are written into it by the workers
+        BinaryPatternWriter(file_name,max(0,num_bx-args.bx_start),description,FASTCMD_LIST,CHANNELS,meta).close()
+        writer = None
+    else:
+        file_name = 'rocData/%s.csv'%eportRX_file_name(args,L1a_name)
+        writer = CSVPatternWriter(file_name,description)
+
+    # shards start at orbit boundaries (of the global BX)
+    shard_size = args.shard_orbits*ORBITLAST
+    edges = [args.bx_start] + list(range((args.bx_start//shard_size+1)*shard_size,num_bx,shard_size)) + [num_bx]
+    shards = [(first,last) for first,last in zip(edges[:-1],edges[1:]) if last>first]
+
+    # times of the fill/format/write stages are summed over the workers (CPU time), 'shards' is the wall time
+    with metrics.stage('shards'), ProcessPoolExecutor(args.jobs,initializer=_init_shard_worker,initargs=(reads,packets,fast_commands,num_bx,args,file_name)) as pool:
+        # keep a limited number of shards in flight, and write them in order
+        pending = deque()
+        for i,bx_range in enumerate(shards):
+            pending.append(pool.submit(generate_shard,bx_range))
+            while len(pending)>2*args.jobs or (i==len(shards)-1 and len(pending)>0):
+                num_rows,rows,shard_metrics = pending.popleft().result()
+                metrics.merge(shard_metrics)
+                if writer is not None:
+                    with metrics.stage('write'):
+                        writer.write_rows(rows,num_rows)
+
+    if writer is not None:
+        writer.close()
+
+    write_run_metrics(metrics,file_name,args)
+    return file_name
+
+def make_eportRX_input_cached(args):
+    """
+    Reuse the pattern from the output cache (args.outputCache) if it was already generated with the same arguments,
+      emulator version and inputs, otherwise generate it and add it to the cache
+    returns the name of the file written
+    """
+    from outputCache import OutputCache
+    cache = OutputCache(args.outputCache,args.outputCacheMode)
+    key = cache.key(args)
+
+    file_name = cache.restore(key)
+    if file_name is not None:
+        log.info(f'Pattern {file_name} taken from the output cache ({key})')
+        return file_name
+
+    generate_args = argparse.Namespace(**vars(args))
+    generate_args.outputCache = None
+    output = make_eportRX_input(generate_args)
+    file_name = output if isinstance(output,str) else output.attrs['file_name']
+    cache.store(key,file_name,args)
+    return file_name
 
 def make_eportRX_input(args):
+    set_log_level(args.logLevel)
+    if args.outputCache:
+        return make_eportRX_input_cached(args)
+    if args.jobs>1:
+        return make_eportRX_input_parallel(args)
+    if args.stream or args.outputFormat=='binary':
+        return make_eportRX_input_streaming(args)
+    if args.engine=='vector':
+        return make_eportRX_input_vectorized(args)
+
+    data_by_channel,num_bx,num_packets,L1a_name,metrics = run_loop_engine(args)
+    return write_eportRX_output(args,data_by_channel,num_bx,num_packets,L1a_name,metrics)
+
+def run_loop_engine(args):
+    """
+    Loop engine: emulates the ROC BX by BX, without writing the output
+    returns the words of each channel, the number of BXs, the number of event packets, the L1A name and the RunMetrics of the run
+    """
+    metrics = RunMetrics()
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # produce idle fast commands w. other fast commands
-    commands, L1a_name, num_events = generate_fast_commands(args)
+    with metrics.stage('fast_commands'):
+        commands, L1a_name, num_events = build_fast_commands(args)
 
     # initialize counters
     counters = {
@@ -294,7 +920,7 @@ def make_eportRX_input(args):
     hammingErrors=args.hamErrRate>0
 
     # output data
-    channels = ['RESET_B', 'SOFT_RESET_B']+[f'ERX_{i}' for i in range(12)]+['FAST_CMD']
+    channels = CHANNELS
 
     def fill_by_channel(counters,hard_resets,soft_resets,link_data,commands):
         by_channel = dict.fromkeys(channels)
@@ -310,7 +936,7 @@ def make_eportRX_input(args):
     # reset
     counters,reset_by_channel = fill_by_channel(counters,[0]*3,[1]*3, [[IDLEWORD] * 3]*NELINKS,[CMD_IDLE]*3)
     # end
-    endwords = ['{0:08X}'.format(int('{0:032b}'.format(ONEWORD_HEX),base=2))]
+    endwords = [ONEWORD_HEX]
     counters,end_by_channel = fill_by_channel(counters,[1],[1],[endwords]*NELINKS,[CMD_ALLONE])
 
     # the data that ECON sees
@@ -319,13 +945,13 @@ def make_eportRX_input(args):
     data_commands = []
     roc_data_by_link = dict()
     for link_counter in range(NELINKS): roc_data_by_link[link_counter] = []
-    roc_buffer_by_link = make_dataset(args,num_events)
+    with metrics.stage('dataset'):
+        roc_buffer_by_link = make_dataset(args,num_events)
 
     # buffers
-    # event buffer: contains the index of the event number to read from the roc_buffer
-    event_buffer = []
-    # delay_buffer: contains when to read events in the event_buffer
-    delay_buffer = []
+    # event buffer: contains the L1A BX, when to read each event (start/end), the index of the event to read from the roc_buffer,
+    #   the number of words already read and the status bits of its header
+    event_buffer = EventBuffer(args.bufferDepth)
 
     # loop over fast commands (or BX)
     num_bx = args.N
@@ -334,8 +960,15 @@ def make_eportRX_input(args):
     bx_=(args.bx_start%ORBITLAST)
     orbit_=0
 
+    # instrumentation
+    l1as = []
+    latencies = []
+    readout = dict.fromkeys(['events_read','ebr_dropped_events','link_reset_idle_bx','buffer_full_l1a'],0)
+    crc_seconds = 0.
+    loop_start = time.perf_counter()
+
     while bx_counter < num_bx:
-        command_ = commands[bx_counter]['fc'] if len(commands)>bx_counter else CMD_IDLE
+        command_ = commands[bx_counter] if len(commands)>bx_counter else CMD_IDLE
 
         # bx_ = commands[bx_counter]['BX'] if len(commands)>bx_counter else count_bx(bx_counter,command_)
         if bx_>=ORBITLAST:
@@ -348,6 +981,20 @@ def make_eportRX_input(args):
         if (command_ == CMD_OCR) or (command_ == CMD_BCROCR):
             orbit_==0
 
+        # L1A with the event buffer full: dropped, not sent (busy), or read out with the status bits set (flag)
+        status = 0
+        l1a_dropped = False
+        if command_ == CMD_L1A and event_buffer.is_full():
+            readout['buffer_full_l1a'] += 1
+            if debug:
+                log.debug(f'L1A at BX: {bx_counter} with a full buffer ({len(event_buffer)} events): {args.bufferFull}')
+            if args.bufferFull=='flag':
+                status = STATUS_BUFFER_FULL
+            elif args.bufferFull=='busy':
+                commands.set([bx_counter],CMD_IDLE)
+                command_ = CMD_IDLE
+            else:
+                l1a_dropped = True
 
         # fill in other columns
         data_hard_resets.append(1)
@@ -356,10 +1003,11 @@ def make_eportRX_input(args):
 
         if command_ == CMD_LINKRESETROCD:
             counterLinkResetIdles=400
-            print('HERE')
+            if debug:
+                log.debug(f'LinkResetROCD at BX: {bx_counter}, sending {counterLinkResetIdles} idles')
 
         # if L1A then pull event out of daq buffer to event buffer
-        if command_ == CMD_L1A:
+        if command_ == CMD_L1A and not l1a_dropped:
             # set delay
             if len(event_buffer)==0:
                 # if buffer is empty: get evt in delay time (e.g. 7BX)
@@ -369,29 +1017,20 @@ def make_eportRX_input(args):
                 # if buffer is not empty:
                 #    if the length(buffer) < delay_time: get evt in delay time (e.g. 7BX)
                 #    else: get evt in (delay time - (words to end))
-                num_words_until_end = NWORDS-len(event_buffer[-1])
+                num_words_until_end = NWORDS-event_buffer.back()[WORDS]
                 if num_words_until_end >= args.delay:
                     delay=0
                 else:
                     delay=args.delay-num_words_until_end
-                start=delay_buffer[-1]['start']+NWORDS+delay
+                start=event_buffer.back()[START]+NWORDS+delay
 
-            print('L1A at BX: ',bx_counter,' Events in buffer: ',len(event_buffer),' Latency delay: ',delay,' Start reading this evt at: ',start,' End at ',start+NWORDS-1)
+            l1as.append((bx_counter,len(event_buffer)))
+            if debug:
+                log.debug(f'L1A at BX: {bx_counter} Events in buffer: {len(event_buffer)} Latency delay: {delay} Start reading this evt at: {start} End at {start+NWORDS-1}')
 
-            # appends empty list that later fills
-            event_buffer.append([])
             # contains current BX, BX at which we should start reading the event (start) and finish reading the event (end), and the index of the event to pull from the roc_buffer
             # and # of BXs that will take to read this event (bx_counter + delay + nWords)
-            delay_buffer.append({'globalBX':bx_counter,
-                                 'start':start,
-                                 'end':start+NWORDS-1,
-                                 'event':counters['roc']
-                                 })
-            # print('events in buffer',event_buffer)
-
-            #add current BX and orbit numbers (accounting for resets)
-            commands[bx_counter]['BX'] = bx_
-            commands[bx_counter]['orbit'] = orbit_
+            event_buffer.push(bx_counter,start,start+NWORDS-1,counters['roc'],status)
 
             # increase roc buffer counter every time we see an l1a
             counters['roc'] +=1
@@ -402,86 +1041,72 @@ def make_eportRX_input(args):
 
         # if EBR, then reset the event buffer
         if command_ == CMD_EBR:
-            if counters['buffer']>0:
-                event_buffer = [event_buffer[0]]
-                delay_buffer = [delay_buffer[0]]
-                counters['event'] = 1
-            else:
-                event_buffer = [] # not clear just get the first out?
-                delay_buffer = []
-                counters['event'] = 1
-            #print(event_buffer)
+            # keep the event being read (if any)
+            readout['ebr_dropped_events'] += event_buffer.clear(keep_front=counters['buffer']>0)
+            counters['event'] = 1
 
         # replace num_bx with the last event to read
-        if len(delay_buffer)>0 and delay_buffer[-1]['end']>=args.N:
-            num_bx = delay_buffer[-1]['end']+1
+        if len(event_buffer)>0 and event_buffer.back()[END]>=args.N:
+            num_bx = event_buffer.back()[END]+1
 
         # read event buffer, read one word in one BX
         is_reading_buffer = False
         if len(event_buffer)>0:
             if counterLinkResetIdles==0:
-                bx_read = delay_buffer[0]['globalBX']
-                start_read = delay_buffer[0]['start']
-                end_read = delay_buffer[0]['end']
-                event_read = delay_buffer[0]['event']
+                bx_read,start_read,end_read,event_read,_,status_read = event_buffer.front()
 
-            bx = commands[bx_read]['BX']
-            orbit = commands[bx_read]['orbit']
             bx = (bx_read+2)%3564
             orbit = int((bx_read+2)/3564)
             #print(f'   --- {bx}, {orbit}, bx_read={bx_read}, start_read={start_read}, bx_counter={bx_counter}')
             if bx_counter>=start_read and bx_counter<=end_read:
                 # print(bx_counter,'reading',bx_read,' length of evt buffer ',len(event_buffer[0]))
 
-                # header word
-                header_word = '1111'  #changed from 0101 to 1111 to verify HGROC3b
-                header_word +=  '{0:012b}'.format(bx & 0b111111111111) # bx
-                header_word += '{0:06b}'.format(counters['event'] & 0b111111) # event
-                header_word += '{0:03b}'.format(orbit & 0b111) # orbit
-                np.random.seed(int(header_word,2))
-                if random.random()<args.hamErrRate:
-                    header_word += '{0:03b}'.format(random.randInt(1,8)) # three bit hamming code from HGCROC
-                else:
-                    header_word += '000'
-                header_word += '0101'
-
-                cm_scale=np.random.randint(0,16)<<6
-                # convert to hex
+                # header word (1111 instead of 0101 at the start, to verify HGROC3b)
+                header_word = pack_header(bx,counters['event'],orbit,status_read)
+                if counters['buffer']==HDR_INDEX:
+                    latencies.append(bx_counter-bx_read)
+                if hammingErrors and counters['buffer']==HDR_INDEX:
+                    # three bit hamming code from HGCROC
+                    header_word = pack_header(bx,counters['event'],orbit,rocRNG.hamming_codes(bx,counters['event'],orbit,args.hamErrRate,args.seed)[0]|status_read)
+
+                if counters['buffer']==CM_INDEX and (args.physicsdata or args.zerodata):
+                    if args.rng=='philox':
+                        cm_by_link = rocRNG.cm_values(bx,counters['event'],orbit,NELINKS,args.seed)[0]
+                    else:
+                        # seeded off of the header (e/b/o number)
+                        np.random.seed(header_word>>7)
+                        cm_scale=np.random.randint(0,16)<<6
+                        cm_by_link = np.random.randint(0,64,(NELINKS,2)) + cm_scale
+                # calculate the CRC (polynomial 0x104c11db7) for full list of daq words (input last 32 bit packet with data)
+                if counters['buffer']==CRC_INDEX:
+                    #calculate crc based on last 39 words of the data, for all links at once
+                    crc_start = time.perf_counter()
+                    crc_by_link = crc_words([roc_data_by_link[link_counter][-CRC_NWORDS:] for link_counter in range(NELINKS)])
+                    crc_seconds += time.perf_counter()-crc_start
                 for link_counter in range(NELINKS):
-                    word = roc_buffer_by_link[event_read][link_counter][counters['buffer']]
-                    if word=='HDR':
+                    word = roc_buffer_by_link[event_read,link_counter,counters['buffer']]
+                    if counters['buffer']==HDR_INDEX:
                         word = header_word
-                    if word=='CM':
-                        word = '00'
-                        word += '{0:010b}'.format(0)
-
-                        cm0,cm1=np.random.randint(0,64,2).astype(int) + cm_scale
-
-                        word += '{0:010b}'.format(max(0,cm0)) # ADC-CM0
-                        word += '{0:010b}'.format(max(0,cm1)) # ADC-CM1
-                    # calculate the CRC (polynomial 0x104c11db7) for full list of daq words (input last 32 bit packet with data)
-                    if word=='CRC':
-                        #calculate crc based on last 39 words of the data
-                        daqvals = roc_data_by_link[link_counter][-39:]
-                        crcword = crc(codecs.decode((''.join(daqvals)), 'hex'))
-                        word = '{0:032b}'.format(crcword)
+                    if counters['buffer']==CM_INDEX and (args.physicsdata or args.zerodata):
+                        word = pack_cm(cm_by_link[link_counter,0],cm_by_link[link_counter,1]) # ADC-CM0, ADC-CM1
+                    if counters['buffer']==CRC_INDEX:
+                        word = crc_by_link[link_counter]
                     # debug for elink2
                     #if link_counter==2: print(word)
-                    word = '{0:08X}'.format(int(word,base=2))
-                    roc_data_by_link[link_counter].append(word)
+                    roc_data_by_link[link_counter].append(int(word))
 
                 counters['buffer'] +=1
                 is_reading_buffer = True
 
-                event_buffer[0].append( roc_data_by_link[0][-1] )
+                event_buffer.front()[WORDS] += 1
 
-                if len(event_buffer[0])==NWORDS:
+                if event_buffer.front()[WORDS]==NWORDS:
                     # increase event counter
                     counters['event'] +=1
+                    readout['events_read'] += 1
                     # print(counters['event'])
 
-                    event_buffer.pop(0)
-                    delay_buffer.pop(0)
+                    event_buffer.pop()
 
                     # reset buffer counter to 0
                     counters['buffer']=0
@@ -491,25 +1116,23 @@ def make_eportRX_input(args):
                 idle_word = IDLEWORD_BC0 if bx_==0 else IDLEWORD
                 roc_data_by_link[link_counter].append(idle_word)
             if counterLinkResetIdles>0:
-                print(f'IDLES FROM LINK RESET, BX={bx_counter}, N={counterLinkResetIdles}')
+                readout['link_reset_idle_bx'] += 1
                 counterLinkResetIdles -= 1
+        event_buffer.count_bx(1)
         bx_ += 1
         bx_counter+=1 # end while loop
 
+    metrics.add_time('bx_loop',time.perf_counter()-loop_start)
+    metrics.add_time('crc',crc_seconds)
+    readout_metrics(metrics,l1as,latencies,event_buffer,readout,args,num_bx)
+    fast_command_metrics(metrics,commands,args.bx_start)
+
     # create data by channel
     counters,data_by_channel = fill_by_channel(counters,data_hard_resets,data_soft_resets,roc_data_by_link,data_commands)
 
-    # creating dataframes
-    # df_start = pd.DataFrame.from_dict(start_by_channel)
-    # df_reset = pd.DataFrame.from_dict(reset_by_channel)
-    df_data = pd.DataFrame.from_dict(data_by_channel)
+    return data_by_channel,num_bx,counters['event'],L1a_name,metrics
 
-    df_data['CLK_N'] = np.arange(args.bx_start,args.bx_start+len(df_data))
-    df_data.set_index('CLK_N',inplace=True)
-#    df_data.index.name='CLK_N'
-    # df_end = pd.DataFrame.from_dict(end_by_channel)
-
-    # write csv
+def eportRX_file_name(args,L1a_name):
     file_name = "ROC_DAQ_%ifc_"%args.N
 
     if L1a_name!='':
@@ -532,10 +1155,12 @@ def make_eportRX_input(args):
     if args.outputFileName:
         file_name=args.outputFileName
 
-    output_file = open('rocData/%s.csv'%file_name, 'w')
+    return file_name
+
+def eportRX_description(args,num_bx,num_packets,L1a_name,channels):
     description = "# Provides a simple reset and then %i fast commands"%num_bx
     if L1a_name!='':
-        description+=" with %i event packets (with %i BXs of delay)\n"%(counters['event'],args.delay)
+        description+=" with %i event packets (with %i BXs of delay)\n"%(num_packets,args.delay)
         description += "# The data idle word will contain the special 0x9 header for BC0\n"
     else:
         description+="\n"
@@ -544,10 +1169,39 @@ def make_eportRX_input(args):
         description += f"# L1As issued in BX {args.L1aBX}\n"
 
     description += f"# BCR resets to {ORBITBCR}\n"
-    description += f"# IDLE patterns {IDLEWORD_BC0}/{IDLEWORD}\n"
+    description += f"# IDLE patterns {IDLEWORD_BC0:08X}/{IDLEWORD:08X}\n"
     description += f'## assuming a Fast Command Latency of {FASTCMD_INTERNAL_LATENCY}\n'
-    output_file.write(description)
-    output_file.write("# CLK_N,"+",".join(channels)+"\n")
+    description += "# CLK_N,"+",".join(channels)+"\n"
+    return description
+
+def write_eportRX_output(args,data_by_channel,num_bx,num_packets,L1a_name,metrics=None):
+    """write the CSV pattern (and the metrics of the run next to it), returns the dataframe of the pattern"""
+    metrics = RunMetrics() if metrics is None else metrics
+    write_start = time.perf_counter()
+    channels = list(data_by_channel.keys())
+
+    # eRx words are kept as integers up to here
+    words = np.stack([np.asarray(data_by_channel['ERX_%i'%link_counter],dtype=np.uint32) for link_counter in range(NELINKS)],axis=1)
+    data_by_channel = dict(data_by_channel)
+    for link_counter in range(NELINKS): data_by_channel['ERX_%i'%link_counter] = to_hex(words[:,link_counter])
+
+    # creating dataframes
+    import pandas as pd
+
+    # df_start = pd.DataFrame.from_dict(start_by_channel)
+    # df_reset = pd.DataFrame.from_dict(reset_by_channel)
+    df_data = pd.DataFrame.from_dict(data_by_channel)
+
+    df_data['CLK_N'] = np.arange(args.bx_start,args.bx_start+len(df_data))
+    df_data.set_index('CLK_N',inplace=True)
+#    df_data.index.name='CLK_N'
+    # df_end = pd.DataFrame.from_dict(end_by_channel)
+
+    # write csv
+    file_name = eportRX_file_name(args,L1a_name)
+
+    output_file = open_output('rocData/%s.csv'%file_name, 'wb')
+    output_file.write(eportRX_description(args,num_bx,num_packets,L1a_name,channels).encode())
     # output_file.write("# start\n")
     # df_start.to_csv(output_file, index=False, header=False)
     # output_file.write("# reset\n")
@@ -557,13 +1211,26 @@ def make_eportRX_input(args):
     #shift all fast commands up by N BX to account for latency
     df_data.FAST_CMD = np.concatenate([df_data.FAST_CMD.values[FASTCMD_INTERNAL_LATENCY:],df_data.FAST_CMD.values[:FASTCMD_INTERNAL_LATENCY]])
 
-    #write it this way, to remove the last newline character
-    str_df_data=df_data.to_csv(None,header=False)
-    output_file.write(str_df_data[:-1])
+    #rendered directly from the integer words, without the last newline character
+    output_file.write(format_csv_block(df_data.index.values,words,df_data.FAST_CMD.values,df_data.RESET_B.values,df_data.SOFT_RESET_B.values))
 
     output_file.close()
+    df_data.attrs['file_name'] = 'rocData/%s.csv'%file_name
+
+    metrics.add_time('write',time.perf_counter()-write_start)
+    write_run_metrics(metrics,df_data.attrs['file_name'],args)
     return df_data
 
+def applyConfig(args,cfgInfo,source=''):
+    """set the arguments in the cfgInfo dict (skipping unknown ones)"""
+    for k in cfgInfo:
+        if k in args.__dict__:
+            args.__dict__[k] = cfgInfo[k]
+        else:
+            log.warning(f'Unrecognized parameter {k} in configuration {source}, skipping')
+
+    return args
+
 def readConfigFromFile(args):
     import json
 
@@ -571,20 +1238,12 @@ def readConfigFromFile(args):
         _file = open(args.config)
         cfgInfo=json.load(_file)
     except:
-        print(f'Error loading configuration {args.config}')
+        log.warning(f'Error loading configuration {args.config}')
         return args
 
+    return applyConfig(args,cfgInfo,f'file {args.config}')
 
-    for k in cfgInfo:
-        if k in args.__dict__:
-            args.__dict__[k] = cfgInfo[k]
-        else:
-            print(f'Unrecognized parameter {k} in configuration file {args.config}, skipping')
-
-    return args
-
-
-if __name__=='__main__':
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-N', type=int, default = 10000, dest="N", help="Number of BX to use (default: 10000)")
     parser.add_argument('--bx_start', type=int, default = 0, dest="bx_start", help="CLK number to start (default: 0)")
@@ -604,24 +1263,50 @@ if __name__=='__main__':
 
     parser.add_argument('--delay', type=int, default = 7,dest="delay", help="ROC delay to respond to L1A (in BXs)")
 
+    parser.add_argument('--bufferDepth', type=int, default=0, dest="bufferDepth", help="Number of events in the ROC event buffer (default: 0, no limit)")
+    parser.add_argument('--bufferFull', type=str, default='drop', choices=BUFFER_FULL_POLICIES, dest="bufferFull", help="L1As with the event buffer full are dropped by the ROC (drop), not sent (busy), or read out with the header status bits set (flag)")
+
     parser.add_argument('--hamErrRate', type=float, default=0., dest="hamErrRate", help="Rate at which hamming errors will be issued in link data headers (0 means no errors)")
+    parser.add_argument('--rng', type=str, default='legacy', choices=['legacy','philox'], dest="rng", help="Random numbers of the CM words: seeded from each header as in previous versions (legacy), or counter-based (philox, vectorized); hamming errors are always counter-based")
 
     parser.add_argument('--sequence', type=str, default='', dest="sequence", help="Sequence of L1A patterns to send (separated by ,)")
     parser.add_argument('--nL1a', type=str, default='', dest="nL1a", help="Length of L1A patterns sent")
     parser.add_argument('--L1a_freq', type=str, default='', dest="L1a_freq", help="Send L1As with a frequency of 1 in L1A_freq")
+    parser.add_argument('--L1a_rate', type=str, default='', dest="L1a_rate", help="L1A rate of each sequence in kHz (e.g. 750), instead of L1a_freq")
     parser.add_argument('--L1aBX', type=str, default='', dest='L1aBX', help='Send L1As in these global BXs.  If specified, this overrides options in other L1A arguments')
     parser.add_argument('--L1aStart', type=int, default=0, dest='L1aStart', help='First BX to start sending L1As in (if random) to wait until after configuration is finished')
+    parser.add_argument('--seed', type=int, default=6, dest='seed', help='Seed of the random L1A sequences, of the choice of MC events and of the counter-based random numbers (each uses its own generator)')
+    parser.add_argument('--triggerRules', type=str, default='', dest='triggerRules', help="Trigger rules applied to the L1A sequences: 'cms', or k,window pairs separated by ; for at most k L1As in any window of BXs (e.g. '1,3;2,25')")
+    parser.add_argument('--l1aVeto', type=str, default='', dest='l1aVeto', help='No L1As from before,after BXs around BCRs, EBRs and LinkResets (e.g. 2,10)')
     parser.add_argument('--mcEvtNumbers', type=str, default=None, dest='mcEvtNumbers', help='Sequence of event numbers from mc data to use')
     parser.add_argument('--zero-data',  action='store_true', default=False, dest="zerodata", help="send zero data in L1A")
     parser.add_argument('--physics-data',  action='store_true', default=False, dest="physicsdata", help="use physics data from MC in L1A")
 
     parser.add_argument('--waferCoor', type=str, default="0,1,5,3,1", dest='waferCoordinates', help='coordinates of wafer to data to load from MC: subdet,zside,layer,waferU,waferV; as a comma separated list')
     parser.add_argument('--fname', type=str, default='InputNtuples/ntuple.root', dest="fname", help="MC filename")
+    parser.add_argument('--mcEntryStart', type=int, default=0, dest="mcEntryStart", help="First entry of the MC ntuple to read")
+    parser.add_argument('--mcMaxEvents', type=int, default=None, dest="mcMaxEvents", help="Stop reading the MC ntuple after this number of events with data in the wafer (-1: one per L1A, default: read all)")
+    parser.add_argument('--mcCacheDir', type=str, default='mcCache', dest="mcCacheDir", help="Directory to cache the MC data loaded from ntuples ('' to not use a cache)")
+    parser.add_argument('--mcCacheSize', type=float, default=1000, dest="mcCacheSize", help="Maximum size of the MC data cache, in MB")
     parser.add_argument('--config', type=str, default=None, dest="config", help="Configuration file to load parameters from")
+    parser.add_argument('--engine', type=str, default='loop', choices=['loop','vector'], dest="engine", help="Engine used to emulate the ROC: per BX loop, or vectorized over BXs (default: loop)")
+    parser.add_argument('--stream', action='store_true', default=False, dest="stream", help="Write the output file in blocks of BXs as they are generated (vectorized engine), keeping memory constant for long runs")
+    parser.add_argument('--block-size', type=int, default=ORBITLAST, dest="block_size", help="Number of BXs per block when streaming (default: one orbit)")
+    parser.add_argument('--jobs', type=int, default=1, dest="jobs", help="Number of processes generating the output in parallel (vectorized engine, in shards of --shard-orbits orbits)")
+    parser.add_argument('--shard-orbits', type=int, default=16, dest="shard_orbits", help="Number of orbits in each shard generated in parallel (default: 16)")
+    parser.add_argument('--format', type=str, default='csv', choices=['csv','binary'], dest="outputFormat", help="Format of the output file: csv, or binary (memory-mappable, written with the streaming engine)")
+    parser.add_argument('--outputCache', type=str, default=None, dest="outputCache", help="Directory of a cache of generated patterns, reused when generating the same pattern again (see outputCache.py)")
+    parser.add_argument('--outputCacheMode', type=str, default='copy', choices=['copy','link'], dest="outputCacheMode", help="Restore patterns from the output cache by copy, or by hard link")
+    parser.add_argument('--log-level', type=str, default='info', choices=LOG_LEVELS, dest="logLevel", help="Level of the log messages: debug (every L1A and LinkReset), info (fast commands issued), warning or error (default: info)")
     parser.add_argument('--outputFileNAme', type=str, default=None, dest="outputFileName", help="Name of the output file (default : None, for which file name is built based on parameters selected")
 
+    return parser
+
+if __name__=='__main__':
+    parser = make_parser()
     args = parser.parse_args()
 
     args = readConfigFromFile(args)
+    setup_logging(args.logLevel)
 
     df=make_eportRX_input(args)